@@ -11,15 +11,29 @@
 """:"
 # This part is run by the shell.  It looks for an appropriate Python
 # interpreter then uses it to re-exec this script. Note that dls-python
-# is a python install at Diamond Light Source which includes pygelf.
+# is a python install at Diamond Light Source.
 # If not available, use whatever python is found on the system path.
+# The script is imported as a module (by the code in pewma_run), rather than run as a script, so that
+# its compiled bytecode is cached in pewma.pyc instead of it being compiled on every run; a file whose
+# name does not end in .py cannot be imported, so is run as a script.
+
+pewma_run='import os, sys, time
+start_time = time.time()
+del sys.argv[0]  # -c
+(directory, name) = os.path.split(os.path.realpath(sys.argv[0]))
+sys.path[0] = directory
+if name.endswith(".py"):
+    __import__(name[:-3]).run(start_time)
+else:
+    import runpy
+    runpy.run_path(sys.argv[0], run_name="__main__")'
 
 if type dls-python >/dev/null 2>/dev/null; then
-  exec dls-python "$0" "$@"
+  exec dls-python -c "$pewma_run" "$0" "$@"
 elif type python2 >/dev/null 2>/dev/null; then
-  exec python2 "$0" "$@"
+  exec python2 -c "$pewma_run" "$0" "$@"
 elif type python >/dev/null 2>/dev/null; then
-  exec python "$0" "$@"
+  exec python -c "$pewma_run" "$0" "$@"
 else
   echo 1>&2 "No usable Python interpreter was found!"
   exit 1
@@ -30,9 +44,21 @@ fi
 # The rest of the file is run by the Python interpreter.
 from __future__ import absolute_import, division, print_function, unicode_literals
 
-import ConfigParser
+import time
+STARTUP_TIMES = [('load', time.time())]  # (milestone, time) pairs reported by --profile-startup (run() adds the start time, if it was imported)
+
+# Modules that are slow to import, and only needed by some actions (tarfile, tempfile, urllib, urllib2, urlparse,
+# xml.etree, zipfile, multiprocessing), are imported in the functions that use them, since pewma is often run
+# just for a quick query such as print-workspace-path
+
+import collections
+import contextlib
 import datetime
 import errno
+try:
+    import fcntl
+except ImportError:
+    fcntl = None  # fcntl not available on Windows
 import filecmp
 import fnmatch
 import getpass
@@ -40,6 +66,10 @@ try:
     import grp
 except ImportError:
     pass  # grp not available on Windows
+import hashlib
+import heapq
+import io
+import json
 import logging
 import optparse
 import os
@@ -49,19 +79,22 @@ try:
 except ImportError:
     pass  # pwd not available on Windows
 import re
-import shlex
+import shutil
+import signal
 import socket
-import StringIO
 import stat
 import subprocess
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir  # backport of os.scandir for Python 2, if installed
+    except ImportError:
+        scandir = None
 import sys
-import tarfile
-import time
-import urllib
-import urllib2
-import xml.etree.ElementTree as ET
-from xml.parsers.expat import ExpatError
-import zipfile
+import threading
+import zlib
+STARTUP_TIMES.append(('imports', time.time()))
 
 GRAYLOG_SERVER = 'graylog2.diamond.ac.uk'
 GRAYLOG_PORT   = 12251
@@ -109,28 +142,38 @@ COMPONENT_CATEGORIES = (
     ('dawn', 'v2.6', 'dawn-v2.6.cquery', 'v3.3', ('v2.6', '2.6'), ('1.8.0',)),
     )
 
+# indexes over COMPONENT_CATEGORIES and COMPONENT_ABBREVIATIONS, built in a single pass of each
 CATEGORIES_AVAILABLE = []  # dedupe COMPONENT_CATEGORIES while preserving order
+CATEGORY_VERSIONS = {}  # (category, version synonym) --> COMPONENT_CATEGORIES entry
+VERSIONS_AVAILABLE = {}  # version synonym --> first COMPONENT_CATEGORIES entry with that synonym (used when no category is specified)
+CQUERY_CATEGORIES = {}  # CQuery --> COMPONENT_CATEGORIES entry
 for c in COMPONENT_CATEGORIES:
     if c[0] not in CATEGORIES_AVAILABLE:
         CATEGORIES_AVAILABLE.append(c[0])
-
-# template names must be of the form vx.y
-for c in COMPONENT_CATEGORIES:
-    assert c[3].startswith('v')
-    assert c[3].count('.') == 1
-
-VERSIONS_AVAILABLE = set()  # dedupe version_synonyms
-for c in COMPONENT_CATEGORIES:
     for v in c[4]:
-        VERSIONS_AVAILABLE.add(v)
-
-for abbrev, actual, cat in COMPONENT_ABBREVIATIONS:
-    assert abbrev not in CATEGORIES_AVAILABLE, 'Component abbreviation "%s" is the same as a category' % (abbrev,)
-    assert cat in CATEGORIES_AVAILABLE, 'Component abbreviation "%s" is defined with an invalid category: "%s"' % (abbrev, cat)
-    assert abbrev not in VERSIONS_AVAILABLE, 'Component abbreviation "%s" is the same as a version' % (abbrev,)
-
-for cat in CATEGORIES_AVAILABLE:
-    assert cat not in VERSIONS_AVAILABLE, 'Category "%s" is the same as a version' % (cat,)
+        CATEGORY_VERSIONS.setdefault((c[0], v), c)
+        VERSIONS_AVAILABLE.setdefault(v, c)
+    CQUERY_CATEGORIES.setdefault(c[2], c)
+ABBREVIATIONS_AVAILABLE = dict((abbrev, (actual, cat)) for (abbrev, actual, cat) in reversed(COMPONENT_ABBREVIATIONS))  # first definition wins
+
+def validate_component_tables():
+    """ Checks the consistency of COMPONENT_CATEGORIES and COMPONENT_ABBREVIATIONS
+        (only needed when components or categories are actually interpreted, so not done at startup)
+    """
+
+    # template names must be of the form vx.y
+    for c in COMPONENT_CATEGORIES:
+        assert c[3].startswith('v')
+        assert c[3].count('.') == 1
+        assert CATEGORY_VERSIONS[(c[0], c[1])] is c, 'Version "%s" of category "%s" is not one of its own synonyms' % (c[1], c[0])
+
+    for abbrev, (actual, cat) in ABBREVIATIONS_AVAILABLE.items():
+        assert abbrev not in CATEGORIES_AVAILABLE, 'Component abbreviation "%s" is the same as a category' % (abbrev,)
+        assert cat in CATEGORIES_AVAILABLE, 'Component abbreviation "%s" is defined with an invalid category: "%s"' % (abbrev, cat)
+        assert abbrev not in VERSIONS_AVAILABLE, 'Component abbreviation "%s" is the same as a version' % (abbrev,)
+
+    for cat in CATEGORIES_AVAILABLE:
+        assert cat not in VERSIONS_AVAILABLE, 'Category "%s" is the same as a version' % (cat,)
 
 INVALID_COMPONENTS = (  # tuple of (component name pattern, (applicable versions pattern), error message) 
     ('^all-dls-config$', ('^(master|v9\.[98765432])$'), 'all-dls-config no longer exists in GDA 9.2+; see Jira DAQ-328'),
@@ -147,12 +190,8 @@ CQUERY_PATTERNS_TO_SKIP_p2_mirrors_false = (
     '^gda-v9\.[01]\..*cquery$',
     )
 
-# the template name for master is the default template
-for c in COMPONENT_CATEGORIES:
-    if c[1] == 'master':
-        DEFAULT_TEMPLATE = c[3]
-        break
-assert DEFAULT_TEMPLATE   # must have been set
+# the template name for master (of the first category) is the default template
+DEFAULT_TEMPLATE = CATEGORY_VERSIONS[(CATEGORIES_AVAILABLE[0], 'master')][3]
 
 PLATFORMS_AVAILABLE =  (
     # os/ws/arch, acceptable abbreviations
@@ -161,6 +200,14 @@ PLATFORMS_AVAILABLE =  (
     ('win32,win32,x86_64', ('win32,win32,x86_64', 'win64', 'windows64',)),
     )
 
+STARTUP_BENCHMARK_THRESHOLD_MS = 75  # default maximum median time that pewma startup (for print-workspace-path) may add to starting Python
+
+PIPELINE_STAGES = ( # the stages that the pipeline action can chain, in the order they must run (at most one stage from each tuple)
+    ('materialize',),
+    ('build', 'buildthorough', 'buildinc'),
+    ('product', 'product.zip'),
+    )
+
 DLS_BUCKMINSTER_URI = 'https://alfred.diamond.ac.uk/buckminster/'  # default, can be overidden by --dls-buckminster-uri option (e.g. file:///path)
 
 JGIT_ERROR_PATTERNS = ( # JGit error messages that identify an intermittent network problem causing a checkout failure (the affected repository is only sometimes identified)
@@ -203,6 +250,28 @@ OUTPUT_LINES_TO_SUPPRESS = (
     "SLF4J: See http://www.slf4j.org/codes.html#StaticLoggerBinder for further details.\n"  # once last item seen in the output, we stop scanning for matches
     )
 
+# Literal strings used to cheaply prefilter Buckminster output lines before any regular expression is run
+# Every one of the *_PATTERNS above (and the "Error: file " compile error prefix) must contain at least one of these
+BUCKMINSTER_OUTPUT_PREFILTER_LITERALS = (b'ERROR', b'Error', b'Exception', b'HttpComponents', b'cannot be resolved')
+
+for (error_pattern, _) in (SYSTEM_PROBLEM_ERROR_PATTERNS + JGIT_ERROR_PATTERNS + PROJECT_ERROR_PATTERNS +
+                           BUCKMINSTER_BUG_ERROR_PATTERNS + COMPILE_ERROR_DUE_TO_BUCKMINSTER_BUG_PATTERNS):
+    assert any(literal.decode('ascii') in error_pattern for literal in BUCKMINSTER_OUTPUT_PREFILTER_LITERALS), 'Error pattern "%s" is not covered by the prefilter' % (error_pattern,)
+
+GIT_TRANSIENT_ERROR_PATTERNS = ( # native git clone error messages that identify an intermittent network or server problem, so the clone is worth retrying
+    'Connection (reset|refused|timed out)',
+    'Could not resolve host',
+    'Failed to connect to',
+    'Temporary failure in name resolution',
+    'Operation timed out',
+    'The remote end hung up unexpectedly',
+    'early EOF',
+    'RPC failed',
+    'index-pack failed',
+    'The requested URL returned error: 5\d\d',
+    '(ssh|kex)_exchange_identification',
+    )
+
 GERRIT_REPOSITORIES = {
     # repository                     url_part:     Gerrit URL (after prefix)
     #                                keep_origin:  if current repo origin is not Gerrit, don't change it to point to Gerrit (Gerrit version had repo history rewritten)
@@ -279,12 +348,1913 @@ GERRIT_REPOSITORIES = {
 GERRIT_URI_HTTPS = 'https://gerrit.diamond.ac.uk/'      # typically used for anonymous clone (we use SSH for authenticated clone)
 GERRIT_URI_SSH   = 'ssh://gerrit.diamond.ac.uk:29418/'  # used for authenticated clone and push
 
-class GitConfigParser(ConfigParser.RawConfigParser):
-    """ Subclass of the regular ConfigParser that handles the leading tab characters in .git/config files """
-    def readgit(self, filename):
+# the configuration of each mirror in the --git-mirror-cache: workspace clones borrow the mirror's objects (through .git/objects/info/alternates),
+# so git must never prune anything from it, neither in an automatic gc after a fetch, nor when expiring the reflog
+GIT_MIRROR_CONFIG = (('gc.auto', '0'),
+                     ('gc.pruneExpire', 'never'),
+                     ('gc.reflogExpire', 'never'),
+                     ('gc.reflogExpireUnreachable', 'never'),
+                     )
+
+PEWMA_METADATA_DIRECTORY = '.pewma'  # directory within the workspace .metadata/ where pewma keeps its own files
+WORKSPACE_GIT_INDEX_FILE = 'workspace_git_index.json'
+WORKSPACE_GIT_INDEX_FORMAT = 4  # increment if the index contents change, so that old index files are rebuilt
+MTIME_UNSTABLE_SECONDS = 2  # a directory modified this recently may change again with the same mtime (on filesystems with 1 second mtimes, such as ext3 and NFS)
+BUILD_FINGERPRINT_FILE = 'build_fingerprint.json'  # the fingerprint of workspace_git when the workspace was last built successfully
+BUILD_FINGERPRINT_FORMAT = 2  # increment if the fingerprint contents change, so that old fingerprints never match
+PROJECT_GRAPH_FILE = 'project_graph.json'
+PROJECT_GRAPH_FORMAT = 1  # increment if the parsed project file contents change, so that old graph files are rebuilt
+GRAPH_JOBS = 8  # default number of projects whose files are parsed concurrently when building the project graph
+REPOSITORY_JOBS = 4  # default number of repositories (or snapshot files) processed concurrently by preclone, snapshots, --affected-* and the build fingerprint
+
+def split_manifest_clauses(value):
+    """ Splits the value of an OSGi manifest header (e.g. Require-Bundle) into clauses, which are separated by commas
+        outside quoted strings (attributes such as uses:="a,b" contain commas)
+        Returns a list of the names in the clauses (a clause can name several packages, before its attributes and directives)
+    """
+
+    clauses = []
+    current = []
+    quoted = False
+    for c in value:
+        if c == '"':
+            quoted = not quoted
+        if (c == ',') and not quoted:
+            clauses.append(''.join(current))
+            current = []
+        else:
+            current.append(c)
+    clauses.append(''.join(current))
+
+    names = []
+    for clause in clauses:
+        for part in clause.split(';'):
+            part = part.strip()
+            if (not part) or ('=' in part):
+                break  # the attributes and directives follow the names
+            names.append(part)
+    return names
+
+def parse_bundle_manifest(manifest_path):
+    """ Reads the dependency information from a bundle's META-INF/MANIFEST.MF
+        Returns a dictionary with the "symbolic_name", the bundles it "requires", the packages it "imports" and "exports",
+        and the "host" bundle if it is a fragment
+    """
+
+    with open(manifest_path, 'rb') as manifest_file:
+        text = manifest_file.read().decode('utf-8', 'replace')
+    headers = {}
+    header = None
+    for line in text.splitlines():
+        if line.startswith(' ') and header:
+            headers[header] += line[1:]  # a continuation line
+        elif ':' in line:
+            (header, value) = line.split(':', 1)
+            header = header.strip()
+            headers[header] = value.strip()
+        else:
+            header = None
+    return {'symbolic_name': (split_manifest_clauses(headers.get('Bundle-SymbolicName', '')) or [None])[0],
+            'requires': split_manifest_clauses(headers.get('Require-Bundle', '')),
+            'imports': split_manifest_clauses(headers.get('Import-Package', '')),
+            'exports': split_manifest_clauses(headers.get('Export-Package', '')),
+            'host': (split_manifest_clauses(headers.get('Fragment-Host', '')) or [None])[0],
+            }
+
+def parse_feature_xml(feature_path):
+    """ Reads the dependency information from a feature's feature.xml
+        Returns a dictionary with the feature "id", the features it "includes", the "plugins" it contains,
+        and the plugins and features it "requires"
+    """
+    import xml.etree.ElementTree as ET
+
+    root = ET.parse(feature_path).getroot()
+    return {'id': root.get('id'),
+            'includes': [element.get('id') for element in root.findall('includes') if element.get('id')],
+            'plugins': [element.get('id') for element in root.findall('plugin') if element.get('id')],
+            'requires': [element.get('plugin') or element.get('feature') for element in root.findall('requires/import')
+                         if element.get('plugin') or element.get('feature')],
+            }
+
+def parse_eclipse_project(project_path):
+    """ Reads an Eclipse .project file
+        Returns a dictionary with the project "name", its "natures", and the other projects it "references"
+    """
+    import xml.etree.ElementTree as ET
+
+    root = ET.parse(project_path).getroot()
+    return {'name': (root.findtext('name') or '').strip(),
+            'natures': [(element.text or '').strip() for element in root.findall('natures/nature')],
+            'references': [(element.text or '').strip() for element in root.findall('projects/project') if (element.text or '').strip()],
+            }
+
+PROJECT_FILE_PARSERS = (  # (key in a project graph node, file in the project, function to parse it)
+    ('bundle', os.path.join('META-INF', 'MANIFEST.MF'), parse_bundle_manifest),
+    ('feature', 'feature.xml', parse_feature_xml),
+    ('project', '.project', parse_eclipse_project),
+    )
+
+def stat_project_files(project_loc):
+    """ Returns {key: [mtime, size]} for the files of a project that the project graph is built from (those that exist)
+    """
+
+    stats = {}
+    for (key, filename, _) in PROJECT_FILE_PARSERS:
+        try:
+            file_stat = os.stat(os.path.join(project_loc, filename))
+        except OSError:
+            continue
+        stats[key] = [file_stat.st_mtime, file_stat.st_size]
+    return stats
+
+def parse_project_files(project_loc):
+    """ Reads the MANIFEST.MF, feature.xml and .project files of a project (whichever it has)
+        Returns a project graph node: a dictionary with "bundle", "feature" and "project" (each None if the project does not
+        have that file, see the parse_... functions), and any "errors" reading them
+    """
+
+    node = {'errors': []}
+    for (key, filename, parser) in PROJECT_FILE_PARSERS:
+        node[key] = None
+        path = os.path.join(project_loc, filename)
+        if os.path.isfile(path):
+            try:
+                node[key] = parser(path)
+            except (IOError, OSError, SyntaxError) as e:  # xml.etree.ElementTree.ParseError is a SyntaxError
+                node['errors'].append('%s: %s' % (filename, e))
+    return node
+
+def strongly_connected_components(graph):
+    """ Returns the strongly connected components of a directed graph, {node: iterable of successor nodes}, each as a sorted list
+        A component is only output after all the components it has edges to (Tarjan's algorithm, without recursion, since
+        dependency chains can be longer than Python's recursion limit)
+    """
+
+    index = {}
+    lowlink = {}
+    stack = []
+    on_stack = set()
+    components = []
+    counter = 0
+    for root in sorted(graph):
+        if root in index:
+            continue
+        index[root] = lowlink[root] = counter
+        counter += 1
+        stack.append(root)
+        on_stack.add(root)
+        work = [(root, iter(sorted(graph.get(root, ()))))]
+        while work:
+            (node, successors) = work[-1]
+            for successor in successors:
+                if successor not in index:
+                    index[successor] = lowlink[successor] = counter
+                    counter += 1
+                    stack.append(successor)
+                    on_stack.add(successor)
+                    work.append((successor, iter(sorted(graph.get(successor, ())))))
+                    break
+                elif successor in on_stack:
+                    lowlink[node] = min(lowlink[node], index[successor])
+            else:
+                work.pop()
+                if work:
+                    lowlink[work[-1][0]] = min(lowlink[work[-1][0]], lowlink[node])
+                if lowlink[node] == index[node]:
+                    component = []
+                    while True:
+                        member = stack.pop()
+                        on_stack.discard(member)
+                        component.append(member)
+                        if member == node:
+                            break
+                    components.append(sorted(component))
+    return components
+
+def topological_batches(dependencies):
+    """ Orders the nodes of a dependency graph, {node: set of the nodes it depends on}, into batches: each node is in a later
+        batch than everything it depends on, so the nodes in a batch can be processed in parallel once the earlier batches are done
+        The nodes in a dependency cycle are put in the same batch
+        Returns (list of batches, each a sorted list of nodes; list of cycles, each a sorted list of the nodes in it)
+    """
+
+    components = strongly_connected_components(dependencies)  # dependencies come before their dependents
+    component_of = {}
+    for (n, component) in enumerate(components):
+        for node in component:
+            component_of[node] = n
+    levels = []
+    for component in components:
+        depends_on = set(component_of[dependency] for node in component for dependency in dependencies.get(node, ()))
+        depends_on.discard(component_of[component[0]])
+        levels.append(1 + max([levels[n] for n in depends_on] or [-1]))
+
+    batches = [[] for _ in range(max(levels or [-1]) + 1)]
+    for (component, level) in zip(components, levels):
+        batches[level].extend(component)
+    cycles = [component for component in components if (len(component) > 1) or (component[0] in dependencies.get(component[0], ()))]
+    return ([sorted(batch) for batch in batches], cycles)
+
+def map_concurrently(function, items, jobs):
+    """ Returns [function(item) for item in items], calling function for up to jobs items concurrently (in threads)
+    """
+    from multiprocessing.pool import ThreadPool
+
+    items = list(items)
+    if (jobs <= 1) or (len(items) <= 1):
+        return [function(item) for item in items]
+    pool = ThreadPool(min(jobs, len(items)))
+    try:
+        results = pool.map(function, items)
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+    return results
+
+def imap_concurrently(function, items, jobs):
+    """ Generates function(item) for item in items, in order, calling function for up to jobs items concurrently (in threads),
+        so that each result can be used as soon as it (and those before it) are available
+    """
+    from multiprocessing.pool import ThreadPool
+
+    items = list(items)
+    if not items:
+        return
+    pool = ThreadPool(max(1, min(jobs, len(items))))
+    try:
+        for result in pool.imap(function, items):
+            yield result
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+def list_directory(path):
+    """ Returns (names of subdirectories, names of other entries) in a directory, using a single scandir where available
+    """
+    dirs = []
+    files = []
+    if scandir:
+        for entry in scandir(path):
+            (dirs if entry.is_dir() else files).append(entry.name)
+    else:
+        for name in os.listdir(path):
+            (dirs if os.path.isdir(os.path.join(path, name)) else files).append(name)
+    return (dirs, files)
+
+@contextlib.contextmanager
+def exclusive_file_lock(lock_path, shared=False):
+    """ Context manager that holds an exclusive lock on a file (created if necessary), to serialise access between processes
+        With shared=True, holds a shared lock instead, which excludes only holders of the exclusive lock
+        (on Windows, where fcntl is not available, no lock is taken)
+    """
+    with open(lock_path, 'a') as lock_file:
+        if fcntl:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+# files in a workspace template that Eclipse never rewrites in place (Lucene index segments are write-once, and local history
+# entries are only ever added or deleted), so they can be hardlinked into a new workspace rather than copied
+TEMPLATE_WRITE_ONCE_FILE_PATTERNS = ('*.lucene60/_*', '*.lucene60/segments_*', '*/org.eclipse.core.resources/.history/*')
+FICLONE = 0x40049409  # Linux ioctl to clone a file (copy-on-write), on filesystems that support it (such as btrfs and xfs)
+
+def remove_tree(directory):
+    """ Deletes a directory tree, including any read-only files in it (which shutil.rmtree cannot delete on Windows)
+    """
+    def make_writable_and_retry(function, path, excinfo):
+        os.chmod(path, stat.S_IWRITE)
+        function(path)
+    shutil.rmtree(directory, onerror=make_writable_and_retry)
+
+TRASH_DIRECTORY_PREFIX = '.trash-'  # a directory deleted in the background is first renamed to <parent>/.trash-<timestamp>.<pid>.<name>
+REAP_JOBS = 8  # default number of directories whose files are deleted concurrently when reaping trash
+
+def _reap_directory(path):
+    """ Deletes the files (and symlinks) in a directory
+        Returns (paths of its subdirectories, number of files deleted); a file or directory already gone is ignored,
+        since another reaper may be working on the same tree
+    """
+    subdirectories = []
+    deleted = 0
+    try:
+        if scandir:
+            entries = [(entry.path, entry.is_dir(follow_symlinks=False)) for entry in scandir(path)]
+        else:
+            entries = [(os.path.join(path, name), None) for name in os.listdir(path)]
+    except OSError as e:
+        if e.errno == errno.ENOENT:
+            return (subdirectories, deleted)
+        raise
+    for (entry_path, is_dir) in entries:
+        if is_dir is None:
+            is_dir = os.path.isdir(entry_path) and not os.path.islink(entry_path)
+        if is_dir:
+            subdirectories.append(entry_path)
+            continue
+        try:
+            os.unlink(entry_path)
+        except OSError as e:
+            if e.errno == errno.ENOENT:
+                continue
+            if platform.system() != 'Windows':
+                raise  # on Linux, it is the directory's permissions that matter, and the file may be hardlinked from a cache, so leave it alone
+            os.chmod(entry_path, stat.S_IWRITE)  # a read-only file
+            os.unlink(entry_path)
+        deleted += 1
+    return (subdirectories, deleted)
+
+def reap_tree(directory, jobs=REAP_JOBS):
+    """ Deletes a directory tree, deleting the files in up to jobs directories concurrently (a level of the tree at a time),
+        which is much faster than a serial delete on a network filesystem
+        Returns (number of files deleted, number of directories deleted)
+    """
+    directories = []
+    files_deleted = 0
+    level = [directory]
+    while level:
+        directories.extend(level)
+        results = map_concurrently(_reap_directory, level, jobs)
+        level = [subdirectory for (subdirectories, _) in results for subdirectory in subdirectories]
+        files_deleted += sum(deleted for (_, deleted) in results)
+    for path in reversed(directories):  # deepest first
+        try:
+            os.rmdir(path)
+        except OSError as e:
+            if e.errno not in (errno.ENOENT, errno.ENOTEMPTY):  # not empty if another reaper is still deleting its contents
+                raise
+    return (files_deleted, len(directories))
+
+SET_GROUP_JOBS = 8  # default number of top-level entries (such as repositories) processed concurrently by --directories.recursive
+
+def set_group_in_tree(path, gid, uid):
+    """ Makes a file or directory tree group-owned by gid (if gid is not None) and group-writable and readable by others,
+        as "chgrp -R" and "chmod -R g+rwX,o+rX" would, with directories also setgid. Only entries owned by uid (or all
+        entries, if uid is 0, for root) are changed, and only if their group or mode differ, so that repeated runs are cheap.
+        Symlinks are not followed or changed, and nor are files with more than one hardlink (such as files hardlinked from
+        the download cache into a workspace by clone_tree), since changing them would change every other link to them too.
+        Returns {'checked': number of entries checked, 'changed': number changed, 'failed': number that could not be changed,
+                 'shared': number of hardlinked files left unchanged}
+    """
+    counts = {'checked': 0, 'changed': 0, 'failed': 0, 'shared': 0}
+    try:
+        stack = [(path, os.lstat(path))]
+    except OSError:
+        return counts  # deleted since it was listed
+    while stack:
+        (entry_path, entry_stat) = stack.pop()
+        counts['checked'] += 1
+        if stat.S_ISLNK(entry_stat.st_mode):
+            continue
+        is_dir = stat.S_ISDIR(entry_stat.st_mode)
+        if is_dir:
+            try:
+                if scandir:
+                    stack.extend((entry.path, entry.stat(follow_symlinks=False)) for entry in scandir(entry_path))
+                else:
+                    stack.extend((os.path.join(entry_path, name), os.lstat(os.path.join(entry_path, name))) for name in os.listdir(entry_path))
+            except OSError:
+                counts['failed'] += 1  # probably not readable
+        if uid and (entry_stat.st_uid != uid):
+            continue
+        if (not is_dir) and (entry_stat.st_nlink > 1):
+            counts['shared'] += 1
+            continue
+        mode_old = stat.S_IMODE(entry_stat.st_mode)
+        mode_new = mode_old | stat.S_IRGRP | stat.S_IWGRP | stat.S_IROTH
+        if is_dir:
+            mode_new |= stat.S_IXGRP | stat.S_ISGID | stat.S_IXOTH
+        elif mode_old & stat.S_IXUSR:
+            mode_new |= stat.S_IXGRP | stat.S_IXOTH
+        change_gid = (gid is not None) and (entry_stat.st_gid != gid)
+        if not (change_gid or (mode_new != mode_old)):
+            continue
+        try:
+            if change_gid:
+                os.lchown(entry_path, -1, gid)  # may clear setgid on an executable, so chmod afterwards
+                mode_old = stat.S_IMODE(os.lstat(entry_path).st_mode)
+            if mode_new != mode_old:
+                os.chmod(entry_path, mode_new)
+            counts['changed'] += 1
+        except OSError:
+            counts['failed'] += 1
+    return counts
+
+def clone_tree(source_dir, destination_dir, member_prefix=None):
+    """ Copies the files in an extracted workspace template to a workspace, without decompressing anything.
+        If member_prefix is specified (for example, "tp/"), only that subdirectory is copied.
+        Write-once files are hardlinked. Other files (which Eclipse may modify) are cloned copy-on-write if the filesystem
+        supports it, so that they share storage with the template until they are changed, otherwise they are copied.
+        Returns a dictionary of {"hardlinked"|"cloned"|"copied": number of files}
+    """
+
+    counts = {'hardlinked': 0, 'cloned': 0, 'copied': 0}
+    can_hardlink = hasattr(os, 'link')
+    can_clone = bool(fcntl) and (platform.system() == 'Linux')
+    if member_prefix:
+        assert member_prefix.endswith('/')
+        source_dir = os.path.join(source_dir, *member_prefix.rstrip('/').split('/'))
+        destination_dir = os.path.join(destination_dir, *member_prefix.rstrip('/').split('/'))
+        if not os.path.isdir(source_dir):
+            return counts
+    for (source_path, dirnames, filenames) in os.walk(source_dir):
+        relpath = os.path.relpath(source_path, source_dir)
+        destination_path = os.path.normpath(os.path.join(destination_dir, relpath))
+        template_reldir = (member_prefix or '') + ('' if relpath == os.curdir else relpath.replace(os.sep, '/') + '/')
+        if not os.path.isdir(destination_path):
+            os.makedirs(destination_path)
+        for filename in filenames:
+            source_file = os.path.join(source_path, filename)
+            destination_file = os.path.join(destination_path, filename)
+            if can_hardlink and any(fnmatch.fnmatch(template_reldir + filename, pattern) for pattern in TEMPLATE_WRITE_ONCE_FILE_PATTERNS):
+                try:
+                    os.link(source_file, destination_file)
+                    counts['hardlinked'] += 1
+                    continue
+                except OSError:
+                    can_hardlink = False  # probably a different filesystem, so don't try again
+            if can_clone:
+                try:
+                    with open(source_file, 'rb') as source:
+                        with open(destination_file, 'wb') as destination:
+                            fcntl.ioctl(destination.fileno(), FICLONE, source.fileno())
+                    counts['cloned'] += 1
+                    continue
+                except (IOError, OSError):
+                    can_clone = False  # not supported by the filesystem, so don't try again
+            shutil.copyfile(source_file, destination_file)
+            counts['copied'] += 1
+    return counts
+
+def merge_tree(source_dir, destination_dir):
+    """ Moves the contents of source_dir into destination_dir (on the same filesystem), merging directories that exist in both.
+        A file that already exists in destination_dir is kept, and the copy from source_dir is discarded.
+        source_dir is deleted afterwards. Returns a list of the paths (relative to destination_dir) that were discarded.
+    """
+
+    discarded = []
+    if not os.path.isdir(destination_dir):
+        os.makedirs(destination_dir)
+    to_merge = ['']
+    while to_merge:
+        relpath = to_merge.pop()
+        for name in os.listdir(os.path.join(source_dir, relpath)):
+            source = os.path.join(source_dir, relpath, name)
+            destination = os.path.join(destination_dir, relpath, name)
+            if not os.path.lexists(destination):
+                os.rename(source, destination)
+            elif os.path.isdir(source) and os.path.isdir(destination) and not os.path.islink(source):
+                to_merge.append(os.path.join(relpath, name))
+            else:
+                discarded.append(os.path.join(relpath, name))
+    remove_tree(source_dir)
+    return discarded
+
+
+METRICS_FORMAT = 1  # increment if the metrics records change
+METRICS_FILE_MAX_BYTES = 4 * 1024 * 1024  # when the metrics file reaches this size, it is renamed to <file>.1 (replacing any earlier one)
+METRICS_SKIPPED_ACTIONS = ('print-workspace-path', 'get-branches-expected', 'resolve-components', 'sites', 'stats')  # quick queries, not timed
+
+PEWMA_SCRIPT = os.path.abspath(__file__[:-1] if __file__.endswith(('.pyc', '.pyo')) else __file__)  # this script, to run pewma in a new process
+LOGGER_NAME = '__main__'  # the name pewma's log records had when it was always run as a script, kept (now that it is imported) so that Graylog records do not change
+
+JAVA_CACHE_FILE = os.path.join('~', '.pewma', 'java_cache.json')  # results of "java -XshowSettings:properties -version", by JDK
+JAVA_CACHE_FORMAT = 1  # increment if the cache contents change, so that old caches are discarded
+JAVA_CACHE_ENTRIES_KEPT = 20
+JAVA_OPTIONS_ENVIRONMENT_VARIABLES = ('JAVA_TOOL_OPTIONS', '_JAVA_OPTIONS', 'JDK_JAVA_OPTIONS')  # these can change java.io.tmpdir
+
+def find_executables_on_path(executable_name):
+    """ Returns a list of the paths of the executables called executable_name on the PATH, in order (like "which -a")
+    """
+
+    found = []
+    for directory in os.environ.get('PATH', '').split(os.pathsep):
+        candidate = os.path.join(directory or os.curdir, executable_name)
+        if os.path.isfile(candidate) and os.access(candidate, os.X_OK) and (candidate not in found):
+            found.append(candidate)
+    return found
+
+def wait_for_subprocess(process):
+    """ Waits for a subprocess.Popen process to exit (any output pipe must already have been read to the end)
+        Returns (return code, peak RSS in MB of the process and the descendants it waited for, or None if not known).
+        The peak is that of this process alone (got with wait4), unlike RUSAGE_CHILDREN, which covers every child pewma has had
+    """
+
+    if not hasattr(os, 'wait4'):  # not available on Windows
+        process.wait()
+        return (process.returncode, None)
+    while True:
+        try:
+            (_, status, rusage) = os.wait4(process.pid, 0)
+            break
+        except OSError as e:
+            if e.errno != errno.EINTR:
+                raise
+    process.returncode = -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)  # as Popen.wait() would set it
+    return (process.returncode, rusage.ru_maxrss // 1024)  # KB on Linux
+
+TEST_TARGETS = ('junit-tests', 'jyunit-tests', 'all-tests')  # the ant targets that --test-jobs can split into shards
+TEST_DURATIONS_FILE = os.path.join('~', '.pewma', 'test_durations.json')  # the duration of each project's tests when last run
+TEST_DURATIONS_FORMAT = 1  # increment if the file contents change, so that old files are discarded
+TEST_DURATION_DEFAULT = 60.0  # seconds assumed for a project whose tests have never been timed (if no project has been)
+JUNIT_TESTSUITE_PATTERN = re.compile(r'<testsuite\b([^>]*)>')
+JUNIT_ATTRIBUTE_PATTERN = re.compile(r'\b(tests|failures|errors|time)="([0-9.,]*)"')
+
+def balance_shards(weights, count):
+    """ Splits the items in weights, a dictionary of {item: weight}, into at most count shards with roughly equal total weights
+            (by assigning the heaviest remaining item to the lightest shard so far)
+        Returns a list of (total weight, sorted list of items), heaviest shard first
+    """
+
+    heap = [(0.0, n, []) for n in range(min(count, len(weights)))]
+    for item in sorted(weights, key=lambda item: (-weights[item], item)):
+        (total, n, items) = heapq.heappop(heap)
+        items.append(item)
+        heapq.heappush(heap, (total + weights[item], n, items))
+    return sorted(((total, sorted(items)) for (total, _, items) in heap), key=lambda shard: (-shard[0], shard[1]))
+
+def read_junit_report_summary(report_path):
+    """ Returns a dictionary of the "tests", "failures", "errors" and "time" attributes of the <testsuite> in a JUnit report file,
+        or None if the file could not be read
+        (only the start of the file is read, since the output captured from the tests can make reports very large)
+    """
+
+    try:
+        with open(report_path, 'rb') as report_file:
+            head = report_file.read(8192).decode('utf-8', 'replace')
+    except (IOError, OSError):
+        return None
+    match = JUNIT_TESTSUITE_PATTERN.search(head)
+    if not match:
+        return None
+    summary = {'tests': 0, 'failures': 0, 'errors': 0, 'time': 0.0}
+    for (name, value) in JUNIT_ATTRIBUTE_PATTERN.findall(match.group(1)):
+        try:
+            summary[name] = float(value.replace(',', '')) if name == 'time' else int(value)
+        except ValueError:
+            pass
+    return summary
+
+AUTO_TUNE_PROFILE_FORMAT = 1  # increment if the profile contents change, so that old profiles are discarded
+AUTO_TUNE_PROFILE_RUNS_KEPT = 50  # number of runs remembered in each host profile
+AUTO_TUNE_MIN_HEAP_MB = 768
+AUTO_TUNE_MAX_HEAP_MB = 8192
+AUTO_TUNE_HEAP_STEP_MB = 256  # heap sizes are rounded up to a multiple of this
+AUTO_TUNE_JVM_OVERHEAD_MB = 384  # approximate non-heap memory (metaspace, threads, code cache) of the Buckminster JVM
+AUTO_TUNE_HEAP_MB_PER_MATERIALIZATION = 256  # don't run more parallel materializations than the heap can comfortably hold
+AUTO_TUNE_MAX_PARALLEL = 16
+
+def _read_cgroup_file(controller, filename):
+    """ Returns the stripped contents of a cgroup file for this process (cgroup v1 if controller is specified, else v2), or None
+    """
+
+    cgroup_path = '/'
+    try:
+        with open('/proc/self/cgroup') as cgroup_file:
+            for line in cgroup_file:
+                (_, controllers, path) = line.rstrip('\n').split(':', 2)
+                if (controller in controllers.split(',')) if controller else (controllers == ''):
+                    cgroup_path = path
+                    break
+    except (IOError, ValueError):
+        pass
+    mount_point = os.path.join('/sys/fs/cgroup', controller) if controller else '/sys/fs/cgroup'
+    for directory in (os.path.join(mount_point, cgroup_path.lstrip('/')), mount_point):  # inside a container, the cgroup is usually mounted as the root
+        try:
+            with open(os.path.join(directory, filename)) as value_file:
+                return value_file.read().strip()
+        except IOError:
+            pass
+    return None
+
+def get_host_resources():
+    """ Returns (memory in bytes (or None if unknown), number of CPUs) available to this process, honouring cgroup (container) limits
+    """
+    import multiprocessing
+
+    memory = None
+    try:
+        memory = os.sysconf(str('SC_PAGE_SIZE')) * os.sysconf(str('SC_PHYS_PAGES'))
+    except (AttributeError, ValueError, OSError):
+        pass  # not available on Windows
+    for limit in (_read_cgroup_file(None, 'memory.max'), _read_cgroup_file('memory', 'memory.limit_in_bytes')):
+        if limit and limit.isdigit() and (int(limit) < 2**60):  # an unlimited cgroup v1 reports a huge number
+            memory = min(memory or int(limit), int(limit))
+
+    cpus = multiprocessing.cpu_count()
+    if hasattr(os, 'sched_getaffinity'):
+        cpus = min(cpus, len(os.sched_getaffinity(0)))
+    quota_period = (_read_cgroup_file(None, 'cpu.max') or '').split()
+    if len(quota_period) != 2:
+        quota_period = (_read_cgroup_file('cpu', 'cpu.cfs_quota_us'), _read_cgroup_file('cpu', 'cpu.cfs_period_us'))
+    try:
+        (quota, period) = (int(quota_period[0]), int(quota_period[1]))
+        if (quota > 0) and (period > 0):
+            cpus = min(cpus, max(1, int(round(quota / period))))
+    except (TypeError, ValueError):
+        pass  # no limit ("max" or -1), or no cgroup
+    return (memory, cpus)
+
+class DownloadCache(object):
+    """ A local cache of files downloaded from URLs (workspace templates and CQueries), which can be shared between
+        workspaces, and between pewma runs on the same machine (including concurrent runs).
+        The contents of each file are stored once, named by their SHA-256, and there is a small index file per URL that
+        records the ETag/Last-Modified validators, so that a download only transfers data if the file on the server has changed.
+        If the server cannot be reached (or offline=True), the cached copy is used.
+        When the contents exceed max_bytes, the least recently used files are evicted.
+        Zip files (workspace templates) can also be kept extracted, so that new workspaces can be created without unzipping;
+        an extracted copy is evicted along with its zip file.
+    """
+
+    def __init__(self, cache_dir, max_bytes, logger):
+        self.cache_dir = cache_dir
+        self.objects_dir = os.path.join(cache_dir, 'objects')
+        self.index_dir = os.path.join(cache_dir, 'index')
+        self.extracted_dir = os.path.join(cache_dir, 'extracted')
+        self.max_bytes = max_bytes
+        self.logger = logger
+        for directory in (self.objects_dir, self.index_dir, self.extracted_dir):
+            if not os.path.isdir(directory):
+                try:
+                    os.makedirs(directory)
+                except OSError:
+                    if not os.path.isdir(directory):  # might have been created by a concurrent run
+                        raise
+
+    def _write_file_atomically(self, path, data):
+        temp_path = '%s.%s.%s.tmp' % (path, socket.gethostname(), os.getpid())
+        with open(temp_path, 'wb') as temp_file:
+            temp_file.write(data)
+        if platform.system() == 'Windows' and os.path.exists(path):
+            os.remove(path)  # rename does not replace an existing file on Windows
+        os.rename(temp_path, path)
+
+    def _read_entry(self, index_path):
+        """ Returns the index entry for a URL, or None if there isn't one, or its contents are no longer in the cache
+        """
+        try:
+            with open(index_path, 'r') as index_file:
+                entry = json.load(index_file)
+            if os.path.getsize(os.path.join(self.objects_dir, entry['sha256'])) != entry['size']:
+                return None
+        except (IOError, OSError, ValueError, KeyError):
+            return None
+        return entry
+
+    def _read_object(self, entry):
+        with open(os.path.join(self.objects_dir, entry['sha256']), 'rb') as object_file:
+            data = object_file.read()
+        if hashlib.sha256(data).hexdigest() != entry['sha256']:
+            raise IOError('cached copy of %s is corrupt' % (entry['url'],))
+        return data
+
+    def fetch(self, url, timeout=30, offline=False):
+        """ Returns the contents of a URL, from the cache if the copy there is current (or the server cannot be reached, times out,
+            or returns a 5xx server error)
+            Raises the urllib2 (or other) exception if the download fails and there is no cached copy, or if the server reports that
+            the URL is not available (e.g. 404 Not Found, 403 Forbidden or 410 Gone), since then the cached copy must not be used
+        """
+        import httplib
+        import urllib2
+
+        url_key = hashlib.sha256(url.encode('utf-8')).hexdigest()
+        index_path = os.path.join(self.index_dir, url_key + '.json')
+        with exclusive_file_lock(os.path.join(self.index_dir, url_key + '.lock')):  # only one run downloads a URL at a time
+            entry = self._read_entry(index_path)
+            data = None
+            if entry and offline:
+                self.logger.info('Using cached copy of "%s" (offline)' % (url,))
+                data = self._read_object(entry)
+            else:
+                request = urllib2.Request(url)
+                if entry and entry.get('etag'):
+                    request.add_header('If-None-Match', entry['etag'])
+                if entry and entry.get('last_modified'):
+                    request.add_header('If-Modified-Since', entry['last_modified'])
+                try:
+                    if offline:
+                        raise IOError('offline, and no cached copy available')
+                    resp = urllib2.urlopen(request, timeout=timeout)
+                    try:
+                        self.logger.info('Downloading %s bytes from "%s"' % (resp.info().get('content-length', '<unknown>'), resp.geturl()))
+                        data = resp.read()
+                        headers = resp.info()
+                    finally:
+                        resp.close()
+                except urllib2.HTTPError as e:
+                    if (e.code != 304) or (not entry):
+                        if (not entry) or (e.code < 500):
+                            raise
+                        self.logger.warn('Error downloading from "%s": %s (using cached copy)' % (url, e))
+                    else:
+                        self.logger.info('Using cached copy of "%s" (not modified on server)' % (url,))
+                    data = self._read_object(entry)
+                except (urllib2.URLError, IOError, httplib.HTTPException) as e:  # could not connect, timed out, or the connection failed
+                    if not entry:
+                        raise
+                    self.logger.warn('Error downloading from "%s": %s (using cached copy)' % (url, e))
+                    data = self._read_object(entry)
+                else:
+                    sha256 = hashlib.sha256(data).hexdigest()
+                    object_path = os.path.join(self.objects_dir, sha256)
+                    if not os.path.isfile(object_path):
+                        self._write_file_atomically(object_path, data)
+                    entry = {'url': url, 'sha256': sha256, 'size': len(data),
+                             'etag': headers.get('etag'), 'last_modified': headers.get('last-modified'),
+                             'fetched': time.time()}
+            entry['last_used'] = time.time()
+            self._write_file_atomically(index_path, json.dumps(entry, sort_keys=True).encode('utf-8'))
+
+        self.evict()
+        return data
+
+    @contextlib.contextmanager
+    def extracted_zip(self, data):
+        """ Context manager that returns the directory containing the extracted contents of zip file data (extracting it
+            first if that has not already been done), and prevents the directory from being evicted while it is in use.
+            The extracted files are read-only, since they may be hardlinked elsewhere, and must not be changed.
+        """
+        import zipfile
+
+        sha256 = hashlib.sha256(data).hexdigest()
+        extracted_path = os.path.join(self.extracted_dir, sha256)
+        with exclusive_file_lock(os.path.join(self.extracted_dir, sha256 + '.lock')):
+            if not os.path.isdir(extracted_path):
+                temp_path = '%s.%s.%s.tmp' % (extracted_path, socket.gethostname(), os.getpid())
+                if os.path.isdir(temp_path):
+                    remove_tree(temp_path)
+                self.logger.debug('Extracting %s bytes into download cache "%s"' % (len(data), extracted_path))
+                with contextlib.closing(zipfile.ZipFile(io.BytesIO(data), 'r')) as zip_file:
+                    zip_file.extractall(temp_path)
+                for (dirpath, _, filenames) in os.walk(temp_path):
+                    for filename in filenames:
+                        os.chmod(os.path.join(dirpath, filename), stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
+                os.rename(temp_path, extracted_path)  # so that the extracted directory is either complete, or absent
+            yield extracted_path
+
+    def evict(self):
+        """ Removes the least recently used files from the cache until its contents are no bigger than max_bytes
+        """
+
+        with exclusive_file_lock(os.path.join(self.cache_dir, 'evict.lock')):
+            entries = []  # (last used, index path, sha256)
+            for name in os.listdir(self.index_dir):
+                if name.endswith('.json'):
+                    index_path = os.path.join(self.index_dir, name)
+                    try:
+                        with open(index_path, 'r') as index_file:
+                            entry = json.load(index_file)
+                        entries.append((entry.get('last_used', 0), index_path, entry['sha256']))
+                    except (IOError, OSError, ValueError, KeyError):
+                        pass
+            object_sizes = {}
+            for name in os.listdir(self.objects_dir):
+                if not name.endswith('.tmp'):
+                    object_sizes[name] = os.path.getsize(os.path.join(self.objects_dir, name))
+            total_bytes = sum(object_sizes.values())
+            if total_bytes <= self.max_bytes:
+                return
+
+            entries.sort()
+            referenced = {}  # {sha256: number of index entries referring to it}
+            for (_, _, sha256) in entries:
+                referenced[sha256] = referenced.get(sha256, 0) + 1
+            orphans = [sha256 for sha256 in object_sizes if sha256 not in referenced]
+            for (_, index_path, sha256) in [(None, None, o) for o in orphans] + entries:
+                if total_bytes <= self.max_bytes:
+                    break
+                if index_path:
+                    os.remove(index_path)
+                    referenced[sha256] -= 1
+                if (not referenced.get(sha256)) and (sha256 in object_sizes):
+                    os.remove(os.path.join(self.objects_dir, sha256))
+                    total_bytes -= object_sizes.pop(sha256)
+                    extracted_path = os.path.join(self.extracted_dir, sha256)
+                    if os.path.isdir(extracted_path):
+                        with exclusive_file_lock(extracted_path + '.lock'):
+                            remove_tree(extracted_path)
+                    self.logger.debug('Evicted %s from download cache "%s"' % (sha256, self.cache_dir))
+
+
+SNAPSHOT_FORMAT = 1  # increment if the snapshot manifest or key contents change, so that old snapshots are not used
+SNAPSHOT_CHUNK_BYTES = 1024 * 1024  # files are hashed, compressed and restored in chunks of this size
+
+class WorkspaceSnapshots(object):
+    """ A store of snapshots of materialized workspaces (workspace/ and workspace_git/), so that a materialize of the same
+        components, CQuery, template and repository HEAD commits can be restored instead of being run again.
+        The contents of each file are stored once, zlib-compressed and named by their SHA-256, so snapshots share the storage
+        for the files they have in common. A snapshot is a (compressed JSON) manifest of the directories, files and symlinks
+        in each tree, named by its key; the mtime of the manifest records when the snapshot was last used.
+        When the stored files exceed max_bytes, the least recently used snapshots are evicted.
+        Saves and restores hold a shared lock, and eviction an exclusive one, so that files are never removed while in use.
+    """
+
+    def __init__(self, snapshot_dir, max_bytes, logger):
+        self.snapshot_dir = snapshot_dir
+        self.objects_dir = os.path.join(snapshot_dir, 'objects')
+        self.manifests_dir = os.path.join(snapshot_dir, 'manifests')
+        self.lock_path = os.path.join(snapshot_dir, 'snapshots.lock')
+        self.max_bytes = max_bytes
+        self.logger = logger
+        for directory in (self.objects_dir, self.manifests_dir):
+            self._makedirs(directory)
+
+    def _makedirs(self, directory):
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                if not os.path.isdir(directory):  # might have been created by a concurrent run
+                    raise
+
+    def _manifest_path(self, key):
+        return os.path.join(self.manifests_dir, key + '.json.z')
+
+    def _object_path(self, sha256):
+        return os.path.join(self.objects_dir, sha256[:2], sha256)
+
+    def _read_manifest(self, manifest_path):
+        with open(manifest_path, 'rb') as manifest_file:
+            manifest = json.loads(zlib.decompress(manifest_file.read()).decode('utf-8'))
+        if manifest.get('format') != SNAPSHOT_FORMAT:
+            raise ValueError('snapshot format %s is not supported' % (manifest.get('format'),))
+        return manifest
+
+    def _scan_tree(self, root):
+        """ Returns a list of entries for the directories, files and symlinks below root, parents before their contents:
+                [relative path, "d", mode, mtime] for a directory
+                [relative path, "f", mode, mtime, size] for a file (the SHA-256 of its contents is appended when stored)
+                [relative path, "l", symlink target] for a symlink
+            Trash directories (being deleted in the background) are ignored
+        """
+        entries = []
+        for (dirpath, dirnames, filenames) in os.walk(root):
+            dirnames[:] = sorted(d for d in dirnames if not d.startswith(TRASH_DIRECTORY_PREFIX))
+            for name in dirnames + sorted(filenames):
+                path = os.path.join(dirpath, name)
+                relpath = os.path.relpath(path, root)
+                path_stat = os.lstat(path)
+                if stat.S_ISLNK(path_stat.st_mode):
+                    entries.append([relpath, 'l', os.readlink(path)])
+                elif stat.S_ISDIR(path_stat.st_mode):
+                    entries.append([relpath, 'd', stat.S_IMODE(path_stat.st_mode), path_stat.st_mtime])
+                elif stat.S_ISREG(path_stat.st_mode):
+                    entries.append([relpath, 'f', stat.S_IMODE(path_stat.st_mode), path_stat.st_mtime, path_stat.st_size])
+        return entries
+
+    def _store_file(self, path):
+        """ Stores the contents of a file, unless they are already stored
+            Returns the SHA-256 of the contents
+            (safe to call from multiple threads and processes at once)
+        """
+        digest = hashlib.sha256()
+        with open(path, 'rb') as source:
+            for chunk in iter(lambda: source.read(SNAPSHOT_CHUNK_BYTES), b''):
+                digest.update(chunk)
+        sha256 = digest.hexdigest()
+        object_path = self._object_path(sha256)
+        if os.path.isfile(object_path):
+            return sha256
+        self._makedirs(os.path.dirname(object_path))
+        temp_path = '%s.%s.%s.%s.tmp' % (object_path, socket.gethostname(), os.getpid(), threading.current_thread().ident)
+        compressor = zlib.compressobj(1)  # most of a workspace is jars and git packs, which are already compressed
+        with open(path, 'rb') as source:
+            with open(temp_path, 'wb') as temp_file:
+                for chunk in iter(lambda: source.read(SNAPSHOT_CHUNK_BYTES), b''):
+                    temp_file.write(compressor.compress(chunk))
+                temp_file.write(compressor.flush())
+        os.rename(temp_path, object_path)
+        return sha256
+
+    def _restore_file(self, path, entry):
+        (_, _, mode, mtime, size, sha256) = entry
+        decompressor = zlib.decompressobj()
+        with open(self._object_path(sha256), 'rb') as source:
+            with open(path, 'wb') as destination:
+                for chunk in iter(lambda: source.read(SNAPSHOT_CHUNK_BYTES), b''):
+                    destination.write(decompressor.decompress(chunk))
+                destination.write(decompressor.flush())
+        if os.path.getsize(path) != size:
+            raise IOError('stored copy of "%s" is corrupt' % (path,))
+        os.chmod(path, mode)
+        os.utime(path, (mtime, mtime))
+
+    def save(self, key, roots, info, jobs=4):
+        """ Saves a snapshot of the directory trees in roots, a list of (tree name, root directory), with info (a dictionary
+            describing what was materialized) recorded in the manifest
+            Returns (number of files, total bytes)
+        """
+
+        manifest = {'format': SNAPSHOT_FORMAT, 'key': key, 'created': time.time(), 'info': info, 'trees': {}}
+        with exclusive_file_lock(self.lock_path, shared=True):
+            for (name, root) in roots:
+                entries = self._scan_tree(root)
+                files = [entry for entry in entries if entry[1] == 'f']
+                for (entry, sha256) in zip(files, map_concurrently(lambda entry: self._store_file(os.path.join(root, entry[0])), files, jobs)):
+                    entry.append(sha256)
+                manifest['trees'][name] = entries
+            manifest_path = self._manifest_path(key)
+            temp_path = '%s.%s.%s.tmp' % (manifest_path, socket.gethostname(), os.getpid())
+            with open(temp_path, 'wb') as manifest_file:
+                manifest_file.write(zlib.compress(json.dumps(manifest).encode('utf-8')))
+            os.rename(temp_path, manifest_path)
+        self.evict()
+        files = [entry for tree_entries in manifest['trees'].values() for entry in tree_entries if entry[1] == 'f']
+        return (len(files), sum(entry[4] for entry in files))
+
+    def restore(self, key, roots, jobs=4):
+        """ Restores the snapshot with the key into the directory trees in roots, a list of (tree name, root directory),
+            which must not already exist
+            Returns the info recorded in the manifest, or None if there is no such snapshot
+            If an exception is raised, partially restored trees are left for the caller to delete
+        """
+
+        with exclusive_file_lock(self.lock_path, shared=True):
+            manifest_path = self._manifest_path(key)
+            if not os.path.isfile(manifest_path):
+                return None
+            manifest = self._read_manifest(manifest_path)
+            if any(name not in manifest['trees'] for (name, _) in roots):
+                return None
+            for (name, root) in roots:
+                entries = manifest['trees'][name]
+                os.makedirs(root)
+                directories = []
+                for entry in entries:
+                    path = os.path.join(root, entry[0])
+                    if entry[1] == 'd':
+                        os.mkdir(path)
+                        directories.append((path, entry))
+                    elif entry[1] == 'l':
+                        os.symlink(entry[2], path)
+                map_concurrently(lambda entry: self._restore_file(os.path.join(root, entry[0]), entry), [e for e in entries if e[1] == 'f'], jobs)
+                for (path, entry) in reversed(directories):  # after their contents, since creating files changes a directory's mtime
+                    os.chmod(path, entry[2])
+                    os.utime(path, (entry[3], entry[3]))
+            os.utime(manifest_path, None)  # records that the snapshot has been used
+        return manifest['info']
+
+    def list_snapshots(self):
+        """ Returns a list of (last used, key, info) for the snapshots, most recently used first
+        """
+
+        snapshots = []
+        for name in os.listdir(self.manifests_dir):
+            if name.endswith('.json.z'):
+                manifest_path = os.path.join(self.manifests_dir, name)
+                try:
+                    snapshots.append((os.path.getmtime(manifest_path), name[:-len('.json.z')], self._read_manifest(manifest_path)['info']))
+                except (IOError, OSError, ValueError, zlib.error):
+                    pass
+        return sorted(snapshots, reverse=True)
+
+    def evict(self):
+        """ Removes the least recently used snapshots until the stored files are no bigger than max_bytes, and removes any
+            stored files that no snapshot refers to
+        """
+
+        with exclusive_file_lock(self.lock_path):
+            object_sizes = {}
+            for subdirectory in os.listdir(self.objects_dir):
+                for name in os.listdir(os.path.join(self.objects_dir, subdirectory)):
+                    if not name.endswith('.tmp'):
+                        object_sizes[name] = os.path.getsize(self._object_path(name))
+            total_bytes = sum(object_sizes.values())
+
+            manifests = []  # (last used, manifest path, set of the SHA-256s it refers to)
+            referenced = {}  # {sha256: number of snapshots referring to it}
+            for name in os.listdir(self.manifests_dir):
+                if name.endswith('.json.z'):
+                    manifest_path = os.path.join(self.manifests_dir, name)
+                    try:
+                        manifest = self._read_manifest(manifest_path)
+                    except (IOError, OSError, ValueError, zlib.error):
+                        os.remove(manifest_path)  # unreadable, or an old format
+                        continue
+                    sha256s = set(entry[5] for entries in manifest['trees'].values() for entry in entries if entry[1] == 'f')
+                    manifests.append((os.path.getmtime(manifest_path), manifest_path, sha256s))
+                    for sha256 in sha256s:
+                        referenced[sha256] = referenced.get(sha256, 0) + 1
+
+            unreferenced = [sha256 for sha256 in object_sizes if not referenced.get(sha256)]
+            for (_, manifest_path, sha256s) in [(None, None, unreferenced)] + sorted(manifests):
+                if manifest_path:
+                    if total_bytes <= self.max_bytes:
+                        break
+                    os.remove(manifest_path)
+                    self.logger.debug('Evicted snapshot %s from "%s"' % (os.path.basename(manifest_path), self.snapshot_dir))
+                for sha256 in sha256s:
+                    if manifest_path:
+                        referenced[sha256] -= 1
+                    if (not referenced.get(sha256)) and (sha256 in object_sizes):
+                        os.remove(self._object_path(sha256))
+                        total_bytes -= object_sizes.pop(sha256)
+
+
+XVFB_LOCK_DIRECTORY = '/tmp'  # where an X server for display <n> creates .X<n>-lock (and its socket, .X11-unix/X<n>)
+XVFB_CLAIM_SEARCH = 200  # the number of display numbers tried (from the preferred one) when claiming a free display
+XVFB_SERVER_ARGUMENTS = ('-screen', '0', '1280x1024x24', '-nolisten', 'tcp')  # for the Xvfb servers in the pool
+XVFB_START_TIMEOUT = 10  # seconds to wait for an Xvfb server in the pool to start accepting connections
+
+def read_lock_pid(lock_path):
+    """ Reads an X server style lock file (the process ID as 10 characters and a newline)
+        Returns (whether the file exists, the process ID or None if it could not be read)
+    """
+
+    try:
+        with open(lock_path) as lock_file:
+            contents = lock_file.read(64)
+    except (IOError, OSError) as e:
+        return (e.errno != errno.ENOENT, None)
+    try:
+        return (True, int(contents.strip()))
+    except ValueError:
+        return (True, None)
+
+def pid_alive(pid):
+    """ Returns whether a process exists (possibly belonging to another user)
+    """
+
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+
+class XvfbDisplays(object):
+    """ Allocates Xvfb display numbers that are unique among the concurrent test runs on a machine (Linux only), and
+        manages a pool of Xvfb servers that are started once, and then reused by test runs.
+        A display is in use if an X server has it (/tmp/.X<n>-lock names a live process, or /tmp/.X11-unix/X<n> exists),
+        or if a pewma run has claimed it, with /tmp/.pewma-X<n>-lock. A claim has the same format as an X server lock, and
+        is stale (and taken over) once the process that made it has died, so a crashed run never leaves a display unusable.
+        A claim is created with O_EXCL, so only one run (of any user) can make it; runs of the same user also hold a lock on
+        /tmp/.pewma-Xvfb-<user>.lock while claiming, so that they can safely take over each other's stale claims (another user's
+        stale claim cannot be removed from /tmp, so that display is passed over).
+        The pool is recorded in /tmp/.pewma-Xvfb-pool-<user>.json, a list of {"display", "pid"}.
+    """
+
+    def __init__(self, logger, lock_dir=XVFB_LOCK_DIRECTORY):
+        self.lock_dir = lock_dir
+        self.logger = logger
+        self.allocator_lock_path = os.path.join(lock_dir, '.pewma-Xvfb-%s.lock' % (getpass.getuser(),))  # per user, since others could not open it
+        self.pool_path = os.path.join(lock_dir, '.pewma-Xvfb-pool-%s.json' % (getpass.getuser(),))
+        self.claimed = set()
+        self.claimed_lock = threading.Lock()  # test shards claim displays from several threads at once
+
+    def _claim_path(self, display):
+        return os.path.join(self.lock_dir, '.pewma-X%s-lock' % (display,))
+
+    def server_active(self, display):
+        """ Returns whether an X server is running (or starting) for a display
+        """
+
+        (exists, pid) = read_lock_pid(os.path.join(self.lock_dir, '.X%s-lock' % (display,)))
+        if exists:
+            return (pid is None) or pid_alive(pid)  # an unreadable lock is assumed to be being written by a starting server
+        return os.path.exists(os.path.join(self.lock_dir, '.X11-unix', 'X%s' % (display,)))
+
+    def _try_claim(self, display):
+        """ Claims a display, unless a live process already has (must be called holding the allocator lock)
+            Returns whether the display was claimed
+        """
+
+        claim_path = self._claim_path(display)
+        (exists, pid) = read_lock_pid(claim_path)
+        if exists:
+            if pid and pid_alive(pid):
+                return False
+            try:
+                if os.stat(claim_path).st_uid != os.getuid():
+                    return False  # another user's claim may still be being written, and could not be removed anyway
+                os.remove(claim_path)  # stale: this user's claims are always written in full holding the allocator lock, so the process died
+            except OSError:
+                return False
+            self.logger.debug('Removed stale claim on Xvfb display %s (process %s)' % (display, pid))
+        try:
+            fd = os.open(claim_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+        except OSError:
+            return False
+        with os.fdopen(fd, 'w') as claim_file:
+            claim_file.write('%10d\n' % (os.getpid(),))
+        with self.claimed_lock:
+            self.claimed.add(display)
+        return True
+
+    def claim(self, preferred):
+        """ Claims a display that no X server is using, trying the preferred display number first, then the following ones
+            Returns the display number
+        """
+
+        with exclusive_file_lock(self.allocator_lock_path):
+            for display in range(preferred, preferred + XVFB_CLAIM_SEARCH):
+                if (not self.server_active(display)) and self._try_claim(display):
+                    return display
+        raise PewmaException('ERROR: no free Xvfb display found in %s-%s' % (preferred, preferred + XVFB_CLAIM_SEARCH - 1))
+
+    def lease(self):
+        """ Claims the display of one of the running Xvfb servers in the pool
+            Returns the display number, or None if there is no pool, or all its displays are in use
+        """
+
+        with exclusive_file_lock(self.allocator_lock_path):
+            for server in self.read_pool():
+                if self._try_claim(server['display']):
+                    return server['display']
+        return None
+
+    def release(self, display):
+        """ Releases a display claimed (or leased) by this process
+        """
+
+        with self.claimed_lock:
+            self.claimed.discard(display)
+        claim_path = self._claim_path(display)
+        if read_lock_pid(claim_path)[1] == os.getpid():
+            try:
+                os.remove(claim_path)
+            except OSError:
+                pass
+
+    def release_all(self):
+        """ Releases all the displays claimed by this process
+        """
+
+        with self.claimed_lock:
+            claimed = list(self.claimed)
+        for display in claimed:
+            self.release(display)
+
+    def read_pool(self):
+        """ Returns the Xvfb servers in the pool that are still running, a list of {"display", "pid"}
+        """
+
+        try:
+            with open(self.pool_path) as pool_file:
+                servers = json.load(pool_file)
+        except (IOError, ValueError):
+            return []
+        return [server for server in servers if pid_alive(server['pid']) and (read_lock_pid(os.path.join(self.lock_dir, '.X%s-lock' % (server['display'],)))[1] == server['pid'])]
+
+    def start_pool(self, count, preferred):
+        """ Starts Xvfb servers until there are count running in the pool, on free displays from preferred onwards
+            Returns the servers in the pool
+        """
+
+        def detach():
+            os.setsid()  # so that the server outlives this pewma run (and isn't sent its terminal's signals)
+
+        with exclusive_file_lock(self.pool_path + '.lock'):
+            servers = self.read_pool()
+            with open(os.devnull, 'r+') as devnull:
+                while len(servers) < count:
+                    display = self.claim(preferred)  # held while the server starts, so no other run can take the display
+                    try:
+                        process = subprocess.Popen(('Xvfb', ':%s' % (display,)) + XVFB_SERVER_ARGUMENTS,
+                                                   stdin=devnull, stdout=devnull, stderr=devnull, close_fds=True, preexec_fn=detach)
+                        socket_path = os.path.join(self.lock_dir, '.X11-unix', 'X%s' % (display,))
+                        deadline = time.time() + XVFB_START_TIMEOUT
+                        while (not os.path.exists(socket_path)) and (process.poll() is None) and (time.time() < deadline):
+                            time.sleep(0.1)
+                        if not os.path.exists(socket_path):
+                            if process.poll() is None:
+                                process.terminate()
+                            raise PewmaException('ERROR: Xvfb server for display :%s did not start' % (display,))
+                    finally:
+                        self.release(display)
+                    self.logger.info('Started Xvfb server for display :%s (process %s)' % (display, process.pid))
+                    servers.append({'display': display, 'pid': process.pid})
+                    self._write_pool(servers)
+                    preferred = display + 1
+            self._write_pool(servers)
+        return servers
+
+    def stop_pool(self):
+        """ Stops the Xvfb servers in the pool
+            Returns the number of servers stopped
+        """
+
+        with exclusive_file_lock(self.pool_path + '.lock'):
+            servers = self.read_pool()
+            for server in servers:
+                pid = read_lock_pid(self._claim_path(server['display']))[1]
+                if pid and pid_alive(pid):
+                    self.logger.warn('Xvfb display :%s is in use by process %s, stopping it anyway' % (server['display'], pid))
+                try:
+                    os.kill(server['pid'], signal.SIGTERM)
+                    self.logger.info('Stopped Xvfb server for display :%s (process %s)' % (server['display'], server['pid']))
+                except OSError as e:
+                    self.logger.warn('Could not stop Xvfb server for display :%s (process %s): %s' % (server['display'], server['pid'], e))
+            if os.path.exists(self.pool_path):
+                os.remove(self.pool_path)
+        return len(servers)
+
+    def _write_pool(self, servers):
+        temp_path = '%s.%s.tmp' % (self.pool_path, os.getpid())
+        with open(temp_path, 'w') as pool_file:
+            json.dump(servers, pool_file)
+        os.rename(temp_path, self.pool_path)
+
+
+class GitConfigFile(object):
+    """ Reads and edits a .git/config file in-process, as an alternative to running "git config -f <file> ..." once per change.
+        Changes are made to the lines in memory, and written back in a single atomic rewrite by write(), under git's own lock.
+        Existing lines (including their tab indentation and comments) are left exactly as they are, apart from those of a key that is set.
+        As in git, a key can follow its section header on the same line, and a value can be continued onto the next line with a backslash.
+        Names are as used by git config, e.g. "remote.origin.url"; the last value of a multi-valued key is the one returned by get().
+    """
+
+    SECTION_HEADER_RE = re.compile(r'^\s*\[\s*([^\]\s"]+)(?:\s+"((?:[^"\\]|\\.)*)")?\s*\]')
+    KEY_VALUE_RE = re.compile(r'^\s*([A-Za-z][-A-Za-z0-9]*)\s*(?:=\s*(.*?))?\s*$')
+
+    def __init__(self, filename):
+        self.filename = filename
         with open(filename, 'r') as config_file:
-            text = config_file.read()
-        self.readfp(StringIO.StringIO(text.replace('\t', '')), filename)
+            self.lines = config_file.readlines()
+        self.original_lines = list(self.lines)  # to detect a change by another process before write()
+        if self.lines and not self.lines[-1].endswith('\n'):
+            self.lines[-1] += '\n'
+        self.changed = False
+
+    @staticmethod
+    def split_name(name):
+        """ Splits a name like "remote.origin.url" into a (section, subsection, key) tuple, normalised for comparison
+        """
+        (section, _, key) = name.rpartition('.')
+        (section, _, subsection) = section.partition('.')
+        return (section.lower(), subsection or None, key.lower())
+
+    @staticmethod
+    def parse_value(raw_value):
+        """ Returns the value of a key, with any quotes, escapes and trailing comment removed
+        """
+        if raw_value is None:
+            return 'true'  # a key with no "=" is a boolean true
+        value = []
+        in_quotes = False
+        pending_space = ''
+        escapes = {'n': '\n', 't': '\t', 'b': '\b', '"': '"', '\\': '\\'}
+        index = 0
+        while index < len(raw_value):
+            char = raw_value[index]
+            if char == '\\' and index + 1 < len(raw_value):
+                value.append(pending_space + escapes.get(raw_value[index + 1], raw_value[index + 1]))
+                pending_space = ''
+                index += 1
+            elif char == '"':
+                in_quotes = not in_quotes
+            elif char in '#;' and not in_quotes:
+                break
+            elif char.isspace() and not in_quotes:
+                pending_space += char  # whitespace is only kept if something follows it
+            else:
+                value.append(pending_space + char)
+                pending_space = ''
+            index += 1
+        return ''.join(value)
+
+    @staticmethod
+    def format_value(value):
+        """ Returns a value in the form to be written to the file, quoted and escaped if necessary
+        """
+        if value and not any(c in value for c in '#;"\\\n\t') and (value == value.strip()):
+            return value
+        return '"%s"' % (value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n').replace('\t', '\\t'),)
+
+    def _parse(self):
+        """ Returns a list of (first line index, last line index, section, subsection, key or None, raw value) for every section header
+            and key (a key on the same line as its header has the same first line index; a continued value spans several lines)
+        """
+        entries = []
+        section = subsection = None
+        index = 0
+        while index < len(self.lines):
+            first_index = index
+            line = self.lines[index]
+            header = self.SECTION_HEADER_RE.match(line)
+            if header:
+                section = header.group(1).lower()
+                subsection = header.group(2)
+                if subsection is not None:
+                    subsection = re.sub(r'\\(.)', r'\1', subsection)
+                elif '.' in section:
+                    (section, _, subsection) = section.partition('.')  # deprecated [section.subsection] syntax
+                entries.append((index, index, section, subsection, None, None))
+                line = line[header.end():]  # which may contain a key
+            key_value = self.KEY_VALUE_RE.match(line)
+            if key_value and (section is not None):
+                raw_value = key_value.group(2)
+                # a value ending with an odd number of backslashes is continued on the next line
+                while raw_value and ((len(raw_value) - len(raw_value.rstrip('\\'))) % 2) and (index + 1 < len(self.lines)):
+                    index += 1
+                    raw_value = raw_value[:-1] + self.lines[index].rstrip('\r\n')
+                entries.append((first_index, index, section, subsection, key_value.group(1).lower(), raw_value))
+            index += 1
+        return entries
+
+    def get_all(self, name):
+        """ Returns a list of all the values of a key (empty if the key is not set)
+        """
+        (section, subsection, key) = self.split_name(name)
+        return [self.parse_value(raw_value) for (_, _, s, ss, k, raw_value) in self._parse()
+                if (s, ss, k) == (section, subsection, key)]
+
+    def get(self, name, default=None):
+        """ Returns the last value of a key (like "git config --get"), or default if the key is not set
+        """
+        values = self.get_all(name)
+        return values[-1] if values else default
+
+    def _insert(self, section, subsection, key, value, entries):
+        """ Adds a new key line at the end of the last matching section, creating the section if necessary
+        """
+        new_line = '\t%s = %s\n' % (key, self.format_value(value))
+        section_lines = [last_index for (_, last_index, s, ss, _, _) in entries if (s, ss) == (section, subsection)]
+        if section_lines:
+            self.lines.insert(section_lines[-1] + 1, new_line)
+        else:
+            if subsection is None:
+                self.lines.append('[%s]\n' % (section,))
+            else:
+                self.lines.append('[%s "%s"]\n' % (section, subsection.replace('\\', '\\\\').replace('"', '\\"')))
+            self.lines.append(new_line)
+        self.changed = True
+
+    def set(self, name, value):
+        """ Sets a key to a single value (like "git config <name> <value>")
+            Returns False if the key has multiple values (which git would refuse to overwrite), otherwise True
+        """
+        (section, subsection, key) = self.split_name(name)
+        entries = self._parse()
+        matches = [(first_index, last_index) for (first_index, last_index, s, ss, k, _) in entries if (s, ss, k) == (section, subsection, key)]
+        if len(matches) > 1:
+            return False
+        if matches:
+            (first_index, last_index) = matches[0]
+            old_lines = self.lines[first_index:last_index + 1]
+            header = self.SECTION_HEADER_RE.match(old_lines[0])
+            if header:
+                # the key follows its section header on the same line, so keep the header, and put the key on a line of its own
+                new_lines = [old_lines[0][:header.end()] + '\n', '\t%s = %s\n' % (key, self.format_value(value))]
+            else:
+                indent = old_lines[0][:len(old_lines[0]) - len(old_lines[0].lstrip())]
+                new_lines = ['%s%s = %s\n' % (indent, key, self.format_value(value))]
+            if new_lines != old_lines:
+                self.lines[first_index:last_index + 1] = new_lines
+                self.changed = True
+        else:
+            self._insert(section, subsection, key, value, entries)
+        return True
+
+    def add(self, name, value):
+        """ Adds another value to a key, keeping any existing values (like "git config --add <name> <value>")
+        """
+        (section, subsection, key) = self.split_name(name)
+        self._insert(section, subsection, key, value, self._parse())
+
+    def write(self):
+        """ Writes the changed file back, replacing the original atomically (and keeping its permissions)
+            As git does, the new contents are written to <file>.lock, created exclusively, which is then renamed over the file,
+            so that if "git config" runs at the same time, whichever finds the lock taken fails, rather than one of the changes being lost
+            Raises IOError if the file is locked, or has been changed since it was read
+        """
+        if not self.changed:
+            return
+        lock_filename = self.filename + '.lock'
+        try:
+            mode = stat.S_IMODE(os.stat(self.filename).st_mode)
+        except OSError:
+            mode = 0o666
+        try:
+            fd = os.open(lock_filename, os.O_WRONLY | os.O_CREAT | os.O_EXCL, mode)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+            raise IOError(e.errno, 'Unable to create "%s": File exists (another git process seems to be running in this repository)' % (lock_filename,))
+        try:
+            with os.fdopen(fd, 'w') as lock_file:
+                with open(self.filename, 'r') as config_file:
+                    if config_file.readlines() != self.original_lines:
+                        raise IOError('"%s" was changed by another process while it was being edited' % (self.filename,))
+                lock_file.writelines(self.lines)
+            os.chmod(lock_filename, mode)  # in case the umask removed some of the permissions
+            if platform.system() == 'Windows':
+                os.remove(self.filename)  # rename does not replace an existing file on Windows
+            os.rename(lock_filename, self.filename)
+        except:
+            os.remove(lock_filename)
+            raise
+        self.original_lines = list(self.lines)
+        self.changed = False
+
+
+class BuckminsterOutputScanner(object):
+    """ Scans Buckminster output, one line at a time, for the known error messages in the *_PATTERNS tables.
+        Patterns are compiled once, and a line is only matched against them if it passes a cheap literal
+        prefilter (most lines do not), so that scanning adds little to the cost of echoing the output.
+    """
+
+    def __init__(self, scan_for_materialize_errors=True, scan_compile_messages=True, suppress_compile_warnings=False, stage_markers=()):
+        """ stage_markers is a sequence of (line prefix, stage name): when Buckminster echoes a line starting with the prefix
+            (the script command that starts the stage), subsequent errors are attributed to that stage
+        """
+
+        self.scan_compile_messages = scan_compile_messages
+        self.suppress_compile_warnings = suppress_compile_warnings
+        self.stage_markers = stage_markers
+        self.stages_reached = [stage_markers[0][1]] if stage_markers else []
+        self.stage_error_counts = {}  # {stage name: number of errors seen while the stage was running}
+
+        self.system_problems = []
+        self.jgit_errors_repos = []
+        self.jgit_errors_general = []
+        self.project_error_projects = []
+        self.buckminster_bugs = []
+        self.compile_error_bugs = []  # compile errors caused by Buckminster bugs
+        self.compile_errors_seen = False  # regular compile errors
+        self.lines_scanned = 0
+
+        families = [(SYSTEM_PROBLEM_ERROR_PATTERNS, self._record_system_problem)]
+        if scan_for_materialize_errors:
+            families.extend(((JGIT_ERROR_PATTERNS, self._record_jgit_error),
+                             (PROJECT_ERROR_PATTERNS, self._record_project_error),
+                             (BUCKMINSTER_BUG_ERROR_PATTERNS, self._record_buckminster_bug),
+                             ))
+        self.error_patterns = [(re.compile(error_pattern), error_summary, recorder)
+                               for (patterns, recorder) in families for (error_pattern, error_summary) in patterns]  # (compiled pattern, error summary, method to record a match)
+        self.compile_error_bug_patterns = [(re.compile(error_pattern), error_summary)
+                                           for (error_pattern, error_summary) in COMPILE_ERROR_DUE_TO_BUCKMINSTER_BUG_PATTERNS]
+
+        # a single alternation of every pattern that applies, so that one regex search tells us whether any pattern matches
+        all_patterns = [p for (p, _) in COMPILE_ERROR_DUE_TO_BUCKMINSTER_BUG_PATTERNS] if scan_compile_messages else []
+        all_patterns.extend(p for (patterns, _) in families for (p, _) in patterns)
+        self.any_error_pattern = re.compile('|'.join('(?:%s)' % (p,) for p in all_patterns))
+
+        # compare as byte strings, so that lines containing non-ASCII characters don't provoke a UnicodeWarning
+        self.lines_to_suppress = frozenset(line.encode('ascii') for line in OUTPUT_LINES_TO_SUPPRESS)
+        self.last_line_to_suppress = OUTPUT_LINES_TO_SUPPRESS[-1].encode('ascii')
+        self.seen_last_line_to_suppress = False  # optimisation to avoid looking for OUTPUT_LINES_TO_SUPPRESS once we've seen them all
+
+    def _record_system_problem(self, match, error_summary):
+        self.system_problems.append(error_summary)
+
+    def _record_jgit_error(self, match, error_summary):
+        if isinstance(error_summary, int):
+            self.jgit_errors_repos.append(os.path.basename(match.group(error_summary)))
+        else:
+            self.jgit_errors_general.append(error_summary)
+
+    def _record_project_error(self, match, error_summary):
+        try:
+            self.project_error_projects.append(match.group(error_summary))
+        except:
+            self.project_error_projects.append('<unknown>')
+
+    def _record_buckminster_bug(self, match, error_summary):
+        self.buckminster_bugs.append(error_summary)
+
+    def _record_stage_error(self):
+        if self.stages_reached:
+            stage = self.stages_reached[-1]
+            self.stage_error_counts[stage] = self.stage_error_counts.get(stage, 0) + 1
+
+    def scan_line(self, line):
+        """ Scans a line of output (a byte string, including the trailing newline), recording any errors found
+            Returns True if the line should be echoed, False if it should be suppressed
+        """
+
+        self.lines_scanned += 1
+        # sometimes there are system problems
+        # sometimes JGit gets intermittent failures (network?) when cloning a repository
+        # sometimes Buckminster detects an error in the projects
+        # sometimes Buckminster hits an intermittent bug
+        # sometimes there are compile errors, possibly caused by an earlier Buckminster bug
+        passes_prefilter = any(literal in line for literal in BUCKMINSTER_OUTPUT_PREFILTER_LITERALS)
+        if self.stage_markers and line.startswith(b'INFO:  '):
+            for (marker, stage) in self.stage_markers:
+                if line.startswith(marker) and (stage not in self.stages_reached):
+                    self.stages_reached.append(stage)
+                    break
+        error_match = passes_prefilter and self.any_error_pattern.search(line)
+        if error_match:
+            for (error_pattern, error_summary, recorder) in self.error_patterns:
+                match = error_pattern.search(line)
+                if match:
+                    recorder(match, error_summary)
+                    self._record_stage_error()
+        if self.suppress_compile_warnings and line.startswith(b'Warning: file '):
+            return False
+        if self.scan_compile_messages and passes_prefilter:
+            compile_error_bug = None
+            if error_match:
+                for (error_pattern, error_summary) in self.compile_error_bug_patterns:
+                    if error_pattern.search(line):
+                        compile_error_bug = error_summary
+                        break
+            if compile_error_bug:
+                self.compile_error_bugs.append(compile_error_bug)
+                self._record_stage_error()
+            elif line.startswith(b'Error: file '):
+                self.compile_errors_seen = True
+                self._record_stage_error()
+
+        if self.seen_last_line_to_suppress:
+            return True
+        if line in self.lines_to_suppress:
+            if line == self.last_line_to_suppress:
+                self.seen_last_line_to_suppress = True
+            return False
+        return True
+
+    def errors_found(self):
+        """ Returns True if any of the error patterns (but not a regular compile error) was seen
+        """
+        return any((self.system_problems, self.jgit_errors_repos, self.jgit_errors_general, self.project_error_projects, self.buckminster_bugs, self.compile_error_bugs))
+
+
+class BuckminsterRMap(object):
+    """ The parts of a Buckminster RMap (resource map) needed to clone its git repositories without running Buckminster:
+        the property definitions, and the remote URI of each git provider.
+        Only the property expressions that DLS RMaps use are understood (constant, propertyRef, and replace/match).
+    """
+
+    RM_NAMESPACE = '{http://www.eclipse.org/buckminster/RMap-1.0}'
+    BC_NAMESPACE = '{http://www.eclipse.org/buckminster/Common-1.0}'
+    PROPERTY_REFERENCE_RE = re.compile(r'\$\{([^${}]+)\}')  # innermost ${...}, since a property name can itself contain references
+
+    def __init__(self):
+        self.property_elements = {}  # {property name: <propertyElement> element}
+        self.git_remote_uris = {}    # {repository directory name (e.g. "gda-core.git"): git.remote.uri (unexpanded)}
+
+    def add(self, rmapdata):
+        """ Adds the contents of one RMap file
+            Returns the list of hrefs of any other RMap files that it redirects to (redirects for a component name pattern are ignored)
+        """
+        import xml.etree.ElementTree as ET
+
+        root = ET.fromstring(rmapdata)
+        for element in root.findall(self.RM_NAMESPACE + 'propertyElement'):
+            self.property_elements.setdefault(element.get('key'), element)
+        for provider in root.findall('{0}searchPath/{0}provider'.format(self.RM_NAMESPACE)):
+            if provider.get('readerType') != 'git':
+                continue
+            uri = provider.find(self.RM_NAMESPACE + 'uri')
+            # the checkout location is "{0}/<repository>.git,{1}", where {0} is repository.git.checkout.root (workspace_git)
+            repo_dir = uri is not None and uri.get('format', '').split(',')[0]
+            if not (repo_dir and repo_dir.startswith('{0}/') and repo_dir.endswith('.git')):
+                continue
+            for remote in provider.findall(self.RM_NAMESPACE + 'property'):
+                if remote.get('key') == 'git.remote.uri':
+                    self.git_remote_uris.setdefault(repo_dir[len('{0}/'):], remote.get('value'))
+        return [redirect.get('href') for redirect in root.findall(self.RM_NAMESPACE + 'redirect') if not redirect.get('pattern')]
+
+    def expand(self, value, properties, depth=0):
+        """ Returns value with all ${...} property references replaced
+            properties is a dictionary of {name: value} that take precedence over the RMap's own definitions (as the CQuery and -D properties do)
+            Raises ValueError if a property is undefined, or the definitions are circular
+        """
+
+        if depth > 50:
+            raise ValueError('property definitions nested too deeply (circular?) expanding "%s"' % (value,))
+        match = self.PROPERTY_REFERENCE_RE.search(value)
+        while match:
+            value = value[:match.start()] + self.get_property(match.group(1), properties, depth + 1) + value[match.end():]
+            match = self.PROPERTY_REFERENCE_RE.search(value)
+        return value
+
+    def get_property(self, name, properties, depth=0):
+        if name in properties:
+            return self.expand(properties[name], properties, depth)
+        if name not in self.property_elements:
+            raise ValueError('property "%s" is not defined' % (name,))
+        return self._evaluate(self.property_elements[name][0], properties, depth)
+
+    def _evaluate(self, expression, properties, depth):
+        if expression.tag == self.BC_NAMESPACE + 'constant':
+            return self.expand(expression.get('value', ''), properties, depth)
+        if expression.tag == self.BC_NAMESPACE + 'propertyRef':
+            return self.get_property(self.expand(expression.get('key'), properties, depth), properties, depth + 1)
+        if expression.tag == self.BC_NAMESPACE + 'replace':
+            value = self._evaluate(expression[0], properties, depth)
+            for match in expression.findall(self.BC_NAMESPACE + 'match'):
+                if re.search(match.get('pattern'), value):  # the first pattern that matches is used
+                    replacement = re.sub(r'\$(\d)', r'\\g<\1>', match.get('replacement'))  # Java regex group references are $n
+                    return re.sub(match.get('pattern'), replacement, value)
+            return value
+        raise ValueError('unsupported RMap expression <%s>' % (expression.tag.split('}')[-1],))
+
+
+class ComponentResolver(object):
+    """ Interprets the "{<component> ...} [<category> [<version>] | <cquery>]" arguments of the materialize, setup and
+        get-branches-expected commands, using the indexes over COMPONENT_ABBREVIATIONS and COMPONENT_CATEGORIES, and the
+        INVALID_COMPONENTS regular expressions compiled once, so that many specifications can be resolved cheaply (resolve_many).
+        Translations are logged if a logger is provided.
+    """
+
+    def __init__(self, logger=None, log_prefix=''):
+        validate_component_tables()
+        self.logger = logger
+        self.log_prefix = log_prefix
+        self.invalid_components = [(re.compile(component_pattern), re.compile(versions_pattern), error_message)
+                                   for (component_pattern, versions_pattern, error_message) in INVALID_COMPONENTS]
+        self.invalid_components_by_version = {}  # {version: [(compiled component pattern, error message) applicable to the version]}
+
+    def _log(self, message):
+        if self.logger:
+            self.logger.info(self.log_prefix + message)
+
+    def split_arguments(self, arguments):
+        """ Returns (components, category/version/cquery arguments): the component list ends immediately before the first
+            category, version or CQuery (we rely on the fact that no component will ever have the same name as a category name)
+        """
+
+        for index, item in enumerate(arguments):
+            if (item in CATEGORIES_AVAILABLE) or (item in VERSIONS_AVAILABLE) or item.endswith('.cquery'):
+                return (arguments[:index], arguments[index:])
+        return (arguments, [])
+
+    def parse_category_version_cquery(self, arguments_part):
+        """ Processes this part of the arguments: [ [<category> ] [<version>] | <cquery>]
+            Returns (category, version, cquery, template), where category and cquery can be None
+        """
+
+        category_to_use = None
+        version_to_use = 'master'
+        cquery_to_use = None
+        template_to_use = DEFAULT_TEMPLATE
+
+        # interpret any (category / category version / version / cquery) arguments
+        if arguments_part:
+            category_or_version_or_cquery = arguments_part[0]
+            if category_or_version_or_cquery.endswith('.cquery'):
+                cquery_to_use = category_or_version_or_cquery
+                if len(arguments_part) > 1:
+                    raise PewmaException('ERROR: No other options can follow the CQuery')
+                if cquery_to_use in CQUERY_CATEGORIES:
+                    template_to_use = CQUERY_CATEGORIES[cquery_to_use][3]
+            elif category_or_version_or_cquery in CATEGORIES_AVAILABLE:
+                category_to_use = category_or_version_or_cquery
+                if len(arguments_part) > 1:
+                    version = arguments_part[1].lower()
+                    if (category_to_use, version) in CATEGORY_VERSIONS:
+                        version_to_use = CATEGORY_VERSIONS[(category_to_use, version)][1]
+                    else:
+                        raise PewmaException('ERROR: category "%s" does not have a version "%s"' % (category_to_use, version))
+                    if len(arguments_part) > 2:
+                        raise PewmaException('ERROR: unexpected additional parameters found "%s"' % (arguments_part[2:],))
+            elif category_or_version_or_cquery.lower() in VERSIONS_AVAILABLE:
+                version_to_use = VERSIONS_AVAILABLE[category_or_version_or_cquery.lower()][1]
+                if len(arguments_part) > 1:
+                    raise PewmaException('ERROR: unexpected additional parameters found "%s"' % (arguments_part[1:],))
+            else:
+                assert False, 'Internal error in parse_category_version_cquery: "%s"' % (category_or_version_or_cquery,)
+
+        return (category_to_use, version_to_use, cquery_to_use, template_to_use)
+
+    def get_category_version_translation(self, category, version):
+        """ Given a category and version, returns [the CQuery to use, the template version to use, the allowable java versions]
+        """
+
+        assert category and version
+        if (category, version) not in CATEGORY_VERSIONS:
+            raise PewmaException('ERROR: category "%s" does not have a version "%s"' % (category, version))
+        entry = CATEGORY_VERSIONS[(category, version)]
+        assert entry[1] == version
+        return [entry[2], entry[3], entry[5]]
+
+    def check_invalid_components(self, components, version):
+        """ Raises PewmaException if any of the components is not valid in the version
+        """
+
+        if version not in self.invalid_components_by_version:
+            self.invalid_components_by_version[version] = [(component_re, error_message)
+                for (component_re, versions_re, error_message) in self.invalid_components if versions_re.match(version)]
+        applicable = self.invalid_components_by_version[version]
+        for component in components:
+            for (component_re, error_message) in applicable:
+                if component_re.match(component):
+                    raise PewmaException('ERROR: ' + error_message)
+
+    def resolve(self, arguments):
+        """ Processes the arguments: {<component> ...} [<category> [<version>] | <cquery>]
+            Returns (components, category, version, cquery, template, allowable java versions (or None if not known))
+        """
+
+        (components_to_use_raw, category_version_cquery) = self.split_arguments(arguments)
+
+        # interpret any (category / category+version / cquery) arguments
+        (category_to_use, version_to_use, cquery_to_use, template_to_use) = self.parse_category_version_cquery(category_version_cquery)
+
+        self.check_invalid_components(components_to_use_raw, version_to_use)
+
+        # translate any abbreviated component names to the real component name, and make sure they are all in the same category
+        category_implied = set()
+        components_to_use_translated = []
+        for component_to_use in components_to_use_raw:
+            if component_to_use in ABBREVIATIONS_AVAILABLE:
+                abbrev = component_to_use
+                (actual, cat) = ABBREVIATIONS_AVAILABLE[abbrev]
+                if isinstance(actual, basestring):
+                    components_to_use_translated.append(actual)  # replacement is a single item
+                    self._log('Translated "%s" --> component "%s" in category %s' % (abbrev, actual, cat))
+                else:
+                    components_to_use_translated.extend(actual)  # replacement is a tuple of items
+                    self._log('Translated "%s" --> components %s in category %s' % (abbrev, tuple(str(a) for a in actual), cat))
+                category_implied.add(cat)
+            else:
+                # component name is specified verbatim
+                components_to_use_translated.append(component_to_use)
+                if component_to_use.endswith(('-config', '-configs', '-clients')) or component_to_use.startswith(('gda','uk.ac.gda.')):
+                    category_implied.add('gda')  # must be a GDA project
+
+        # dedupe components_to_use_translated (preserves order)
+        components_to_use = []
+        components_seen = set()
+        for c in components_to_use_translated:
+            if c not in components_seen:
+                components_to_use.append(c)
+                components_seen.add(c)
+            else:
+                self._log('Component "%s" appears in materialize list multiple times - duplicates removed' % (c,))
+        if components_to_use_raw != components_to_use:
+            self._log('Component(s) to materialize: %s' % (tuple(str(c) for c in components_to_use),))
+
+        if len(category_implied) > 1:
+            raise PewmaException('ERROR: the %s components you want to materialize %s come from more than 1 category: %s' %
+                                 (len(components_to_use), components_to_use, [c for c in category_implied]))
+
+        category_implied = tuple(category_implied)
+        category_implied = (category_implied and category_implied[0]) or None
+
+        if not category_to_use:
+            category_to_use = category_implied
+        elif category_implied and (category_implied != category_to_use):
+            # if a component abbreviation was provided, it implies a category. If a category was also specified, it must match the implied category
+            raise PewmaException('ERROR: components %s are not consistent with category "%s"' % (components_to_use, category_to_use,))
+
+        if not (category_to_use or cquery_to_use):
+            raise PewmaException('ERROR: the category is missing (can be one of %s)' % ('/'.join(CATEGORIES_AVAILABLE)))
+
+        valid_java_versions = None
+        if category_to_use and version_to_use:
+            (cquery_to_use_translation, template_to_use, valid_java_versions) = self.get_category_version_translation(category_to_use, version_to_use)
+            if not cquery_to_use:
+                cquery_to_use = cquery_to_use_translation
+
+        assert template_to_use and cquery_to_use
+
+        return (components_to_use, category_to_use, version_to_use, cquery_to_use, template_to_use, valid_java_versions)
+
+    def resolve_many(self, specifications):
+        """ Resolves a sequence of argument lists, each as for resolve(), in one call (for job generators)
+            Returns a list of (arguments, result of resolve() or None, error message or None), in the order of the input
+        """
+
+        results = []
+        for arguments in specifications:
+            try:
+                results.append((arguments, self.resolve(arguments), None))
+            except PewmaException as e:
+                results.append((arguments, None, str(e)))
+        return results
+
+
+class GelfQueueHandler(logging.Handler):
+    """ A logging handler that sends records to a Graylog server as GELF messages from a background thread, so that logging
+        never waits for the network. At most max_queued records are held; when the queue is full, the oldest record is dropped.
+        Queued records are sent in batches: over UDP, each message is a zlib-compressed datagram (chunked if it is large);
+        over TCP, a batch is written in a single send, each message terminated by a null byte (as Graylog requires).
+        close() (also called by logging.shutdown on exit) sends the records still queued, waiting at most flush_timeout seconds.
+        sent_count, dropped_count and failed_count record what happened to the records.
+    """
+
+    GELF_CHUNK_MAGIC = b'\x1e\x0f'
+    GELF_CHUNK_DATA_SIZE = 8192 - 12  # so that each datagram, with its 12 byte chunk header, is at most 8192 bytes
+    GELF_MAX_CHUNKS = 128
+    SYSLOG_LEVELS = {logging.CRITICAL: 2, logging.ERROR: 3, logging.WARNING: 4, logging.INFO: 6, logging.DEBUG: 7}
+    RECORD_ATTRIBUTES = frozenset(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | frozenset(('message', 'asctime'))  # everything else is an extra field
+
+    def __init__(self, host, port, protocol='udp', extra_fields=None, max_queued=1000, batch_size=100, flush_timeout=5.0):
+        assert protocol in ('udp', 'tcp')
+        logging.Handler.__init__(self)
+        self.address = (host, port)
+        self.protocol = protocol
+        self.extra_fields = dict(('_' + name, value) for (name, value) in (extra_fields or {}).items())
+        self.max_queued = max_queued
+        self.batch_size = batch_size
+        self.flush_timeout = flush_timeout
+        self.hostname = socket.gethostname()
+        self.sent_count = 0
+        self.dropped_count = 0
+        self.failed_count = 0
+        self.queue = collections.deque()  # encoded GELF messages
+        self.queue_condition = threading.Condition()
+        self.closing = False
+        self.sock = None
+        self.sender_thread = threading.Thread(target=self._send_queued, name='GelfQueueHandler')
+        self.sender_thread.daemon = True
+        self.sender_thread.start()
+
+    def gelf_message(self, record):
+        """ Returns the GELF message for the record, as encoded JSON
+        """
+
+        message = {'version': '1.1',
+                   'host': self.hostname,
+                   'short_message': record.getMessage(),
+                   'full_message': self.format(record),
+                   'timestamp': record.created,
+                   'level': self.SYSLOG_LEVELS.get(record.levelno, 7),
+                   '_logger': record.name,
+                   '_file': record.pathname,
+                   '_line': record.lineno,
+                  }
+        message.update(self.extra_fields)
+        for (name, value) in vars(record).items():
+            if name not in self.RECORD_ATTRIBUTES and not name.startswith('_'):
+                message['_' + name] = value
+        return json.dumps(message, default=str, separators=(',', ':')).encode('utf-8')
+
+    def emit(self, record):
+        try:
+            message = self.gelf_message(record)
+        except Exception:
+            self.handleError(record)
+            return
+        with self.queue_condition:
+            if len(self.queue) >= self.max_queued:
+                self.queue.popleft()
+                self.dropped_count += 1
+            self.queue.append(message)
+            self.queue_condition.notify()
+
+    def _send_queued(self):
+        while True:
+            with self.queue_condition:
+                while not (self.queue or self.closing):
+                    self.queue_condition.wait()
+                if not self.queue:
+                    return  # closing, and everything has been sent
+                batch = [self.queue.popleft() for _ in range(min(self.batch_size, len(self.queue)))]
+            try:
+                self._send_batch(batch)
+                self.sent_count += len(batch)
+            except (socket.error, ValueError):
+                self.failed_count += len(batch)
+                self._close_socket()  # reconnect for the next batch
+
+    def _send_batch(self, batch):
+        if self.protocol == 'tcp':
+            if not self.sock:
+                self.sock = socket.create_connection(self.address, timeout=self.flush_timeout)
+            self.sock.sendall(b''.join(message + b'\0' for message in batch))
+            return
+        if not self.sock:
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        for message in batch:
+            data = zlib.compress(message)
+            if len(data) <= self.GELF_CHUNK_DATA_SIZE:
+                self.sock.sendto(data, self.address)
+                continue
+            chunks = [data[start:start + self.GELF_CHUNK_DATA_SIZE] for start in range(0, len(data), self.GELF_CHUNK_DATA_SIZE)]
+            if len(chunks) > self.GELF_MAX_CHUNKS:
+                raise ValueError('GELF message too large (%s bytes compressed)' % (len(data),))
+            message_id = os.urandom(8)
+            for (sequence, chunk) in enumerate(chunks):
+                self.sock.sendto(self.GELF_CHUNK_MAGIC + message_id + bytes(bytearray((sequence, len(chunks)))) + chunk, self.address)
+
+    def _close_socket(self):
+        if self.sock:
+            try:
+                self.sock.close()
+            except socket.error:
+                pass
+            self.sock = None
+
+    def close(self):
+        """ Sends the records still queued (waiting at most flush_timeout seconds), then closes the handler
+            Records that could not be sent in time are counted as dropped
+        """
+
+        with self.queue_condition:
+            self.closing = True
+            self.queue_condition.notify()
+        self.sender_thread.join(self.flush_timeout)
+        with self.queue_condition:
+            self.dropped_count += len(self.queue)
+            self.queue.clear()
+        if not self.sender_thread.is_alive():
+            self._close_socket()
+        logging.Handler.close(self)
+
 
 class PewmaException(Exception):
     """ Exception class to handle case when the setup does not support the requested operation. """
@@ -313,6 +2283,15 @@ class PewmaManager(object):
         self.java_version_current = None
         self.valid_java_versions = None
         self.executable_locations = {}
+        self.gerrit_commit_hook_lock = threading.Lock()
+        self.auto_tune_settings = None
+        self.auto_tune_profile_lock = threading.Lock()
+        self.snapshot_key = None  # set if the materialize is to be saved as a snapshot
+        self.snapshot_head_commits = None
+        self.snapshot_restored = False
+        self.metrics = []  # a record for each timed phase of the action, written to the metrics file when the action ends
+        self.metrics_lock = threading.Lock()
+        self.child_peak_rss = []  # (start time, peak RSS in MB) of each Buckminster or ant process run, so far
 
         # when running at DLS, we might want to set the Linux group to "dls_dasc" on directories that we create
         self.group_dls_dasc_gid = None  # the numeric group id for group dls_dasc
@@ -357,6 +2336,31 @@ class PewmaManager(object):
                 ('get-branches-expected <component> [<category> [<version>] | <cquery>]',
                  'Determine the CQuery to use, and return from it a list of repositories and branches',
                  )),
+            ('resolve-components', None, False,
+                ('resolve-components [<file>]',
+                 'Resolve many "<component> ... [<category> [<version>] | <cquery>]" specifications (one per line, from the file or standard input)',
+                 'to the components, category, version, CQuery and template to use, written as one JSON object per line',
+                 )),
+            ('preclone', None, True,
+                ('preclone [<category> [<version>] | <cquery>]',
+                 'Clone the git repositories used by the CQuery (that are not already cloned), using native git, several at a time',
+                 '(the same as "materialize --preclone", but without running Buckminster)',
+                 )),
+            ('reap', None, False,
+                ('reap [<directory> ...]',
+                 'Finish deleting the .trash-* directories that --delete, --recreate and --tp-recreate leave to be deleted in the background',
+                 'Each directory is a trash directory or contains them (default: the workspace directory and its parent)',
+                 )),
+            ('snapshot', None, False,
+                ('snapshot {save|restore} <component> [<category> [<version>] | <cquery>]',
+                 'Save a snapshot of the materialized workspace and workspace_git, or restore one into a new workspace',
+                 'Snapshots are keyed by the components, CQuery, template, and the HEAD commits of the branches the CQuery uses',
+                 )),
+            ('snapshot', None, False, ('snapshot list', 'List the saved snapshots, most recently used first',)),
+            ('mirror-gc', None, False,
+                ('mirror-gc',
+                 'Repack the git mirrors in --git-mirror-cache (waits for any pre-clones using them to finish)',
+                 )),
             ('gerrit-config', None, False, ('gerrit-config', 'Switch applicable repositories to origin Gerrit and configure for Eclipse',)),
             ('git', None, True, ('git <command>', 'Issue "git <command>" for all git clones (escape any quotes in the command with a \\)',)),
             ('clean', None, True, ('clean', 'Clean the workspace',)),
@@ -387,6 +2391,30 @@ class PewmaManager(object):
                 ('product.zip <site> [ <platform> ... ]',
                  'Build the workspace and an Eclipse product, then zip the product',
                 )),
+            ('pipeline', None, True,
+                ('pipeline <stage>,<stage>... [<stage arguments>] [+ <stage arguments>]',
+                 'Run the stages (materialize, build/buildthorough/buildinc, product/product.zip, in that order) in a single Buckminster process',
+                 'Arguments are as for the separate actions; separate the materialize arguments from the product arguments with a +',
+                 'e.g. pipeline materialize,build,product gda-server gda master + uk.ac.diamond.daq.server.site',
+                )),
+            ('stats', None, False,
+                ('stats [<action> ...]',
+                 'Summarise the timings of earlier runs recorded in the metrics file (for all actions, or just those specified)',
+                )),
+            ('scan-log', None, False,
+                ('scan-log <file> ...',
+                 'Scan saved Buckminster output for known errors, and report the scan rate (a benchmark of the output scanner)',
+                )),
+            ('template-benchmark', None, False,
+                ('template-benchmark [<template version> [<iterations>]]',
+                 'Time creating a workspace from the template by unzipping, and by copying the extracted template in the download cache',
+                 'Template version defaults to %s' % (DEFAULT_TEMPLATE,),
+                )),
+            ('startup-benchmark', None, False,
+                ('startup-benchmark [<runs> [<threshold ms>]]',
+                 'Time how long pewma takes to start and run print-workspace-path, compared with starting Python alone',
+                 'Fails if the median difference exceeds the threshold (default %s ms)' % (STARTUP_BENCHMARK_THRESHOLD_MS,),
+                )),
             ('tests-clean', self._iterate_ant, False, ('tests-clean', 'Delete test output and results files from JUnit/JyUnit tests',)),
             ('junit-tests', self._iterate_ant, True, ('junit-tests', 'Run Java JUnit tests for all (or selected) projects',)),
             ('jyunit-tests', self._iterate_ant, True, ('jyunit-tests', 'Runs JyUnit tests for all (or selected) projects',)),
@@ -394,6 +2422,16 @@ class PewmaManager(object):
             ('corba-make-jar', self._iterate_ant, False, ('corba-make-jar', '(Re)generate the corba .jar(s) in all or selected projects',)),
             ('corba-validate-jar', self._iterate_ant, False, ('corba-validate-jar', 'Check that the corba .jar(s) in all or selected plugins match the source',)),
             ('corba-clean', self._iterate_ant, False, ('corba-clean', 'Remove temporary files from workspace left over from corba-make-jar',)),
+            ('graph', None, False,
+                ('graph [dot|json|batches] [<file>]',
+                 'Report the dependencies between the projects in workspace_git (from MANIFEST.MF, feature.xml and .project), and any cycles',
+                 'Optionally write the graph as DOT or JSON, or the batches of projects that can be built in parallel, in order',
+                 )),
+            ('xvfb-pool', None, False,
+                ('xvfb-pool {start [<count>]|stop|status}',
+                 'Start (or stop) a pool of Xvfb servers that test runs with --xvfb-pool use, rather than each starting its own',
+                 'Displays are claimed with lock files in /tmp, so concurrent test runs on a machine never share a display (Linux only)',
+                 )),
             ('dummy', self._iterate_ant, False, ()),
             ('developer-test', None, False, ()),
             )
@@ -402,7 +2440,7 @@ class PewmaManager(object):
 
     def setup_standard_logging(self):
         # create logger with console handler, and formatter to match
-        self.logger = logging.getLogger(__name__)
+        self.logger = logging.getLogger(LOGGER_NAME)
         self.logger.setLevel(1)
         console_formatter = logging.Formatter("%(asctime)s - %(levelname)s - %(message)s", "%Y-%m-%d %H:%M:%S")
         self.logging_console_handler = logging.StreamHandler()
@@ -412,30 +2450,24 @@ class PewmaManager(object):
     def setup_graylog_logging(self):
         # create logger with Graylog handler, and formatter to match
         # we use a separate logger, rather than an additional handler on the standard logger
+        # the records are sent by a background thread, so logging never waits for the network
         if self.options.no_graylog:
             return False  # command line option said not to write to Graylog
-        if not socket.getfqdn().endswith('.diamond.ac.uk'):
+        (host, port) = self.options.graylog_server.rsplit(':', 1)
+        if (host == GRAYLOG_SERVER) and not socket.getfqdn().endswith('.diamond.ac.uk'):
             return False  # not at Diamond Light Source
-        try:
-            from pkg_resources import require
-            require('pygelf')
-            from pygelf import GelfUdpHandler
-        except:
-            return False  # pygelf not installed in the version of Python we are running
 
-        self.logger_graylog = logging.getLogger(__name__ + '-graylog')
+        self.logger_graylog = logging.getLogger(LOGGER_NAME + '-graylog')
         self.logger_graylog.setLevel(1)
         graylog_formatter = logging.Formatter("%(asctime)s - %(levelname)s - %(message)s", "%Y-%m-%d %H:%M:%S")
         action_index = sys.argv.index(self.action)
-        self.logging_graylog_handler = GelfUdpHandler(
-            host = GRAYLOG_SERVER,
-            port = GRAYLOG_PORT,
-            _application_name = 'pewma',
-            _username = getpass.getuser(),
-            _workspace_loc = self.workspace_loc,
-            _pewma_options = ' '.join(sys.argv[1:action_index]),
-            _pewma_action = '%s %s' % (self.action, ' '.join(self.arguments)),
-            include_extra_fields = True)
+        self.logging_graylog_handler = GelfQueueHandler(host, int(port), protocol=self.options.graylog_protocol,
+            extra_fields = {'application_name': 'pewma',
+                            'username': getpass.getuser(),
+                            'workspace_loc': self.workspace_loc,
+                            'pewma_options': ' '.join(sys.argv[1:action_index]),
+                            'pewma_action': '%s %s' % (self.action, ' '.join(self.arguments)),
+                           })
         self.logging_graylog_handler.setFormatter(graylog_formatter)
         self.logger_graylog.addHandler(self.logging_graylog_handler)
         self.logger.debug('Performance data will be logged to Graylog')
@@ -528,6 +2560,9 @@ class PewmaManager(object):
                                help='First completely delete current workspace/, but keep any workspace_git/')
         group.add_option('--tp-recreate', dest='tp_recreate', action='store_true', default=False,
                                help='First completely delete current tp/, but keep everything else')
+        group.add_option('--foreground-delete', dest='foreground_delete', action='store_true', default=False,
+                               help='With --delete, --recreate or --tp-recreate, delete before continuing, rather than renaming the directories '
+                                    'aside and deleting them in the background')
         self.parser.add_option_group(group)
 
         group = optparse.OptionGroup(self.parser, "Materialize options")
@@ -538,12 +2573,47 @@ class PewmaManager(object):
             group.add_option('--directories.groupname', dest='directories_groupname', type='string', metavar='<groupname>',
                              default='dls_dasc' if self.group_dls_dasc_gid else None,
                              help='Linux group to set on directories that are created (default: %default)')
+            group.add_option('--directories.recursive', dest='directories_recursive', action='store_true', default=False,
+                             help='After setup or materialize, also apply --directories.groupname (and group write and setgid permissions) '
+                                  'to everything in workspace/ and workspace_git/ that you own (only entries that differ are changed)')
+        group.add_option('--download-cache', dest='download_cache', type='string', metavar='<dir>',
+                         default=os.path.join('~', '.pewma', 'download_cache'),
+                         help='Directory to cache downloaded (and extracted) templates and CQueries in, shared between workspaces (default: %default)')
+        group.add_option('--no-download-cache', dest='no_download_cache', action='store_true', default=False,
+                         help='Always download templates and CQueries, without using the download cache')
+        group.add_option('--download-cache-size', dest='download_cache_size', type='int', metavar='<MB>', default=512,
+                         help='Maximum size of the download cache in MB (default: %default)')
+        group.add_option('--snapshots', dest='snapshots', action='store_true', default=False,
+                         help='With materialize into a new workspace, restore a snapshot of an identical earlier materialize instead of running Buckminster '
+                              '(if there is one), otherwise save a snapshot afterwards')
+        group.add_option('--snapshot-dir', dest='snapshot_dir', type='string', metavar='<dir>',
+                         default=os.path.join('~', '.pewma', 'snapshots'),
+                         help='Directory to keep workspace snapshots in (default: %default)')
+        group.add_option('--snapshot-size', dest='snapshot_size', type='int', metavar='<MB>', default=20480,
+                         help='Maximum size of the stored workspace snapshots in MB (default: %default)')
+        group.add_option('--offline', dest='offline', action='store_true', default=False,
+                         help='Use templates and CQueries from the download cache, without contacting the server')
+        group.add_option('--preclone', dest='preclone', action='store_true', default=False,
+                         help='Before materializing, clone any missing git repositories used by the CQuery with native git, several at a time (see --jobs)')
+        group.add_option('--git-mirror-cache', dest='git_mirror_cache', type='string', metavar='<dir>', default=None,
+                         help='Local directory of bare mirrors of Gerrit repositories, kept up to date and borrowed from by pre-clones (workspaces then depend on it, so do not delete it)')
+        group.add_option('--preclone-retries', dest='preclone_retries', type='int', metavar='<value>', default=2,
+                         help='Number of times to retry a pre-clone that fails with a network or server error (default: %default)')
+        group.add_option('--retry-transient', dest='retry_transient', type='int', metavar='<value>', default=0,
+                         help='Number of times to rerun a materialize that fails only because of network errors cloning named repositories or '
+                              'intermittent Buckminster bugs, after deleting the partial clones (default: %default)')
         group.add_option('-l', '--location', dest='download_location', choices=('diamond', 'public'), metavar='<location>',
                          help='Download location ("diamond" or "public")')
         group.add_option('--maxParallelMaterializations', dest='maxParallelMaterializations', type='int', metavar='<value>',
                          help='Override Buckminster default')
         group.add_option('--maxParallelResolutions', dest='maxParallelResolutions', type='int', metavar='<value>',
                          help='Override Buckminster default')
+        group.add_option('--auto-tune', dest='auto_tune', action='store_true', default=False,
+                         help='Choose the Buckminster heap size and materialization parallelism from the memory and CPUs available '
+                              '(honouring container limits), refined by the wall time and peak memory recorded for earlier runs on this host')
+        group.add_option('--auto-tune-profile-dir', dest='auto_tune_profile_dir', type='string', metavar='<dir>',
+                         default=os.path.join('~', '.pewma', 'auto_tune'),
+                         help='Directory to keep the per-host --auto-tune profiles in (default: %default)')
         group.add_option('--prepare-jenkins-build-description-on-error',
                          dest='prepare_jenkins_build_description_on_error', action='store_true', default=False,
                          help=optparse.SUPPRESS_HELP)
@@ -568,6 +2638,11 @@ class PewmaManager(object):
                          help='Properties file, relative to site project if not absolute (default: filenames looked for in order: buckminster.properties, buckminster.beamline.properties)')
         group.add_option('--buckminster.root.prefix', dest='buckminster_root_prefix', type='string', metavar='<path>',
                          help='Prefix for buckminster.output.root and buckminster.temp.root properties')
+        group.add_option('--force', dest='force', action='store_true', default=False,
+                         help='With buildinc, build even if nothing has changed since the last successful build')
+        group.add_option('--parallel-platforms', dest='parallel_platforms', action='store_true', default=False,
+                         help='With "product" for several platforms, build the workspace once, then export each platform in its own concurrent '
+                              'Buckminster process (with its own copy of the workspace .metadata, and its own buckminster.root.prefix), and merge the output')
         self.parser.add_option_group(group)
 
         group = optparse.OptionGroup(self.parser, "Test/Corba options")
@@ -578,6 +2653,14 @@ class PewmaManager(object):
         default_GDALargeTestFilesLocation = '/dls_sw/dasc/GDALargeTestFiles/'  # location at Diamond
         if not os.path.isdir(default_GDALargeTestFilesLocation):
             default_GDALargeTestFilesLocation=""
+        group.add_option('--affected-since', dest='affected_since', type='string', metavar='<ref>',
+                         help='Only test the projects affected by changes since the git ref (in each repository): the changed projects, and the bundles that depend on them')
+        group.add_option('--affected-repositories', dest='affected_repositories', action='append', metavar='<repository>,<repository>,...', default=[],
+                         help='Only test the projects affected by changes to the repositories (e.g. gda-core.git), as for --affected-since')
+        group.add_option('--test-jobs', dest='test_jobs', type='int', metavar='<N>', default=1,
+                         help='Run the tests in N ant processes at once, with the projects split between them by previous test duration (default: %default)')
+        group.add_option('--xvfb-pool', dest='xvfb_pool', action='store_true', default=False,
+                         help='Run the tests on a free Xvfb server from the pool (see "xvfb-pool start"), if there is one')
         group.add_option("--GDALargeTestFilesLocation", dest="GDALargeTestFilesLocation", type="string", metavar=" ", default=default_GDALargeTestFilesLocation,
                          help="Default: %default")
         self.parser.add_option_group(group)
@@ -605,6 +2688,21 @@ class PewmaManager(object):
         group.add_option('--debug-options-file', dest='debug_options_file', type='string', metavar='<path>',
                                help='File containing debug options for Buckminster')
         group.add_option('-g', '--no-graylog', dest='no_graylog', action='store_true', default=False, help='Never log to DLS Graylog, even if available')
+        group.add_option('--graylog-server', dest='graylog_server', type='string', metavar='<host>:<port>',
+                               default='%s:%s' % (GRAYLOG_SERVER, GRAYLOG_PORT),
+                               help='Graylog GELF input to log to (default: %default, which is only used at DLS)')
+        group.add_option('--graylog-protocol', dest='graylog_protocol', type='choice', choices=['udp', 'tcp'], metavar='<protocol>',
+                               default='udp', help='Protocol of the Graylog GELF input, udp or tcp (default: %default)')
+        group.add_option('--metrics-file', dest='metrics_file', type='string', metavar='<path>',
+                               default=os.path.join('~', '.pewma', 'metrics.jsonl'),
+                               help='File to append the timings of each phase of the action to, one JSON record per line (default: %%default; '
+                                    'kept below %s MB by renaming it to <file>.1; quick queries such as print-workspace-path are not recorded)' %
+                                    (METRICS_FILE_MAX_BYTES // (1024 * 1024),))
+        group.add_option('--no-metrics', dest='no_metrics', action='store_true', default=False, help='Don\'t write the metrics file')
+        group.add_option('--profile-startup', dest='profile_startup', action='store_true', default=False,
+                               help='Report the time taken to import modules, initialise and process the options, before the action is run')
+        group.add_option('--prometheus-textfile', dest='prometheus_textfile', type='string', metavar='<path>',
+                               help='Also write the timings of this run as Prometheus metrics, for the node_exporter textfile collector')
         self.parser.add_option_group(group)
 
         group = optparse.OptionGroup(self.parser, "Git options (when using the git subcommand)")
@@ -617,21 +2715,27 @@ class PewmaManager(object):
                                help='Do not process repository names matching any of the glob patterns')
         group.add_option('--max-git-output', dest='max_git_output', type='int', metavar='<value>', default=30000,
                                help='Maximum characters git output per repository (0=unlimited)')
+        group.add_option('-j', '--jobs', dest='git_jobs', type='int', metavar='<value>', default=None,
+                               help='Number of things to process concurrently: repositories for git and gerrit-config (default: 1), '
+                                    'repositories for preclone, --affected-since/--affected-repositories and the build fingerprint of buildinc, and branch heads and files for --snapshots (default: %s); '
+                                    'directories for reap (default: %s); projects for graph (default: %s); top-level entries for --directories.recursive (default: %s)' %
+                                    (REPOSITORY_JOBS, REAP_JOBS, GRAPH_JOBS, SET_GROUP_JOBS))
+        group.add_option('--verify', dest='verify', action='store_true', default=False,
+                               help='With gerrit-config, only check that repositories are configured (do not change anything)')
         self.parser.add_option_group(group)
 
 
     def setup_workspace(self):
+        with self.timed_phase('setup-workspace') as phase:
+            phase['rc'] = self._setup_workspace() or 0
+        return phase['rc']
+
+    def _setup_workspace(self):
         # create the workspace if it doesn't exist, initialise the workspace if it is not set up
         # note: only applies to workspace, not workspace_git
 
-        if self.options.delete or self.options.recreate:
-            assert self.action in ('setup', 'materialize')
-            self.delete_directory(self.workspace_loc, "workspace directory")
-            if self.options.delete:
-                self.delete_directory(self.workspace_git_loc, "workspace_git directory")
-        elif self.options.tp_recreate:
-            assert self.action == 'materialize'
-            self.delete_directory(os.path.join(self.workspace_loc, "tp"), "tp directory")
+        self.delete_workspace_as_requested()
+        self.forget_build_fingerprint()  # e.g. a materialize can import more projects, or recreate the target platform
 
         need_to_create_workspace = True
         if os.path.isdir(self.workspace_loc):
@@ -665,15 +2769,17 @@ class PewmaManager(object):
                 self._set_linux_group(self.workspace_git_loc)
 
         if need_to_create_workspace or (not tp_exists):
-            template_zip = os.path.join( self.workspace_loc, self.template_name )
-            self.download_workspace_template(self._get_full_uri('templates/' + self.template_name), template_zip)
-            if need_to_create_workspace:
-                self.unzip_workspace_template(template_zip, None, self.workspace_loc)
+            member_prefix = None if need_to_create_workspace else 'tp/'
+            if (not self.options.dry_run) and self.get_download_cache():
+                # copy from the extracted template in the download cache, rather than unzipping the template every time
+                self.clone_workspace_template(self._get_full_uri('templates/' + self.template_name), member_prefix, self.workspace_loc)
             else:
-                self.unzip_workspace_template(template_zip, 'tp/', self.workspace_loc)
-            self.logger.info('%sDeleting "%s"' % (self.log_prefix, template_zip,))
-            if not self.options.dry_run:
-                os.remove(template_zip)
+                template_zip = os.path.join( self.workspace_loc, self.template_name )
+                self.download_workspace_template(self._get_full_uri('templates/' + self.template_name), template_zip)
+                self.unzip_workspace_template(template_zip, member_prefix, self.workspace_loc)
+                self.logger.info('%sDeleting "%s"' % (self.log_prefix, template_zip,))
+                if not self.options.dry_run:
+                    os.remove(template_zip)
 
 
     def add_cquery_to_history(self, cquery_to_use):
@@ -802,6 +2908,21 @@ class PewmaManager(object):
                              (self.log_prefix, org_eclipse_core_variables_prefs_loc, variable_name, variable_value, variable_description))
 
 
+    def delete_workspace_as_requested(self):
+        """ Deletes the workspace, workspace_git or tp directories, as requested by --delete, --recreate or --tp-recreate
+            (does nothing if they have already been deleted)
+        """
+
+        if self.options.delete or self.options.recreate:
+            assert self.action in ('setup', 'materialize', 'pipeline')
+            self.delete_directory(self.workspace_loc, "workspace directory")
+            if self.options.delete:
+                self.delete_directory(self.workspace_git_loc, "workspace_git directory")
+        elif self.options.tp_recreate:
+            assert self.action in ('materialize', 'pipeline')
+            self.delete_directory(os.path.join(self.workspace_loc, "tp"), "tp directory")
+
+
     def delete_directory(self, directory, description):
         if directory and os.path.isdir(directory):
             if self.options.answer_no:
@@ -820,6 +2941,17 @@ class PewmaManager(object):
             self.logger.info('%sDeleting %s "%s"' % (self.log_prefix, description, directory,))
             if self.options.dry_run:
                 return
+            if self.isLinux and not self.options.foreground_delete:
+                # rename the directory out of the way (which is atomic and immediate), and delete it in a background process
+                trash_path = os.path.join(os.path.dirname(directory), '%s%s.%s.%s' %
+                                          (TRASH_DIRECTORY_PREFIX, time.strftime('%Y%m%d%H%M%S'), os.getpid(), os.path.basename(directory)))
+                try:
+                    os.rename(directory, trash_path)
+                except OSError as e:
+                    self.logger.warn('%sCould not rename "%s" to "%s" (%s), so deleting it now' % (self.log_prefix, directory, trash_path, e))
+                else:
+                    self.start_background_reap(trash_path)
+                    return
             # shutil.rmtree(directory)  # does not work under Windows if there are read-only files in the directory, such as.svn\all-wcprops
             if self.isLinux:
                 retcode = subprocess.call(('rm', '-rf', directory), shell=False)
@@ -832,43 +2964,318 @@ class PewmaManager(object):
                 raise PewmaException('Error deleting directory "%s". Abandoning.' % (directory,))
 
 
-    def download_workspace_template(self, source, destination):
-        if self.options.dry_run:
-            self.logger.info('%sDownloading "%s" to "%s"' % (self.log_prefix, source, destination))
-            return
+    def start_background_reap(self, trash_path):
+        """ Starts a detached, low-priority pewma process to reap a trash directory
+            If it is interrupted, the reap command finishes the job
+        """
+
+        def detach():
+            os.setsid()
+            os.nice(10)
+
+        command = (sys.executable, PEWMA_SCRIPT, '--no-metrics', '--no-graylog', '-w', self.workspace_loc, 'reap', trash_path)
+        self.logger.debug('%sStarting background reap: %s' % (self.log_prefix, ' '.join(command)))
+        with open(os.devnull, 'r+') as devnull:
+            subprocess.Popen(command, stdin=devnull, stdout=devnull, stderr=devnull, close_fds=True, preexec_fn=detach)
+
+
+    def action_reap(self):
+        """ Processes command: reap [<directory> ...]
+            Deletes trash directories (left by --delete, --recreate and --tp-recreate, which rename a directory to
+            .trash-<timestamp>... and delete it in the background) that an interrupted run did not finish deleting.
+            Each directory is either a trash directory, or a directory containing trash directories.
+            Defaults to the workspace directory and its parent (which contains the workspace_git directory).
+        """
+
+        directories = self.arguments or (os.path.dirname(self.workspace_loc), self.workspace_loc)
+        trash_paths = []
+        for directory in directories:
+            directory = os.path.abspath(os.path.expanduser(directory))
+            if os.path.basename(directory).startswith(TRASH_DIRECTORY_PREFIX):
+                trash_paths.append(directory)
+            elif os.path.isdir(directory):
+                (dirs, _) = list_directory(directory)
+                trash_paths.extend(os.path.join(directory, d) for d in sorted(dirs) if d.startswith(TRASH_DIRECTORY_PREFIX))
+            elif self.arguments:
+                raise PewmaException('ERROR: "%s" is not a directory' % (directory,))
+        if not trash_paths:
+            self.logger.info('%sNo trash to reap' % (self.log_prefix,))
+            return
+
+        jobs = self.options.git_jobs or REAP_JOBS
+        rc = 0
+        for trash_path in trash_paths:
+            self.logger.info('%sReaping "%s"' % (self.log_prefix, trash_path))
+            if self.options.dry_run:
+                continue
+            start_time = time.time()
+            try:
+                (files_deleted, directories_deleted) = reap_tree(trash_path, jobs)
+            except OSError as e:
+                self.logger.error('%sCould not reap "%s": %s' % (self.log_prefix, trash_path, e))
+                rc = 1
+                continue
+            self.logger.info('%sReaped "%s" (%s files, %s directories) in %.1f seconds' %
+                             (self.log_prefix, trash_path, files_deleted, directories_deleted, time.time() - start_time))
+        return rc
+
+
+    def get_workspace_snapshots(self):
+        """ Returns the WorkspaceSnapshots store
+        """
+
+        if not hasattr(self, 'workspace_snapshots'):
+            self.workspace_snapshots = WorkspaceSnapshots(os.path.abspath(os.path.expanduser(self.options.snapshot_dir)),
+                                                          self.options.snapshot_size * 1024 * 1024, self.logger)
+        return self.workspace_snapshots
+
+
+    def get_branch_head_commits(self, cquery_to_use):
+        """ Returns a sorted list of (repository name, branch, commit) for the branches (on the remote) of the git repositories
+            that a CQuery uses, or None if any could not be determined
+        """
+        repositories = self.get_cquery_git_repositories(cquery_to_use)
+
+        def get_head_commit(repo):
+            (repo_name, branch, url) = repo
+            (out, retcode) = self._run_native_git(('git', 'ls-remote', url, 'refs/heads/' + branch))
+            if retcode or not out.strip():
+                self.logger.warn('%sCould not determine the HEAD of %s branch %s: %s' % (self.log_prefix, repo_name, branch, out or 'no such branch'))
+                return None
+            return out.split()[0]
+
+        commits = map_concurrently(get_head_commit, repositories, self.options.git_jobs or REPOSITORY_JOBS)
+        if None in commits:
+            return None
+        return [(repo_name, branch, commit) for ((repo_name, branch, _), commit) in zip(repositories, commits)]
+
+
+    def get_snapshot_key(self, components_to_use, cquery_to_use, template_to_use, head_commits):
+        """ Returns the key of the snapshot of a materialize: a digest of everything that determines the materialized workspace
+            (the workspace location is included, since Eclipse records absolute paths in the workspace metadata)
+        """
+
+        lines = ['format=%s' % (SNAPSHOT_FORMAT,),
+                 'cquery=%s' % (cquery_to_use,),
+                 'template=%s' % (template_to_use,),
+                 'components=%s' % (','.join(components_to_use),),
+                 'properties=%s' % (','.join(sorted(self.options.system_property)),),
+                 'workspace=%s' % (self.workspace_loc,),
+                ]
+        # the same format as materialized_head_commits.txt written by the Jenkins jobs
+        lines.extend('repository=%s***HEAD=%s***BRANCH=%s***' % head_commit for head_commit in head_commits)
+        return hashlib.sha256('\n'.join(lines).encode('utf-8')).hexdigest()
+
+
+    def _get_snapshot_roots(self):
+        return [('workspace', self.workspace_loc), ('workspace_git', self.workspace_git_loc)]
+
+
+    def restore_materialize_snapshot(self, components_to_use, cquery_to_use, template_to_use):
+        """ If the workspace is new, and there is a snapshot of an identical materialize, restores it
+            Otherwise, if the workspace is new, sets self.snapshot_key so that the materialize is saved as a snapshot afterwards
+            Returns True if a snapshot was restored
+        """
+
+        if os.path.exists(self.workspace_loc) or os.path.exists(self.workspace_git_loc):
+            self.logger.info('%sNot using snapshots, since the workspace or workspace_git directory already exists' % (self.log_prefix,))
+            return False
+        if self.options.dry_run:
+            self.logger.info('%sLooking for a snapshot of the materialize in "%s"' % (self.log_prefix, self.options.snapshot_dir))
+            return False
+        head_commits = self.get_branch_head_commits(cquery_to_use)
+        if not head_commits:
+            self.logger.warn('%sNot using snapshots, since the branch HEAD commits are not known' % (self.log_prefix,))
+            return False
+        self.snapshot_head_commits = head_commits
+        self.snapshot_key = self.get_snapshot_key(components_to_use, cquery_to_use, template_to_use, head_commits)
+
+        with self.timed_phase('snapshot-restore') as phase:
+            start_time = time.time()
+            try:
+                info = self.get_workspace_snapshots().restore(self.snapshot_key, self._get_snapshot_roots(), self.options.git_jobs or REPOSITORY_JOBS)
+            except (IOError, OSError, ValueError, zlib.error) as e:
+                self.logger.warn('%sCould not restore snapshot %s: %s' % (self.log_prefix, self.snapshot_key, e))
+                for (_, root) in self._get_snapshot_roots():
+                    if os.path.isdir(root):
+                        remove_tree(root)
+                return False
+            phase['rc'] = 0
+        if not info:
+            self.logger.info('%sNo snapshot %s of this materialize yet' % (self.log_prefix, self.snapshot_key))
+            return False
+
+        self.snapshot_key = None  # no need to save it again
+        self.snapshot_restored = True
+        self.logger.info('%sRestored snapshot %s (saved %s) in %s, instead of materializing' %
+                         (self.log_prefix, info['key'], info['saved'], datetime.timedelta(seconds=int(time.time() - start_time))))
+        for (_, root) in self._get_snapshot_roots():
+            self._set_linux_group(root)
+        return True
+
+
+    def save_materialize_snapshot(self, components_to_use, cquery_to_use):
+        """ Saves a snapshot of the workspace just materialized, provided that the repositories cloned are at the HEAD commits
+            the snapshot key was calculated from (a branch may have moved on during the materialize)
+            Returns True if the snapshot was saved
+        """
+
+        for (repo_name, branch, commit) in self.snapshot_head_commits:
+            git_dir = os.path.join(self.workspace_git_loc, repo_name, '.git')
+            if not os.path.isdir(git_dir):
+                continue  # not needed by the components materialized
+            (out, retcode) = self._run_native_git(('git', '--git-dir', git_dir, 'rev-parse', '--verify', 'HEAD'))
+            if retcode or (out.strip() != commit):
+                self.logger.warn('%sNot saving a snapshot, since %s is not at the HEAD of branch %s (%s)' % (self.log_prefix, repo_name, branch, commit))
+                return False
+
+        self.logger.info('%sSaving snapshot %s in "%s"' % (self.log_prefix, self.snapshot_key, self.options.snapshot_dir))
+        info = {'key': self.snapshot_key,
+                'saved': time.strftime('%Y-%m-%d %H:%M:%S'),
+                'cquery': cquery_to_use,
+                'components': components_to_use,
+                'workspace': self.workspace_loc,
+               }
+        with self.timed_phase('snapshot-save') as phase:
+            start_time = time.time()
+            try:
+                (files, total_bytes) = self.get_workspace_snapshots().save(self.snapshot_key, self._get_snapshot_roots(), info, self.options.git_jobs or REPOSITORY_JOBS)
+            except (IOError, OSError) as e:
+                self.logger.warn('%sCould not save snapshot %s: %s' % (self.log_prefix, self.snapshot_key, e))
+                return False
+            phase['rc'] = 0
+        self.logger.info('%sSaved snapshot %s (%s files, %s bytes) in %s' % (self.log_prefix, self.snapshot_key, files,
+                         '{0:,d}'.format(total_bytes), datetime.timedelta(seconds=int(time.time() - start_time))))
+        return True
+
+
+    def action_snapshot(self):
+        """ Processes command: snapshot {save|restore} <component> [<category> [<version>] | <cquery>]
+                           or: snapshot list
+        """
+
+        if (not self.arguments) or (self.arguments[0] not in ('save', 'restore', 'list')):
+            raise PewmaException('ERROR: snapshot command must be followed by save, restore or list')
+        subcommand = self.arguments[0]
+        self.arguments = self.arguments[1:]
+
+        if subcommand == 'list':
+            if self.arguments:
+                raise PewmaException('ERROR: snapshot list command does not take any arguments')
+            for (last_used, key, info) in self.get_workspace_snapshots().list_snapshots():
+                print('%s  last used %s  saved %s  %s %s  (%s)' % (key, time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(last_used)), info['saved'],
+                      ' '.join(info['components']), info['cquery'], info['workspace']))
+            return
+
+        (components_to_use, category_to_use, version_to_use, cquery_to_use, template_to_use) = self._interpret_components_category_version_cquery()
+        if not components_to_use:
+            raise PewmaException('ERROR: snapshot %s command requires the name of the component materialized' % (subcommand,))
+
+        if subcommand == 'restore':
+            if os.path.exists(self.workspace_loc) or os.path.exists(self.workspace_git_loc):
+                raise PewmaException('ERROR: snapshot restore requires that the workspace and workspace_git directories do not exist')
+            if not self.restore_materialize_snapshot(components_to_use, cquery_to_use, template_to_use):
+                return 1
+            return
+
+        if not (os.path.isdir(os.path.join(self.workspace_loc, '.metadata')) and os.path.isdir(self.workspace_git_loc)):
+            raise PewmaException('ERROR: snapshot save requires a materialized workspace')
+        if self.options.dry_run:
+            self.logger.info('%sSaving snapshot in "%s"' % (self.log_prefix, self.options.snapshot_dir))
+            return
+        self.snapshot_head_commits = self.get_branch_head_commits(cquery_to_use)
+        if not self.snapshot_head_commits:
+            raise PewmaException('ERROR: could not determine the HEAD commits of the branches, so cannot save a snapshot')
+        self.snapshot_key = self.get_snapshot_key(components_to_use, cquery_to_use, template_to_use, self.snapshot_head_commits)
+        if not self.save_materialize_snapshot(components_to_use, cquery_to_use):
+            return 1
+
+
+    def get_download_cache(self):
+        """ Returns the DownloadCache to use, or None if the cache is not to be used
+        """
+
+        if not hasattr(self, 'download_cache'):
+            self.download_cache = None
+            if not self.options.no_download_cache:
+                cache_dir = os.path.abspath(os.path.expanduser(self.options.download_cache))
+                try:
+                    self.download_cache = DownloadCache(cache_dir, self.options.download_cache_size * 1024 * 1024, self.logger)
+                except (IOError, OSError) as e:
+                    self.logger.warn('%sDownload cache "%s" not available: %s' % (self.log_prefix, cache_dir, e))
+        return self.download_cache
+
+
+    def download_url(self, source, description, error_description):
+        """ Returns the contents of a (small) file downloaded from source, using the download cache if available
+            description and error_description are used in the Jenkins build description and the exception message on error
+        """
+
+        with self.timed_phase('download', detail=description) as phase:
+            data = self._download_url(source, description, error_description)
+            phase['rc'] = 0
+        return data
 
-        # open the URL
+    def _download_url(self, source, description, error_description):
+        import urllib2
+        download_cache = self.get_download_cache()
         try:
+            if download_cache:
+                return download_cache.fetch(source, timeout=30, offline=self.options.offline)
+            if self.options.offline:
+                raise IOError('--offline specified, but the download cache is not available')
             resp = urllib2.urlopen(source, timeout=30)
-        except (urllib2.URLError, urllib2.HTTPError, socket.timeout) as e:
+        except Exception as e:
             self.logger.error('Error downloading from "%s": %s' % (source, str(e)))
             if self.options.prepare_jenkins_build_description_on_error:
-                text = 'append-build-description: Failure downloading template workspace (probable network issue)'
+                text = 'append-build-description: Failure downloading %s (probable network issue)' % (description,)
                 print(text)
-            raise PewmaException('ERROR: Workspace template download failed (network or proxy error, possibly transient): please retry')
+            raise PewmaException('ERROR: %s download failed (network or proxy error, possibly transient): please retry' % (error_description,))
 
         # read the data (small enough to do in one chunk)
-        self.logger.info('Downloading %s bytes from "%s" to "%s"' % (resp.info().get('content-length', '<unknown>'), resp.geturl(), destination))
+        self.logger.info('Downloading %s bytes from "%s"' % (resp.info().get('content-length', '<unknown>'), resp.geturl()))
         try:
-            templatedata = resp.read()
+            return resp.read()
         except Exception as e:
             self.logger.error('Error downloading from "%s": %s' % (source, str(e)))
             if self.options.prepare_jenkins_build_description_on_error:
-                text = 'append-build-description: Failure downloading template workspace (probable network issue)'
+                text = 'append-build-description: Failure downloading %s (probable network issue)' % (description,)
                 print(text)
-            raise PewmaException('ERROR: Workspace template download failed (network or proxy error, possibly transient): please retry')
+            raise PewmaException('ERROR: %s download failed (network or proxy error, possibly transient): please retry' % (error_description,))
         finally:
             try:
                 resp.close()
             except:
                 pass
 
+
+    def download_workspace_template(self, source, destination):
+        if self.options.dry_run:
+            self.logger.info('%sDownloading "%s" to "%s"' % (self.log_prefix, source, destination))
+            return
+
+        templatedata = self.download_url(source, 'template workspace', 'Workspace template')
+        self.logger.debug('Writing %s bytes to "%s"' % (len(templatedata), destination))
+
         # write the data
         with open(destination, "wb") as template:
             template.write(templatedata)
 
 
+    def clone_workspace_template(self, source, member_prefix, workspace_dir):
+        """ Creates workspace files from the workspace template, using the copy of the template kept extracted in the download cache
+        """
+
+        templatedata = self.download_url(source, 'template workspace', 'Workspace template')
+        with self.get_download_cache().extracted_zip(templatedata) as template_dir:
+            self.logger.info('%sCopying "%s (%s)" to "%s"' %
+                             (self.log_prefix, template_dir, member_prefix + '*' if member_prefix else '', workspace_dir))
+            counts = clone_tree(template_dir, workspace_dir, member_prefix)
+        self.logger.debug('Template files hardlinked: %(hardlinked)s, cloned: %(cloned)s, copied: %(copied)s' % counts)
+
+
     def unzip_workspace_template(self, template_zip, member_prefix, unzipdir):
+        import zipfile
         self.logger.info('%sUnzipping "%s (%s)" to "%s"' %
                          (self.log_prefix, template_zip, member_prefix + '*' if member_prefix else '', unzipdir))
         if self.options.dry_run:
@@ -884,10 +3291,10 @@ class PewmaManager(object):
         template.close()
 
 
-    def set_available_sites(self):
+    def set_available_sites(self, imported_only=True):
         """ Sets self.available_sites, a dictionary of {site name: project path} entries,
             for all .site projects in the workspace_git directory,
-            provided they have been imported into the Eclipse workspace
+            provided they have been imported into the Eclipse workspace (or regardless, if imported_only is False)
         """
 
         # we cache self.available_sites and never recompute
@@ -903,22 +3310,10 @@ class PewmaManager(object):
                     site_projects_imported.add(project_name)
 
         sites = {}
-        if site_projects_imported and self.workspace_git_loc:
-            # .site projects can be up to three directory levels below the git materialize directory
-            for level1 in os.listdir(self.workspace_git_loc):
-                level1_dir = os.path.join(self.workspace_git_loc, level1)
-                if os.path.isdir(level1_dir):
-                    for level2 in os.listdir(level1_dir):
-                        level2_dir = os.path.join(level1_dir, level2)
-                        if os.path.isdir(level2_dir):
-                            if level2 in site_projects_imported and os.path.exists( os.path.join(level2_dir, 'feature.xml')):
-                                sites[level2] = level2_dir
-                            else:
-                                for level3 in os.listdir(level2_dir):
-                                    level3_dir = os.path.join(level2_dir, level3)
-                                    if os.path.isdir(level3_dir):
-                                        if level3 in site_projects_imported and os.path.exists( os.path.join(level3_dir, 'feature.xml')):
-                                            sites[level3] = level3_dir
+        if (site_projects_imported or not imported_only) and self.workspace_git_loc and os.path.isdir(self.workspace_git_loc):
+            for (site_name, relpath) in self.get_workspace_git_index()['sites']:
+                if (site_name in site_projects_imported) or not imported_only:
+                    sites[site_name] = os.path.join(self.workspace_git_loc, relpath)
 
         self.available_sites = sites
 
@@ -994,21 +3389,16 @@ class PewmaManager(object):
                     projects_imported.add(project_name)
 
         project_names_paths = {}
-        for root, dirs, files in os.walk(self.workspace_git_loc):
-            for d in dirs[:]:
-                if d.startswith('.') or d.endswith(('.feature', '.site')):
-                    dirs.remove(d)
-            if 'releng.ant' in files:
-                dirs[:] = []  # projects are not normally nested inside other projects, so no need to look beneath this directory
-                if os.path.basename(root) in projects_imported:  # only include this project if it was imported into the workspace
-                    if os.path.basename(root).startswith('org.eclipse.scanning') and ('/daq-eclipse.git/' in root):
-                        continue # ignore org.eclipse.scanning projects in the old (un-imported) location (daq-eclipse.git); the imported version is in scanning.git
-                    if os.path.basename(root) in project_names_paths:  # we have seen this project before
-                        raise PewmaException('ERROR: releng.ant for project "%s" found in 2 locations: "%s/", "%s/"' %
-                                             (os.path.basename(root),
-                                              os.path.relpath(root, self.workspace_git_loc),
-                                              project_names_paths[os.path.basename(root)]))
-                    project_names_paths[os.path.basename(root)] = os.path.relpath(root, self.workspace_git_loc)
+        if self.workspace_git_loc and os.path.isdir(self.workspace_git_loc):
+            for (project_name, relpath) in self.get_workspace_git_index()['releng_ant_projects']:
+                if project_name not in projects_imported:  # only include this project if it was imported into the workspace
+                    continue
+                if project_name.startswith('org.eclipse.scanning') and ('daq-eclipse.git' in relpath.split(os.sep)):
+                    continue # ignore org.eclipse.scanning projects in the old (un-imported) location (daq-eclipse.git); the imported version is in scanning.git
+                if project_name in project_names_paths:  # we have seen this project before
+                    raise PewmaException('ERROR: releng.ant for project "%s" found in 2 locations: "%s/", "%s/"' %
+                                         (project_name, relpath, project_names_paths[project_name]))
+                project_names_paths[project_name] = relpath
         self.all_imported_projects_with_releng_ant = project_names_paths
 
 
@@ -1021,9 +3411,40 @@ class PewmaManager(object):
         return sorted( set(matching_items) )
 
 
+
+    def get_selected_repo_names(self, repo_names):
+        """ Returns the sorted list of repository names that satisfy --repo-include and --repo-exclude
+        """
+
+        if self.options.repo_includes:
+            repos_included = self.get_items_matching_glob_patterns(repo_names, self.options.repo_includes)
+        else:
+            repos_included = repo_names
+        if self.options.repo_excludes:
+            repos_excluded = self.get_items_matching_glob_patterns(repo_names, self.options.repo_excludes)
+        else:
+            repos_excluded = []
+        return sorted(set(repos_included) - set(repos_excluded))
+
     def get_selected_imported_projects_with_releng_ant(self):
         """ Finds all the project names that match the specified glob patterns (combination of --include and --exclude).
-            If neither --include nor --exclude specified, return the empty string
+            Returns the "-Dplugin_list=..." ant argument for them
+        """
+
+        return self.get_plugin_list_argument(self.get_selected_imported_project_names())
+
+
+    def get_plugin_list_argument(self, project_names):
+        """ Returns the "-Dplugin_list=..." ant argument for the projects (which must be in self.all_imported_projects_with_releng_ant)
+        """
+
+        return "-Dplugin_list=\"%s\"" % '|'.join([self.all_imported_projects_with_releng_ant[pname] for pname in project_names])
+
+
+    def get_selected_imported_project_names(self):
+        """ Finds all the project names that match the specified glob patterns (combination of --include and --exclude).
+            If neither --include nor --exclude specified, returns all the imported projects with a releng.ant
+            Returns a sorted list of project names
         """
 
         self.set_all_imported_projects_with_releng_ant()
@@ -1049,7 +3470,7 @@ class PewmaManager(object):
             selected_projects = sorted(self.all_imported_projects_with_releng_ant.keys())
 
         self.logger.info('%sSelected: %s projects' % (self.log_prefix, len(selected_projects)))
-        return "-Dplugin_list=\"%s\"" % '|'.join([self.all_imported_projects_with_releng_ant[pname] for pname in selected_projects])
+        return selected_projects
 
     def set_buckminster_properties_path(self, site_name=None):
         """ Sets self.buckminster_properties_path, the absolute path to the buckminster properties file in the specified site
@@ -1072,6 +3493,386 @@ class PewmaManager(object):
             else:
                 raise PewmaException('ERROR: Neither properties file "%s" exists' % (buckminster_properties_paths,))
 
+    def get_pewma_metadata_loc(self):
+        """ Returns the path of the directory in the workspace .metadata/ where pewma keeps its own files
+            (None if the workspace has no .metadata/). The directory is not created here.
+        """
+
+        if (not self.workspace_loc) or (not os.path.isdir(os.path.join(self.workspace_loc, '.metadata'))):
+            return None
+        return os.path.join(self.workspace_loc, '.metadata', PEWMA_METADATA_DIRECTORY)
+
+
+    def write_json_file(self, path, data):
+        """ Writes data to a JSON file, replacing it atomically so that a concurrent reader never sees a partial file
+        """
+
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        temp_path = '%s.%s.tmp' % (path, os.getpid())
+        with open(temp_path, 'w') as json_file:
+            json.dump(data, json_file, sort_keys=True)
+        if self.isWindows and os.path.exists(path):
+            os.remove(path)  # rename does not replace an existing file on Windows
+        os.rename(temp_path, path)
+
+
+    def get_workspace_git_index(self):
+        """ Returns an index of the workspace_git directory, a dictionary with lists of (name, path relative to workspace_git) for
+            "repositories", "sites", "releng_ant_projects" and "projects" (every project, with or without a releng.ant).
+            The index is kept in the workspace .metadata/, and is only rebuilt if the mtime of a directory it was built from has changed,
+            or if a directory had been modified just before it was scanned (since a later change might not alter the mtime)
+        """
+
+        index = getattr(self, '_workspace_git_index', None)
+        index_loc = self.get_pewma_metadata_loc()
+        if index_loc:
+            index_loc = os.path.join(index_loc, WORKSPACE_GIT_INDEX_FILE)
+        if (index is None) and index_loc and os.path.isfile(index_loc):
+            try:
+                with open(index_loc, 'r') as index_file:
+                    index = json.load(index_file)
+            except (IOError, ValueError) as e:
+                self.logger.debug('%sIgnoring unreadable index "%s": %s' % (self.log_prefix, index_loc, e))
+                index = None
+
+        if index is not None:
+            if ((index.get('format') != WORKSPACE_GIT_INDEX_FORMAT) or
+                (index.get('workspace_git_loc') != self.workspace_git_loc) or
+                (not self._is_workspace_git_index_current(index))):
+                index = None
+
+        if index is None:
+            start_time = time.time()
+            index = self._build_workspace_git_index()
+            self.logger.debug('%sIndexed %s directories in "%s" in %.2f seconds' %
+                              (self.log_prefix, len(index['directory_mtimes']), self.workspace_git_loc, time.time() - start_time))
+            if index_loc and not self.options.dry_run:
+                try:
+                    self.write_json_file(index_loc, index)
+                except (IOError, OSError) as e:
+                    self.logger.warn('%sCould not save index "%s": %s' % (self.log_prefix, index_loc, e))
+
+        self._workspace_git_index = index
+        return index
+
+
+    def _is_workspace_git_index_current(self, index):
+        """ Returns True if none of the directories scanned to build the index have changed since
+            (a directory whose mtime is None was modified just before the scan, so is always treated as changed)
+        """
+
+        for (relpath, mtime) in index['directory_mtimes'].items():
+            if mtime is None:
+                return False
+            try:
+                if os.stat(os.path.join(self.workspace_git_loc, relpath)).st_mtime != mtime:
+                    return False
+            except OSError:
+                return False  # directory has been deleted
+        return True
+
+
+    def _build_workspace_git_index(self):
+        """ Scans the workspace_git directory, once, for git repositories, .site projects and projects with a releng.ant file
+            The scan does not look beneath a project with a releng.ant, or a .feature or .site directory, since projects are not normally
+            nested inside those, but does look beneath other projects (e.g. diamond.releng.buckminster contains templates/tp/)
+        """
+
+        index = {'format': WORKSPACE_GIT_INDEX_FORMAT,
+                 'workspace_git_loc': self.workspace_git_loc,
+                 'directory_mtimes': {},  # {path relative to workspace_git: mtime, or None if unstable} for every directory scanned
+                 'repositories': [],
+                 'sites': [],
+                 'releng_ant_projects': [],
+                 'projects': [],
+                 }
+        unstable_after = time.time() - MTIME_UNSTABLE_SECONDS
+        to_scan = [(self.workspace_git_loc, 0, False)]  # (directory, depth below workspace_git, whether inside a git repository)
+        while to_scan:
+            (directory, depth, in_repository) = to_scan.pop()
+            try:
+                mtime = os.stat(directory).st_mtime
+                (dirs, files) = list_directory(directory)
+            except OSError:
+                continue  # directory deleted since its parent was scanned
+            relpath = os.path.relpath(directory, self.workspace_git_loc)
+            name = os.path.basename(directory)
+            index['directory_mtimes'][relpath] = mtime if mtime < unstable_after else None
+
+            if ('.git' in dirs) and not in_repository:
+                index['repositories'].append((name, relpath))
+                in_repository = True  # don't look for git repositories nested inside this one
+            if depth:
+                if name.endswith('.site') and (depth in (2, 3)) and ('feature.xml' in files):
+                    index['sites'].append((name, relpath))  # .site projects can be up to three directory levels below workspace_git
+                    continue
+                if 'releng.ant' in files:
+                    if not name.endswith(('.feature', '.site')):
+                        index['releng_ant_projects'].append((name, relpath))
+                    index['projects'].append((name, relpath))
+                    continue
+                if '.project' in files:
+                    index['projects'].append((name, relpath))  # but keep looking beneath it, since it may contain other projects
+                if name.endswith(('.feature', '.site')):
+                    continue  # features and sites do not contain other projects
+            for d in dirs:
+                if not d.startswith('.'):  # don't recurse into hidden directories
+                    to_scan.append((os.path.join(directory, d), depth + 1, in_repository))
+
+        for key in ('repositories', 'sites', 'releng_ant_projects', 'projects'):
+            index[key].sort()
+        return index
+
+
+    def get_project_graph(self):
+        """ Returns the graph of the projects in workspace_git, a dictionary of {project path relative to workspace_git: node}
+            for every project, where a node has the project's parsed MANIFEST.MF, feature.xml and .project (see parse_project_files)
+            The nodes are kept in the workspace .metadata/, and only projects whose files have changed since are read again,
+            several at a time
+        """
+        graph_loc = self.get_pewma_metadata_loc()
+        if graph_loc:
+            graph_loc = os.path.join(graph_loc, PROJECT_GRAPH_FILE)
+        cached = {}
+        if graph_loc and os.path.isfile(graph_loc):
+            try:
+                with open(graph_loc, 'r') as graph_file:
+                    graph = json.load(graph_file)
+                if (graph.get('format') == PROJECT_GRAPH_FORMAT) and (graph.get('workspace_git_loc') == self.workspace_git_loc):
+                    cached = graph['projects']
+            except (IOError, ValueError, KeyError) as e:
+                self.logger.debug('%sIgnoring unreadable project graph "%s": %s' % (self.log_prefix, graph_loc, e))
+
+        projects = {}  # {relpath: {"stats": {key: [mtime, size]}, "node": node}}
+        to_parse = []
+        for (_, relpath) in self.get_workspace_git_index()['projects']:
+            stats = stat_project_files(os.path.join(self.workspace_git_loc, relpath))
+            if (relpath in cached) and (cached[relpath]['stats'] == stats):
+                projects[relpath] = cached[relpath]
+            else:
+                projects[relpath] = {'stats': stats}
+                to_parse.append(relpath)
+
+        if to_parse:
+            nodes = map_concurrently(lambda relpath: parse_project_files(os.path.join(self.workspace_git_loc, relpath)), to_parse,
+                                     self.options.git_jobs or GRAPH_JOBS)
+            for (relpath, node) in zip(to_parse, nodes):
+                projects[relpath]['node'] = node
+                for error in node['errors']:
+                    self.logger.warn('%sCould not read %s in "%s": %s' % (self.log_prefix, error.split(':', 1)[0], relpath, error.split(':', 1)[1].strip()))
+
+        if to_parse or (len(projects) != len(cached)):
+            self.logger.debug('%sRead the files of %s of %s projects in "%s"' % (self.log_prefix, len(to_parse), len(projects), self.workspace_git_loc))
+            if graph_loc and not self.options.dry_run:
+                try:
+                    self.write_json_file(graph_loc, {'format': PROJECT_GRAPH_FORMAT, 'workspace_git_loc': self.workspace_git_loc, 'projects': projects})
+                except (IOError, OSError) as e:
+                    self.logger.warn('%sCould not save project graph "%s": %s' % (self.log_prefix, graph_loc, e))
+        return dict((relpath, project['node']) for (relpath, project) in projects.items())
+
+
+    def get_project_dependencies(self, nodes):
+        """ Returns {project path: set of the project paths it depends on} for the nodes returned by get_project_graph
+            A bundle depends on the bundles it requires, the bundles that export packages it imports, and (if it is a fragment)
+            its host; a feature depends on the features it includes, the plugins in it, and the plugins and features it requires;
+            and any project depends on the projects that its .project references
+            (dependencies on anything not in workspace_git, such as the target platform, are ignored)
+        """
+
+        bundles = collections.defaultdict(list)  # {symbolic name: [relpath]}
+        features = collections.defaultdict(list)  # {feature id: [relpath]}
+        exporters = collections.defaultdict(list)  # {package: [relpath]}
+        names = collections.defaultdict(list)  # {Eclipse project name: [relpath]}
+        for (relpath, node) in nodes.items():
+            if node['bundle']:
+                if node['bundle']['symbolic_name']:
+                    bundles[node['bundle']['symbolic_name']].append(relpath)
+                for package in node['bundle']['exports']:
+                    exporters[package].append(relpath)
+            if node['feature'] and node['feature']['id']:
+                features[node['feature']['id']].append(relpath)
+            names[(node['project'] and node['project']['name']) or os.path.basename(relpath)].append(relpath)
+
+        dependencies = {}
+        for (relpath, node) in nodes.items():
+            depends_on = set()
+            bundle = node['bundle']
+            if bundle:
+                for name in bundle['requires']:
+                    depends_on.update(bundles.get(name, ()))
+                for package in bundle['imports']:
+                    depends_on.update(exporters.get(package, ()))
+                if bundle['host']:
+                    depends_on.update(bundles.get(bundle['host'], ()))
+            feature = node['feature']
+            if feature:
+                for name in feature['includes']:
+                    depends_on.update(features.get(name, ()))
+                for name in feature['plugins']:
+                    depends_on.update(bundles.get(name, ()))
+                for name in feature['requires']:
+                    depends_on.update(bundles.get(name, ()))
+                    depends_on.update(features.get(name, ()))
+            if node['project']:
+                for name in node['project']['references']:
+                    depends_on.update(names.get(name, ()))
+            depends_on.discard(relpath)
+            dependencies[relpath] = depends_on
+        return dependencies
+
+
+    def get_project_dependents(self, nodes):
+        """ Returns {project path: set of the project paths that depend on it} for the nodes returned by get_project_graph
+            (see get_project_dependencies; in addition, a host bundle depends on its fragments, since they add to its contents)
+        """
+
+        dependents = collections.defaultdict(set)
+        for (relpath, depends_on) in self.get_project_dependencies(nodes).items():
+            for dependency in depends_on:
+                dependents[dependency].add(relpath)
+            bundle = nodes[relpath]['bundle']
+            if bundle and bundle['host']:
+                dependents[relpath].update(dependency for dependency in depends_on
+                                           if nodes[dependency]['bundle'] and (nodes[dependency]['bundle']['symbolic_name'] == bundle['host']))
+        return dependents
+
+
+    def action_graph(self):
+        """ Processes command: graph [dot|json|batches] [<file>]
+            Reports the number of projects and dependencies in workspace_git, and any dependency cycles,
+            and optionally writes the graph (as DOT or JSON) or the batches of projects in build order
+        """
+
+        if len(self.arguments) > 2:
+            raise PewmaException('ERROR: graph command has too many arguments')
+        output_format = self.arguments[0] if self.arguments else None
+        if output_format not in (None, 'dot', 'json', 'batches'):
+            raise PewmaException('ERROR: graph command output must be dot, json or batches, not "%s"' % (output_format,))
+        if not os.path.isdir(self.workspace_git_loc):
+            raise PewmaException('ERROR: workspace_git directory "%s" does not exist' % (self.workspace_git_loc,))
+
+        start_time = time.time()
+        nodes = self.get_project_graph()
+        dependencies = self.get_project_dependencies(nodes)
+        (batches, cycles) = topological_batches(dependencies)
+        names = dict((relpath, (node['project'] and node['project']['name']) or os.path.basename(relpath)) for (relpath, node) in nodes.items())
+        self.logger.info('%sGraph: %s projects (%s bundles, %s features), %s dependencies, %s batches, %s cycles, in %.2f seconds' %
+                         (self.log_prefix, len(nodes), sum(1 for node in nodes.values() if node['bundle']),
+                          sum(1 for node in nodes.values() if node['feature']), sum(len(depends_on) for depends_on in dependencies.values()),
+                          len(batches), len(cycles), time.time() - start_time))
+        for cycle in cycles:
+            self.logger.warn('%sDependency cycle: %s' % (self.log_prefix, ', '.join(names[relpath] for relpath in cycle)))
+        if not output_format:
+            return
+
+        if output_format == 'dot':
+            in_cycle = set(relpath for cycle in cycles for relpath in cycle)
+            lines = ['digraph projects {', '    rankdir=LR;', '    node [shape=box];']
+            for relpath in sorted(nodes):
+                attributes = ['label="%s"' % (names[relpath],)]
+                if nodes[relpath]['feature']:
+                    attributes.append('shape=folder')
+                if relpath in in_cycle:
+                    attributes.append('color=red')
+                lines.append('    "%s" [%s];' % (relpath, ', '.join(attributes)))
+            for relpath in sorted(dependencies):
+                for dependency in sorted(dependencies[relpath]):
+                    lines.append('    "%s" -> "%s"%s;' % (relpath, dependency, ' [color=red]' if (relpath in in_cycle) and (dependency in in_cycle) else ''))
+            lines.append('}')
+            text = '\n'.join(lines) + '\n'
+        elif output_format == 'json':
+            text = json.dumps({'projects': dict((relpath, {'name': names[relpath],
+                                                           'kind': 'feature' if nodes[relpath]['feature'] else 'bundle' if nodes[relpath]['bundle'] else 'project',
+                                                           'depends_on': sorted(dependencies[relpath])}) for relpath in nodes),
+                               'batches': batches,
+                               'cycles': cycles,
+                               }, indent=1, separators=(',', ': '), sort_keys=True) + '\n'
+        else:
+            text = ''.join('batch %s: %s\n' % (n, ' '.join(names[relpath] for relpath in batch)) for (n, batch) in enumerate(batches, 1))
+
+        if len(self.arguments) > 1:
+            output_path = os.path.abspath(os.path.expanduser(self.arguments[1]))
+            with open(output_path, 'w') as output_file:
+                output_file.write(text.encode('utf-8'))
+            self.logger.info('%sWrote %s to "%s"' % (self.log_prefix, output_format, output_path))
+        else:
+            sys.stdout.write(text)
+
+
+    def get_changed_project_paths(self):
+        """ Returns the set of project paths (relative to workspace_git) that have changed, according to --affected-repositories
+            (every project in those repositories) and --affected-since (projects with files that differ from that git ref,
+            including uncommitted changes and untracked files, in each repository; if the ref is not known in a repository, all its projects)
+        """
+        index = self.get_workspace_git_index()
+        project_paths = set(relpath for (_, relpath) in index['projects'])
+        affected_repositories = set()
+        for repositories in self.options.affected_repositories:
+            affected_repositories.update(repo.strip() for repo in repositories.split(',') if repo.strip())
+        unknown = affected_repositories - set(name for (name, _) in index['repositories'])
+        if unknown:
+            raise PewmaException('ERROR: --affected-repositories %s not found in "%s"' % (', '.join(sorted(unknown)), self.workspace_git_loc))
+
+        def changed_files(repository):
+            """ Returns the paths (relative to workspace_git) of the files changed in a repository, or None for all of them """
+            (repo_name, repo_relpath) = repository
+            if repo_name in affected_repositories:
+                return None
+            if not self.options.affected_since:
+                return []
+            repo_loc = os.path.join(self.workspace_git_loc, repo_relpath)
+            git_command = ('git', '--git-dir', os.path.join(repo_loc, '.git'), '--work-tree', repo_loc)
+            paths = []
+            # run in the repository, since ls-files only lists (and diff.relative only shows) files below the current directory;
+            # and -z so that unusual paths are not quoted
+            for command in (('diff', '--name-only', '-z', self.options.affected_since, '--'), ('ls-files', '--others', '--exclude-standard', '-z')):
+                (out, err, retcode) = self._run_native_git_raw(git_command + command, cwd=repo_loc)
+                if retcode:
+                    self.logger.warn('%sCould not compare %s with "%s", so assuming all its projects are affected: %s' %
+                                     (self.log_prefix, repo_name, self.options.affected_since, err.splitlines()[0] if err else retcode))
+                    return None
+                paths.extend(os.path.normpath(os.path.join(repo_relpath, path.decode('utf-8', 'replace'))) for path in out.split(b'\0') if path)
+            return paths
+
+        repositories = index['repositories']
+        results = map_concurrently(changed_files, repositories, self.options.git_jobs or REPOSITORY_JOBS)
+
+        changed = set()
+        for ((_, repo_relpath), paths) in zip(repositories, results):
+            if paths is None:
+                changed.update(relpath for relpath in project_paths if (relpath == repo_relpath) or relpath.startswith(repo_relpath + os.sep))
+                continue
+            for path in paths:
+                while path and (path not in project_paths):
+                    path = os.path.dirname(path)  # the project containing the file, if any
+                if path:
+                    changed.add(path)
+        return changed
+
+
+    def select_affected_projects(self, project_names):
+        """ Returns the projects (from project_names, which have a releng.ant) that are affected by the changes identified by
+            --affected-since and --affected-repositories: the changed projects, and all the bundles that depend on them (transitively)
+        """
+
+        changed = self.get_changed_project_paths()
+        dependents = self.get_project_dependents(self.get_project_graph())
+        affected = set(changed)
+        to_visit = list(changed)
+        while to_visit:
+            for dependent in dependents.get(to_visit.pop(), ()):
+                if dependent not in affected:
+                    affected.add(dependent)
+                    to_visit.append(dependent)
+
+        selected = [name for name in project_names if self.all_imported_projects_with_releng_ant[name] in affected]
+        self.logger.info('%sAffected: %s projects changed, %s affected, %s of the %s selected projects to test' %
+                         (self.log_prefix, len(changed), len(affected), len(selected), len(project_names)))
+        if selected:
+            self.logger.debug('%sProjects affected: %s' % (self.log_prefix, ', '.join(selected)))
+        return selected
+
 ###############################################################################
 #  Actions                                                                    #
 ###############################################################################
@@ -1135,6 +3936,32 @@ class PewmaManager(object):
                                   dirowner_uname, dirowner_uid,))
 
 
+    def _set_linux_group_in_workspace_trees(self):
+        """ With --directories.recursive, applies the Linux group and permissions to everything in workspace/ and workspace_git/
+            (see set_group_in_tree), processing the top-level entries (such as repositories) concurrently
+        """
+
+        if (not self.isLinux) or (not self.options.directories_groupname) or (not self.options.directories_recursive) or self.options.dry_run:
+            return
+        gid = self.gid_new if (self.user_euid == 0) or (self.gid_new in os.getgroups()) else None  # can only change the group to one we are a member of (unless root)
+        if gid is None:
+            self.logger.warn('Cannot change owning group: current user %s (%s) is not in new group %s (%s)' %
+                             (self.user_uname, self.user_euid, self.options.directories_groupname, self.gid_new,))
+        for directory in (self.workspace_loc, self.workspace_git_loc):
+            if not os.path.isdir(directory):
+                continue
+            start_time = time.time()
+            (dirs, files) = list_directory(directory)
+            paths = [os.path.join(directory, name) for name in dirs + files]
+            results = map_concurrently(lambda path: set_group_in_tree(path, gid, self.user_euid), paths, self.options.git_jobs or SET_GROUP_JOBS)
+            counts = dict((key, sum(result[key] for result in results)) for key in ('checked', 'changed', 'failed', 'shared'))
+            self.logger.log(logging.WARNING if counts['failed'] else logging.INFO,
+                            '%sGroup %s and permissions: checked %s entries in "%s", changed %s%s%s, in %.1f seconds' %
+                            (self.log_prefix, self.options.directories_groupname, counts['checked'], directory, counts['changed'],
+                             ' (%s could not be changed)' % (counts['failed'],) if counts['failed'] else '',
+                             ', left %s hardlinked files unchanged' % (counts['shared'],) if counts['shared'] else '', time.time() - start_time))
+
+
     def action_setup(self):
         """ Processes command: setup [<category> [<version>] | <cquery>]
         """
@@ -1152,6 +3979,7 @@ class PewmaManager(object):
 
         if cquery_to_use:
             self.add_cquery_to_history(cquery_to_use)
+        self._set_linux_group_in_workspace_trees()
         return
 
 
@@ -1167,6 +3995,7 @@ class PewmaManager(object):
     def action_get_branches_expected(self):
         """ Processes command: get-branches-expected <component> [<category> [<version>] | <cquery>]
         """
+        import xml.etree.ElementTree as ET
 
         (_, _, _, cquery_to_use, _) = self._interpret_components_category_version_cquery()
         source = self._get_full_uri('base/' + cquery_to_use)
@@ -1174,34 +4003,25 @@ class PewmaManager(object):
             self.logger.info('%sDownloading "%s"' % (self.log_prefix, source))
             return
 
-        # open the URL
-        try:
-            resp = urllib2.urlopen(source, timeout=30)
-        except (urllib2.URLError, urllib2.HTTPError, socket.timeout) as e:
-            self.logger.error('Error downloading from "%s": %s' % (source, str(e)))
-            if self.options.prepare_jenkins_build_description_on_error:
-                text = 'append-build-description: Failure downloading CQuery (probable network issue)'
-                print(text)
-            raise PewmaException('ERROR: CQuery download failed (network or proxy error, possibly transient): please retry')
+        cquerydata = self.download_url(source, 'CQuery', 'CQuery')
+        repos_branches = self._get_cquery_repositories_branches(ET.fromstring(cquerydata))
 
-        # read the data (it's small enough to do in one chunk)
-        self.logger.info('Downloading %s bytes from "%s"' % (resp.info().get('content-length', '<unknown>'), resp.geturl()))
-        try:
-            cquerydata = resp.read()
-        except Exception as e:
-            self.logger.error('Error downloading from "%s": %s' % (source, str(e)))
-            if self.options.prepare_jenkins_build_description_on_error:
-                text = 'append-build-description: Failure downloading CQuery (probable network issue)'
-                print(text)
-            raise PewmaException('ERROR: CQuery download failed (network or proxy error, possibly transient): please retry')
-        finally:
-            try:
-                resp.close()
-            except:
-                pass
+        cquery_branches_path = os.path.abspath(os.path.expanduser(self.options.cquery_branches_file))
+        self.logger.info('Writing expected branches to "%s"' % (cquery_branches_path,))
+        with open(cquery_branches_path, 'w') as expected_branches_file:
+            expected_branches_file.write('### File generated ' + time.strftime("%a, %Y/%m/%d %H:%M:%S %z") +
+                          ' (' + os.environ.get('BUILD_URL','$BUILD_URL:missing') + ')\n')
+            expected_branches_file.write('# branches as specified by cquery=%s\n' % (cquery_to_use,))
+            for repo in sorted(repos_branches):
+                expected_branches_file.write('%s=%s\n' % (repo, repos_branches[repo]))
+
+
+    def _get_cquery_repositories_branches(self, root):
+        """ Returns a dictionary of {repository name: branch} for all the repositories in the advisor nodes of a CQuery
+            (root is the parsed CQuery). Repository names do not include the ".git" suffix.
+        """
 
         # process all repositories in advisor nodes
-        root = ET.fromstring(cquerydata)
         repos_branches = {}
 
         cquery_namespace = "{http://www.eclipse.org/buckminster/CQuery-1.0}"
@@ -1235,31 +4055,367 @@ class PewmaManager(object):
 
             branchTagPath = advisorNode.get('branchTagPath', None)
             repos_branches[repository] = branchTagPath or 'master'  # if repo defined multiple times, use the last specified branch
+        return repos_branches
 
-        cquery_branches_path = os.path.abspath(os.path.expanduser(self.options.cquery_branches_file))
-        self.logger.info('Writing expected branches to "%s"' % (cquery_branches_path,))
-        with open(cquery_branches_path, 'w') as expected_branches_file:
-            expected_branches_file.write('### File generated ' + time.strftime("%a, %Y/%m/%d %H:%M:%S %z") +
-                          ' (' + os.environ.get('BUILD_URL','$BUILD_URL:missing') + ')\n')
-            expected_branches_file.write('# branches as specified by cquery=%s\n' % (cquery_to_use,))
-            for repo in sorted(repos_branches):
-                expected_branches_file.write('%s=%s\n' % (repo, repos_branches[repo]))
+
+    def get_cquery_git_repositories(self, cquery_to_use):
+        """ Returns a sorted list of (repository name, branch, remote URL) for the git repositories used by a CQuery,
+            with the branches taken from the CQuery, and the URLs from its RMap (and any RMaps that it redirects to)
+            Repository names are as they appear in workspace_git (e.g. "gda-core.git")
+        """
+        import urlparse
+        import xml.etree.ElementTree as ET
+
+        source = self._get_full_uri('base/' + cquery_to_use)
+        root = ET.fromstring(self.download_url(source, 'CQuery', 'CQuery'))
+        repos_branches = self._get_cquery_repositories_branches(root)
+
+        # properties are taken from the RMap, overridden by -D properties, overridden by the CQuery (the precedence Buckminster uses)
+        properties = {'workspace.root': self.workspace_loc, 'user.home': os.path.expanduser('~')}
+        properties.update(keyval.split('=', 1) for keyval in self.options.system_property)
+        for prop in root.findall('{http://www.eclipse.org/buckminster/CQuery-1.0}property'):
+            properties[prop.get('key')] = prop.get('value', '')
+
+        rmap = BuckminsterRMap()
+        rmaps_to_read = [urlparse.urljoin(source, root.get('resourceMap'))]
+        rmaps_read = set()
+        while rmaps_to_read:
+            rmap_source = rmaps_to_read.pop(0)
+            if rmap_source not in rmaps_read:
+                rmaps_read.add(rmap_source)
+                redirects = rmap.add(self.download_url(rmap_source, 'RMap', 'RMap'))
+                rmaps_to_read.extend(urlparse.urljoin(rmap_source, href) for href in redirects)
+
+        repositories = []
+        for repo in sorted(repos_branches):
+            repo_name = repo + '.git'
+            remote_uri = rmap.git_remote_uris.get(repo_name)
+            if not remote_uri:
+                self.logger.warn('%sNo git provider for repository "%s" found in the RMap' % (self.log_prefix, repo_name))
+                continue
+            try:
+                repositories.append((repo_name, repos_branches[repo], rmap.expand(remote_uri, properties)))
+            except ValueError as e:
+                self.logger.warn('%sCould not determine URL for repository "%s": %s' % (self.log_prefix, repo_name, e))
+        return repositories
+
+
+    def preclone_repositories(self, cquery_to_use):
+        """ Clones the git repositories used by a CQuery that are not already in workspace_git, using native git, several at a time
+            (--jobs), and retrying clones that fail with a transient error. Buckminster then finds the repositories already present.
+            Returns the number of repositories that could not be cloned
+        """
+        repositories = self.get_cquery_git_repositories(cquery_to_use)
+        selected_repos = self.get_selected_repo_names([repo_name for (repo_name, _, _) in repositories])
+        repos_to_clone = []  # list of (repo_name, branch, url), in sorted order
+        for (repo_name, branch, url) in repositories:
+            if repo_name not in selected_repos:
+                self.logger.debug('%sSkipped: does not satisfy --repo-include/--repo-exclude: %s' % (self.log_prefix, repo_name))
+            elif os.path.isdir(os.path.join(self.workspace_git_loc, repo_name)):
+                self.logger.debug('%sSkipped: already cloned: %s' % (self.log_prefix, repo_name))
+            else:
+                repos_to_clone.append((repo_name, branch, url))
+        if not repos_to_clone:
+            self.logger.info('%sPre-clone: all %s repositories used by %s are already present' % (self.log_prefix, len(selected_repos), cquery_to_use))
+            return 0
+
+        jobs = min(self.options.git_jobs or REPOSITORY_JOBS, len(repos_to_clone))
+        self.logger.info('%sPre-cloning %s repositories used by %s, %s at a time' % (self.log_prefix, len(repos_to_clone), cquery_to_use, jobs))
+        start_time = time.time()
+        results = map_concurrently(lambda repo: self._preclone_one_repo(*repo), repos_to_clone, jobs)
+
+        failed = [repo_name for ((repo_name, _, _), ok) in zip(repos_to_clone, results) if not ok]
+        self.logger.log(logging.ERROR if failed else logging.INFO, '%sPre-cloned %s of %s repositories in %s%s' %
+                        (self.log_prefix, len(repos_to_clone) - len(failed), len(repos_to_clone),
+                         datetime.timedelta(seconds=int(time.time() - start_time)),
+                         ' (failed: %s)' % (', '.join(failed),) if failed else ''))
+        self.record_metric('preclone', start_time, time.time() - start_time, len(failed), detail='%s repositories' % (len(repos_to_clone),))
+        return len(failed)
+
+
+    def _preclone_one_repo(self, repo_name, branch, url):
+        """ Clones one repository (into a temporary directory, which is renamed when complete, so a partial clone is never left)
+            Returns True if successful
+            (safe to call from multiple threads at once)
+        """
+
+        git_dir = os.path.join(self.workspace_git_loc, repo_name)
+        temp_dir = git_dir + '.preclone'
+        mirror_loc = self.get_git_mirror_loc(repo_name)
+        if mirror_loc and not self.refresh_git_mirror(repo_name, url):
+            mirror_loc = None
+        if mirror_loc:
+            # objects already in the mirror are borrowed (through .git/objects/info/alternates) rather than downloaded and copied
+            command = ('git', 'clone', '--quiet', '--reference', mirror_loc, '--branch', branch, url, temp_dir)
+        else:
+            command = ('git', 'clone', '--quiet', '--branch', branch, url, temp_dir)
+        self.logger.info('%sRunning: %s' % (self.log_prefix, ' '.join(command)))
+        if self.options.dry_run:
+            return True
+
+        for attempt in range(1, self.options.preclone_retries + 2):
+            if os.path.isdir(temp_dir):
+                remove_tree(temp_dir)
+            start_time = time.time()
+            if mirror_loc:
+                with exclusive_file_lock(mirror_loc + '.lock', shared=True):  # mirror-gc must not repack while the clone reads the mirror
+                    (out, retcode) = self._run_native_git(command)
+            else:
+                (out, retcode) = self._run_native_git(command)
+            if not retcode:
+                os.rename(temp_dir, git_dir)
+                self.logger.info('%sCloned %s (branch %s) in %.1f seconds' % (self.log_prefix, repo_name, branch, time.time() - start_time))
+                return True
+            if attempt > self.options.preclone_retries or not any(re.search(pattern, out) for pattern in GIT_TRANSIENT_ERROR_PATTERNS):
+                break
+            delay = 5 * 2 ** (attempt - 1)
+            self.logger.warn('%sClone of %s failed (attempt %s, rc=%s), retrying in %s seconds: %s' % (self.log_prefix, repo_name, attempt, retcode, delay, out))
+            time.sleep(delay)
+
+        if os.path.isdir(temp_dir):
+            remove_tree(temp_dir)
+        self.logger.error('%sClone of %s failed (attempt %s, rc=%s): %s' % (self.log_prefix, repo_name, attempt, retcode, out))
+        return False
+
+
+    def _run_native_git(self, command):
+        """ Runs a git command (a tuple of arguments), capturing the output (stdout and stderr combined)
+            Returns (output, return code)
+            (safe to call from multiple threads at once)
+        """
+
+        env = dict(os.environ)
+        env['GIT_TERMINAL_PROMPT'] = '0'  # fail rather than prompt for credentials, since several commands may be running at once
+        try:
+            process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, env=env)
+            out = process.communicate()[0].strip()
+        except OSError as e:
+            return (str(e), -1)
+        return (out, process.returncode)
+
+
+    def _run_native_git_raw(self, command, cwd=None):
+        """ Runs a git command (a tuple of arguments), capturing stdout exactly as written (for output that is parsed, such as -z lists),
+            optionally in directory cwd
+            Returns (stdout, stderr, return code)
+            (safe to call from multiple threads at once)
+        """
+
+        env = dict(os.environ)
+        env['GIT_TERMINAL_PROMPT'] = '0'
+        try:
+            process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=env, cwd=cwd)
+            (out, err) = process.communicate()
+        except OSError as e:
+            return (b'', str(e), -1)
+        return (out, err.strip(), process.returncode)
+
+
+    def get_git_mirror_loc(self, repo_name):
+        """ Returns the path of the bare mirror of a repository in the --git-mirror-cache, or None if there is no mirror cache
+            Mirrors are named by the repository's Gerrit URL path (e.g. "gda/gda-core.git"), so only Gerrit repositories have one
+        """
+
+        if (not self.options.git_mirror_cache) or (repo_name not in GERRIT_REPOSITORIES):
+            return None
+        return os.path.join(os.path.abspath(os.path.expanduser(self.options.git_mirror_cache)),
+                            *GERRIT_REPOSITORIES[repo_name]['url_part'].split('/'))
+
+
+    def refresh_git_mirror(self, repo_name, url):
+        """ Creates or incrementally updates the bare mirror of a repository from url
+            Only branches and tags are mirrored (not Gerrit's refs/changes/), and nothing is ever pruned, since clones may be borrowing the objects
+            (the mirror is configured with GIT_MIRROR_CONFIG, and the fetch itself never starts an automatic gc)
+            Failure to update is not an error: a clone that references an out-of-date mirror just downloads more
+            Returns True if the mirror exists (so can be referenced)
+        """
+
+        mirror_loc = self.get_git_mirror_loc(repo_name)
+        command = ('git', '--git-dir=' + mirror_loc, '-c', 'gc.auto=0', 'fetch', '--quiet', url, '+refs/heads/*:refs/heads/*', '+refs/tags/*:refs/tags/*')
+        self.logger.info('%sRunning: %s' % (self.log_prefix, ' '.join(command)))
+        if self.options.dry_run:
+            return True
+
+        if not os.path.isdir(os.path.dirname(mirror_loc)):
+            try:
+                os.makedirs(os.path.dirname(mirror_loc))
+            except OSError:
+                if not os.path.isdir(os.path.dirname(mirror_loc)):  # might have been created by a concurrent run
+                    raise
+        with exclusive_file_lock(mirror_loc + '.lock'):
+            if not os.path.isdir(mirror_loc):
+                (out, retcode) = self._run_native_git(('git', 'init', '--quiet', '--bare', mirror_loc))
+                if not retcode:
+                    retcode = self._configure_git_mirror(mirror_loc)
+                if retcode:
+                    self.logger.warn('%sCould not create git mirror "%s": %s' % (self.log_prefix, mirror_loc, out))
+                    if os.path.isdir(mirror_loc):
+                        remove_tree(mirror_loc)  # so that it is created, and configured, next time
+                    return False
+            start_time = time.time()
+            (out, retcode) = self._run_native_git(command)
+        if retcode:
+            self.logger.warn('%sCould not update git mirror "%s" (rc=%s): %s' % (self.log_prefix, mirror_loc, retcode, out))
+        else:
+            self.logger.debug('%sUpdated git mirror "%s" in %.1f seconds' % (self.log_prefix, mirror_loc, time.time() - start_time))
+        return True
+
+
+    def _configure_git_mirror(self, mirror_loc):
+        """ Sets GIT_MIRROR_CONFIG in a mirror's config (must be called holding the mirror's lock)
+            Returns 0, or the return code of the first git config command that failed
+        """
+
+        for (name, value) in GIT_MIRROR_CONFIG:
+            command = ('git', '--git-dir=' + mirror_loc, 'config', name, value)
+            (out, retcode) = self._run_native_git(command)
+            if retcode:
+                self.logger.error('Return Code: %s running: %s: %s' % (retcode, ' '.join(command), out))
+                return retcode
+        return 0
+
+
+    def action_mirror_gc(self):
+        """ Processes command: mirror-gc
+            Repacks each mirror in the --git-mirror-cache into a single pack. Unreachable objects are kept, since workspace clones
+            borrow objects from the mirrors, and may need objects from branches that have since been deleted.
+            Also (re)applies GIT_MIRROR_CONFIG, for mirrors created by earlier versions of pewma.
+        """
+
+        if self.arguments:
+            raise PewmaException('ERROR: mirror-gc command does not take any arguments')
+        if not self.options.git_mirror_cache:
+            raise PewmaException('ERROR: mirror-gc command requires --git-mirror-cache')
+        cache_loc = os.path.abspath(os.path.expanduser(self.options.git_mirror_cache))
+        if not os.path.isdir(cache_loc):
+            self.logger.info('%sGit mirror cache "%s" does not exist' % (self.log_prefix, cache_loc))
+            return
+
+        mirror_locs = []
+        for (dirpath, dirnames, _) in os.walk(cache_loc):
+            for dirname in sorted(dirnames):
+                if dirname.endswith('.git'):
+                    mirror_locs.append(os.path.join(dirpath, dirname))
+            dirnames[:] = [d for d in dirnames if not d.endswith('.git')]  # don't descend into the mirrors themselves
+
+        def objects_size(mirror_loc):
+            (out, retcode) = self._run_native_git(('git', '--git-dir=' + mirror_loc, 'count-objects', '-v'))
+            sizes = dict(line.split(': ', 1) for line in out.splitlines() if ': ' in line) if not retcode else {}
+            return int(sizes.get('size', 0)) + int(sizes.get('size-pack', 0))  # in KiB
+
+        rc = 0
+        for mirror_loc in mirror_locs:
+            self.logger.info('%sRepacking git mirror "%s"' % (self.log_prefix, mirror_loc))
+            if self.options.dry_run:
+                continue
+            start_time = time.time()
+            with exclusive_file_lock(mirror_loc + '.lock'):  # waits for any clones from, or updates of, the mirror to finish
+                if self._configure_git_mirror(mirror_loc):
+                    rc = 1
+                    continue
+                size_before = objects_size(mirror_loc)
+                for command in (('git', '--git-dir=' + mirror_loc, 'repack', '-a', '-d', '--keep-unreachable', '--quiet'),
+                                ('git', '--git-dir=' + mirror_loc, 'pack-refs', '--all')):
+                    (out, retcode) = self._run_native_git(command)
+                    if retcode:
+                        self.logger.error('Return Code: %s running: %s: %s' % (retcode, ' '.join(command), out))
+                        rc = 1
+                        break
+                size_after = objects_size(mirror_loc)
+            self.logger.info('%sRepacked "%s" in %.1f seconds: %s KiB --> %s KiB' %
+                             (self.log_prefix, mirror_loc, time.time() - start_time, '{0:,d}'.format(size_before), '{0:,d}'.format(size_after)))
+        return rc
+
+
+    def action_preclone(self):
+        """ Processes command: preclone [<category> [<version>] | <cquery>]
+        """
+
+        if len(self.arguments) > 2:
+            raise PewmaException('ERROR: preclone command has too many arguments')
+
+        (category_to_use, version_to_use, cquery_to_use, template_to_use) = self._parse_category_version_cquery(self.arguments)
+        if category_to_use and version_to_use:
+            (cquery_to_use, template_to_use, self.valid_java_versions) = self._get_category_version_translation(category_to_use, version_to_use)
+        if not cquery_to_use:
+            raise PewmaException('ERROR: the category is missing (can be one of %s)' % ('/'.join(CATEGORIES_AVAILABLE)))
+        self.template_name = 'template_workspace_%s.zip' % (template_to_use,)
+
+        self.setup_workspace()
+        return 1 if self.preclone_repositories(cquery_to_use) else 0
 
 
     def action_materialize(self):
         """ Processes command: materialize <component> [<category> [<version>] | <cquery>]
         """
 
+        (exit_code, components_to_use, cquery_to_use) = self._prepare_materialize()
+        if exit_code:
+            return exit_code
+        if self.snapshot_restored:
+            return self._finish_materialize(components_to_use, cquery_to_use, 0)
+
+        script_commands = self._materialize_script_commands(components_to_use, cquery_to_use)
+        script_file_path_to_pass = self._write_script_file(script_commands)
+
+        # get buckminster to run the materialize(s), rerunning it if it failed only because of transient errors
+        for attempt in range(1, self.options.retry_transient + 2):
+            final_attempt = attempt > self.options.retry_transient
+            start_time = time.time()
+            rc = self.run_buckminster_in_subprocess(('--scriptfile', script_file_path_to_pass), scan_for_materialize_errors=True, scan_compile_messages=False,
+                                                    prepare_jenkins_build_description=final_attempt)
+            scanner = self.buckminster_output_scanner
+            if self.options.retry_transient:
+                self.logger.info('%sMaterialize attempt %s of %s %s in %s' % (self.log_prefix, attempt, self.options.retry_transient + 1,
+                                 'failed (rc=%s)' % (rc,) if rc else 'succeeded', datetime.timedelta(seconds=int(time.time() - start_time))))
+            if (not rc) or final_attempt:
+                break
+            if not self._transient_materialize_failure(scanner):
+                # not retrying after all, so report the failure that was deferred from the attempt
+                text = self._buckminster_errors_build_description(scanner)
+                if text and self.options.prepare_jenkins_build_description_on_error:
+                    print('append-build-description: ' + text)
+                break
+            for repo in sorted(set(scanner.jgit_errors_repos)):
+                partial_clone_loc = os.path.join(self.workspace_git_loc, repo)
+                if os.path.isdir(partial_clone_loc):
+                    self.logger.info('%sDeleting partial clone "%s"' % (self.log_prefix, partial_clone_loc,))
+                    remove_tree(partial_clone_loc)
+            delay = 30 * 2 ** (attempt - 1)
+            failures = ', '.join(sorted(set(scanner.jgit_errors_repos))) or 'intermittent Buckminster bug'
+            self.logger.warn('%sMaterialize failed with transient errors (%s), retrying in %s seconds' % (self.log_prefix, failures, delay))
+            if self.options.prepare_jenkins_build_description_on_error:
+                print('append-build-description: Materialize attempt %s failed (%s), retried' % (attempt, failures))
+            time.sleep(delay)
+
+        if (not rc) and self.snapshot_key:
+            self.save_materialize_snapshot(components_to_use, cquery_to_use)
+        return self._finish_materialize(components_to_use, cquery_to_use, rc)
+
+
+    def _prepare_materialize(self):
+        """ Does everything a materialize needs before Buckminster is run: interprets the arguments, and sets up the workspace
+            Returns (exit code, components to materialize, CQuery to use)
+        """
+
         (components_to_use, category_to_use, version_to_use, cquery_to_use, template_to_use) = self._interpret_components_category_version_cquery()
         if not components_to_use:
-            raise PewmaException('ERROR: materialize command requires the name of the component to materialize')
+            raise PewmaException('ERROR: %s command requires the name of the component to materialize' % (self.action,))
 
-        # create the workspace if required
+        # create the workspace if required (or restore a snapshot of an identical materialize)
         self.template_name = 'template_workspace_%s.zip' % (template_to_use,)
+        if self.options.snapshots:
+            self.delete_workspace_as_requested()  # first, so that we know whether the workspace is to be created afresh
+            if self.restore_materialize_snapshot(components_to_use, cquery_to_use, template_to_use):
+                return (0, components_to_use, cquery_to_use)
         exit_code = self.setup_workspace()
         if exit_code:
             self.logger.info('Abandoning materialize: workspace setup failed')
-            return exit_code
+            return (exit_code, components_to_use, cquery_to_use)
+
+        if self.options.preclone:
+            if self.preclone_repositories(cquery_to_use):
+                self.logger.warn('%sSome repositories could not be pre-cloned, so Buckminster will clone them' % (self.log_prefix,))
 
         # set jvmarg -Declipse.p2.mirrors=false, unless the value has already been set, or unless the CQuery is an old one
         assert cquery_to_use
@@ -1273,34 +4429,38 @@ class PewmaManager(object):
             else:
                 self.options.jvmargs.extend(('-Declipse.p2.mirrors=false',))
 
-        import_commands = ''
+        return (0, components_to_use, cquery_to_use)
+
+
+    def _materialize_script_commands(self, components_to_use, cquery_to_use):
+        """ Returns the Buckminster script commands (a string of lines) to materialize the components
+        """
+
+        script_commands = ''
+        # set preferences
+        maxParallelMaterializations = self.options.maxParallelMaterializations
+        maxParallelResolutions = self.options.maxParallelResolutions
+        if self.options.auto_tune:
+            maxParallelMaterializations = maxParallelMaterializations or self.get_auto_tune_settings()['parallel']
+            maxParallelResolutions = maxParallelResolutions or self.get_auto_tune_settings()['parallel']
+        if maxParallelMaterializations:
+            script_commands += 'setpref maxParallelMaterializations=%s\n' % (maxParallelMaterializations,)
+        if maxParallelResolutions:
+            script_commands += 'setpref maxParallelResolutions=%s\n' % (maxParallelResolutions,)
         for component in components_to_use:
-            import_commands += 'import -Dcomponent=%s ' % (component,)
+            script_commands += 'import -Dcomponent=%s ' % (component,)
             if self.options.download_location:
-                import_commands += '-Ddownload.location.common=%s ' % (self.options.download_location,)
+                script_commands += '-Ddownload.location.common=%s ' % (self.options.download_location,)
             for keyval in self.options.system_property:
-                import_commands += '-D%s ' % (keyval,)
-            import_commands += self._get_full_uri('base/' + cquery_to_use) + '\n'
-        self.logger.info('%sWriting buckminster commands to "%s"' % (self.log_prefix, self.script_file_path,))
-        if not self.options.dry_run:
-            with open(self.script_file_path, 'w') as script_file:
-                script_file.write('### File generated ' + time.strftime("%a, %Y/%m/%d %H:%M:%S %z") +
-                                  ' (' + os.environ.get('BUILD_URL','$BUILD_URL:missing') + ')\n')
-                script_file.write('importproxysettings\n')  # will import proxy settings from Java system properties
-                # set preferences
-                if self.options.maxParallelMaterializations:
-                    script_file.write('setpref maxParallelMaterializations=%s\n' % (self.options.maxParallelMaterializations,))
-                if self.options.maxParallelResolutions:
-                    script_file.write('setpref maxParallelResolutions=%s\n' % (self.options.maxParallelResolutions,))
-                script_file.write(import_commands)
+                script_commands += '-D%s ' % (keyval,)
+            script_commands += self._get_full_uri('base/' + cquery_to_use) + '\n'
+        return script_commands
 
-        if self.isWindows:
-            script_file_path_to_pass = '"%s"' % (self.script_file_path,)
-        else:
-            script_file_path_to_pass = self.script_file_path
 
-        # get buckminster to run the materialize(s)
-        rc = self.run_buckminster_in_subprocess(('--scriptfile', script_file_path_to_pass), scan_for_materialize_errors=True, scan_compile_messages=False)
+    def _finish_materialize(self, components_to_use, cquery_to_use, rc):
+        """ Does everything a materialize needs after Buckminster has run
+            Returns the return code
+        """
 
         self.add_cquery_to_history(cquery_to_use)
         for component in components_to_use:
@@ -1314,94 +4474,52 @@ class PewmaManager(object):
           os.path.join( os.path.abspath(os.path.join(self.workspace_loc, '..')), ''),  # final '' is to make sure the path ends in a /
           'Location of workspace parent directory')
 
-        rc = max(rc, self.action_gerrit_config(check_arguments=False) or 0)
-
-        return rc
-
-
-    def _interpret_components_category_version_cquery(self):
-        """ Processes this part of the arguments: {<component> ...} [<category> [<version>] | <cquery>]
-            (on behalf of "materialize" and "get_branches_expected" commands)
-        """
-
-        if len(self.arguments) < 1:
-            raise PewmaException('ERROR: %s command has too few arguments' % (self.action,))
+        rc = max(rc, self.action_gerrit_config(check_arguments=False) or 0)
+        self._set_linux_group_in_workspace_trees()
 
-        # go through the arguments, and find where the component list ends, which is immediately before the (optional) category/version/cquery
-        # we rely on the fact that no component will ever have the same name as a category name
-        components_to_use_raw = []
-        category_version_cquery = []
-        for index, item in enumerate(self.arguments):
-            if (item in CATEGORIES_AVAILABLE) or (item in VERSIONS_AVAILABLE) or item.endswith('.cquery'):
-                components_to_use_raw = self.arguments[:index]
-                category_version_cquery = self.arguments[index:]
-                break
-        else:
-            components_to_use_raw = self.arguments
-            category_version_cquery = []
+        return rc
 
-        # interpret any (category / category+version / cquery) arguments
-        (category_to_use, version_to_use, cquery_to_use, template_to_use) = self._parse_category_version_cquery(category_version_cquery)
 
-        for component in components_to_use_raw:
-            for (invalid_component_pattern, applicable_versions, error_message) in INVALID_COMPONENTS:
-                if re.match(applicable_versions, version_to_use):
-                    if re.match(invalid_component_pattern, component):
-                        raise PewmaException('ERROR: ' + error_message)
+    def _write_script_file(self, script_commands, script_file_path=None):
+        """ Writes the Buckminster script file (unless this is a dry run), preceded by the standard header
+            script_file_path, if specified, overrides the standard script file location
+            Returns the script file path, quoted if necessary, to pass to run_buckminster_in_subprocess
+        """
 
-        # translate any abbreviated component names to the real component name, and make sure they are all in the same category
-        category_implied = set()
-        components_to_use_translated = []
-        for component_to_use in components_to_use_raw:
-            for abbrev, actual, cat in COMPONENT_ABBREVIATIONS:
-                if component_to_use == abbrev:
-                    if isinstance(actual, basestring):
-                        components_to_use_translated.append(actual)  # replacement is a single item
-                        self.logger.info('%sTranslated "%s" --> component "%s" in category %s' % (self.log_prefix, abbrev, actual, cat))
-                    else:
-                        components_to_use_translated.extend(actual)  # replacement is a tuple of items
-                        self.logger.info('%sTranslated "%s" --> components %s in category %s' % (self.log_prefix, abbrev, tuple(str(a) for a in actual), cat))
-                    category_implied.add(cat)
-                    break
-            else:
-                # component name is specified verbatim
-                components_to_use_translated.append(component_to_use)
-                if component_to_use.endswith(('-config', '-configs', '-clients')) or component_to_use.startswith(('gda','uk.ac.gda.')):
-                    category_implied.add('gda')  # must be a GDA project
+        script_file_path = script_file_path or self.script_file_path
+        self.logger.info('%sWriting buckminster commands to "%s"' % (self.log_prefix, script_file_path,))
+        if not self.options.dry_run:
+            with open(script_file_path, 'w') as script_file:
+                script_file.write('### File generated ' + time.strftime("%a, %Y/%m/%d %H:%M:%S %z") +
+                                  ' (' + os.environ.get('BUILD_URL','$BUILD_URL:missing') + ')\n')
+                script_file.write('importproxysettings\n')  # will import proxy settings from Java system properties
+                script_file.write(script_commands)
 
-        # dedupe components_to_use_translated (preserves order; efficiency doesn't matter since list short)
-        components_to_use = []
-        for c in components_to_use_translated:
-            if c not in components_to_use:
-                components_to_use.append(c)
-            else:
-                self.logger.info('%sComponent "%s" appears in materialize list multiple times - duplicates removed' % (self.log_prefix, c))
-        if components_to_use_raw != components_to_use:
-            self.logger.info('%sComponent(s) to materialize: %s' % (self.log_prefix, tuple(str(c) for c in components_to_use)))
+        if self.isWindows:
+            return '"%s"' % (script_file_path,)
+        return script_file_path
 
-        if len(category_implied) > 1:
-            raise PewmaException('ERROR: the %s components you want to materialize %s come from more than 1 category: %s' %
-                                 (len(components_to_use), components_to_use, [c for c in category_implied]))
 
-        category_implied = tuple(category_implied)
-        category_implied = (category_implied and category_implied[0]) or None
+    def get_component_resolver(self):
+        """ Returns the ComponentResolver, which logs its translations
+        """
 
-        if not category_to_use:
-            category_to_use = category_implied
-        elif category_implied and (category_implied != category_to_use):
-            # if a component abbreviation was provided, it implies a category. If a category was also specified, it must match the implied category
-            raise PewmaException('ERROR: components %s are not consistent with category "%s"' % (components_to_use, category_to_use,))
+        if not hasattr(self, 'component_resolver'):
+            self.component_resolver = ComponentResolver(self.logger, self.log_prefix)
+        return self.component_resolver
 
-        if not (category_to_use or cquery_to_use):
-            raise PewmaException('ERROR: the category is missing (can be one of %s)' % ('/'.join(CATEGORIES_AVAILABLE)))
 
-        if category_to_use and version_to_use:
-            (cquery_to_use_translation, template_to_use, self.valid_java_versions) = self._get_category_version_translation(category_to_use, version_to_use)
-            if not cquery_to_use:
-                cquery_to_use = cquery_to_use_translation
+    def _interpret_components_category_version_cquery(self):
+        """ Processes this part of the arguments: {<component> ...} [<category> [<version>] | <cquery>]
+            (on behalf of "materialize" and "get_branches_expected" commands)
+        """
 
-        assert template_to_use and cquery_to_use
+        if len(self.arguments) < 1:
+            raise PewmaException('ERROR: %s command has too few arguments' % (self.action,))
 
+        (components_to_use, category_to_use, version_to_use, cquery_to_use, template_to_use, valid_java_versions) = self.get_component_resolver().resolve(self.arguments)
+        if valid_java_versions:
+            self.valid_java_versions = valid_java_versions
         return (components_to_use, category_to_use, version_to_use, cquery_to_use, template_to_use)
 
 
@@ -1410,47 +4528,7 @@ class PewmaManager(object):
             (on behalf of "setup" and "materialize" commands)
         """
 
-        category_to_use = None
-        version_to_use = 'master'
-        cquery_to_use = None
-        template_to_use = DEFAULT_TEMPLATE
-
-        # interpret any (category / category version / version / cquery) arguments
-        if arguments_part:
-            category_or_version_or_cquery = arguments_part[0]
-            if category_or_version_or_cquery.endswith('.cquery'):
-                cquery_to_use = category_or_version_or_cquery
-                if len(arguments_part) > 1:
-                    raise PewmaException('ERROR: No other options can follow the CQuery')
-                for c, v, q, t, s, j in [cc for cc in COMPONENT_CATEGORIES if cc[2] == cquery_to_use]:
-                    template_to_use = t
-                    break
-            elif category_or_version_or_cquery in CATEGORIES_AVAILABLE:
-                category_to_use = category_or_version_or_cquery
-                if len(arguments_part) > 1:
-                    version = arguments_part[1].lower()
-                    for c, v, q, t, s, j in [cc for cc in COMPONENT_CATEGORIES if cc[0] == category_to_use]:
-                        if version in s:
-                            version_to_use = v
-                            break
-                    else:
-                        raise PewmaException('ERROR: category "%s" does not have a version "%s"' % (category_to_use, version))
-                    if len(arguments_part) > 2:
-                        raise PewmaException('ERROR: unexpected additional parameters found "%s"' % (arguments_part[2:],))
-            elif category_or_version_or_cquery.lower() in VERSIONS_AVAILABLE:
-                version = category_or_version_or_cquery.lower()
-                for c, v, q, t, s, j in [cc for cc in COMPONENT_CATEGORIES]:
-                    if version in s:
-                        version_to_use = v
-                        break
-                else:
-                    assert False  # should always match
-                if len(arguments_part) > 1:
-                    raise PewmaException('ERROR: unexpected additional parameters found "%s"' % (arguments_part[1:],))
-            else:
-                assert False, 'Internal error in _parse_category_version_cquery: "%s"' % (category_or_version_or_cquery,)
-
-        return (category_to_use, version_to_use, cquery_to_use, template_to_use)
+        return self.get_component_resolver().parse_category_version_cquery(arguments_part)
 
 
     def _get_category_version_translation(self, category, version):
@@ -1460,10 +4538,37 @@ class PewmaManager(object):
                 the allowable java versions
         """
 
-        assert category and version
-        matching_list = [cc for cc in COMPONENT_CATEGORIES if cc[0] == category and cc[1] == version]
-        assert len(matching_list) == 1
-        return [matching_list[0][2], matching_list[0][3], matching_list[0][5]]
+        return self.get_component_resolver().get_category_version_translation(category, version)
+
+
+    def action_resolve_components(self):
+        """ Processes command: resolve-components [<file>]
+            Resolves many component specifications in one run, reading them one per line from the file (or standard input),
+            and writing one JSON object per line to standard output. Returns 1 if any specification could not be resolved.
+        """
+
+        if len(self.arguments) > 1:
+            raise PewmaException('ERROR: resolve-components command has too many arguments')
+        if self.arguments and self.arguments[0] != '-':
+            try:
+                with io.open(self.arguments[0], encoding='utf-8') as spec_file:
+                    lines = spec_file.readlines()
+            except (IOError, OSError) as e:
+                raise PewmaException('ERROR: could not read "%s": %s' % (self.arguments[0], e))
+        else:
+            lines = [line.decode(sys.stdin.encoding or 'utf-8') for line in sys.stdin]
+        specifications = [line.split() for line in lines if line.strip() and not line.lstrip().startswith('#')]
+
+        rc = 0
+        for (arguments, result, error) in ComponentResolver().resolve_many(specifications):
+            record = {'specification': ' '.join(arguments)}
+            if error:
+                record['error'] = error
+                rc = 1
+            else:
+                (record['components'], record['category'], record['version'], record['cquery'], record['template'], _) = result
+            print(json.dumps(record, sort_keys=True))
+        return rc
 
 
     def action_add_diamond_cpython(self):
@@ -1491,6 +4596,8 @@ class PewmaManager(object):
         """ Processes command: add-diamond-cpython <platform>
             (for a single platform only)
         """
+        import tarfile
+        import urllib
         assert pform in [p[0] for p in PLATFORMS_AVAILABLE]
 
         # workspace_git/diamond-cpython.git should already exist
@@ -1552,19 +4659,8 @@ class PewmaManager(object):
         if (not self.workspace_git_loc) or (not os.path.isdir(self.workspace_git_loc)):
             return []
 
-        git_directories = []
-        for root, dirs, files in os.walk(self.workspace_git_loc):
-            if os.path.basename(root) == '.git':
-                raise PewmaException('ERROR: _get_git_directories attempted to recurse into a .git directory: %s' % (root,))
-            if os.path.basename(root).startswith('.'):
-                # don't recurse into hidden directories
-                self.logger.debug('%sSkipping: %s' % (self.log_prefix, root))
-                dirs[:] = []
-                continue
-            if '.git' in dirs:
-                # if this directory is the top level of a git checkout, remember it
-                git_directories.append((os.path.basename(root), os.path.join(self.workspace_git_loc, root)))
-                dirs[:] = []  # do not recurse into this directory
+        git_directories = [(repo_name, os.path.normpath(os.path.join(self.workspace_git_loc, relpath)))
+                           for (repo_name, relpath) in self.get_workspace_git_index()['repositories']]
         assert len(git_directories) == len(set(git_directories))  # should be no duplicates
 
         return git_directories
@@ -1573,15 +4669,13 @@ class PewmaManager(object):
     def action_gerrit_config(self, check_arguments=True):
         """ Processes command: gerrit-config
         """
-
-        NOT_REQUIRED, DONE, FAILED = list(range(3))  # possible status for various configure actions
-        assert NOT_REQUIRED < DONE                   # )
-        assert DONE < FAILED                         # ) we record the highest status, which must therefore be FAILED
-
         if check_arguments and self.arguments:
             raise PewmaException('ERROR: gerrit-config command does not take any arguments')
 
-        self.logger.info('%sLooking for repositories that need switching to Gerrit, and/or configuring for EGit/JGit and git' % (self.log_prefix,))
+        if self.options.verify:
+            self.logger.info('%sChecking that repositories have been switched to Gerrit, and configured for EGit/JGit and git' % (self.log_prefix,))
+        else:
+            self.logger.info('%sLooking for repositories that need switching to Gerrit, and/or configuring for EGit/JGit and git' % (self.log_prefix,))
         rc = 0  # return code, will be 0 or 1
 
         git_directories = self._get_git_directories()
@@ -1589,18 +4683,10 @@ class PewmaManager(object):
             self.logger.info('%sSkipped: %s' % (self.log_prefix, self.workspace_loc + '_git (does not contain any repositories)'))
             return rc
         repo_names = [repo_name for (repo_name, _) in git_directories]
-        prefix= "%%%is: " % max([len(r) for r in repo_names]) if self.options.repo_prefix else ""
 
-        if self.options.repo_includes:
-            repos_included = self.get_items_matching_glob_patterns(repo_names, self.options.repo_includes)
-        else:
-            repos_included = repo_names
-        if self.options.repo_excludes:
-            repos_excluded = self.get_items_matching_glob_patterns(repo_names, self.options.repo_excludes)
-        else:
-            repos_excluded = []
-        selected_repos = sorted(set(repos_included) - set(repos_excluded))
+        selected_repos = self.get_selected_repo_names(repo_names)
 
+        repos_to_process = []  # list of (repo_name, git_dir), in sorted order
         for (repo_name, git_dir) in sorted(git_directories):
             if repo_name not in GERRIT_REPOSITORIES:
                 # self.logger.debug('%sSkipped: not in Gerrit: %s' % (self.log_prefix, git_dir))
@@ -1608,176 +4694,189 @@ class PewmaManager(object):
             if repo_name not in selected_repos:
                 self.logger.debug('%sSkipped: does not satisfy --repo-include/--repo-exclude: %s' % (self.log_prefix, git_dir))
                 continue
-            config_file_loc = os.path.join(git_dir, '.git', 'config')
-            if not os.path.isfile(config_file_loc):
-                self.logger.error('%sSkipped: %s should exist, but does not' % (self.log_prefix, config_file_loc))
-                rc = 1  # when we're finished, exit with return code 1 to indicate an error
-                continue
+            repos_to_process.append((repo_name, git_dir))
 
-            #####################################################
-            # parse and potentially update the .git/config file #
-            #####################################################
-            config = GitConfigParser()
-            config.readgit(config_file_loc)
-            try:
-                origin_url = config.get('remote "origin"', 'url')
-            except (ConfigParser.NoSectionError, ConfigParser.NoOptionError):
-                self.logger.warn('%sSkipped: no [remote "origin"]: %s' % (self.log_prefix, config_file_loc))
-                continue
+        # the work for each repository is independent, so can be done concurrently
+        repo_rcs = map_concurrently(lambda repo: self._gerrit_config_one_repo(*repo), repos_to_process, self.options.git_jobs or 1)
 
-            # origin_url can be ssh or https. ssh might or might not include a username. server might be gerrit or gerritbeta
-            # examples:
-            # ssh://mwebber@gerritbeta.diamond.ac.uk:29418/gda/gda-core.git
-            # ssh://gerrit.diamond.ac.uk:29418/gda/gda-core.git
-            # https://gerrit.diamond.ac.uk:29418/gda/gda-core.git
-
-            # get the current branch (so we can set up the push branch correctly)
-            # the HEAD file contains one line which looks like "ref: refs/heads/gda-9.8" (probably)
-            HEAD_file_loc = os.path.join(git_dir, '.git', 'HEAD')
-            if not os.path.isfile(HEAD_file_loc):
-                self.logger.error('%sSkipped: %s should exist, but does not' % (self.log_prefix, HEAD_file_loc))
-                rc = 1  # when we're finished, exit with return code 1 to indicate an error
-                continue
-            current_branch = 'master'  # in case of problems parsing HEAD file
-            with open(HEAD_file_loc, 'r') as HEAD_file:
-                for line in HEAD_file:
-                    current_branch = (line.rsplit('/')[-1] or 'master').strip()  # strip() to get rid of newline
-                    break
+        return max([rc] + repo_rcs)
 
-            gerrit_repo_details = GERRIT_REPOSITORIES[repo_name]
-            gerrit_repo_url_path = gerrit_repo_details['url_part']
-
-            # this repo might have been cloned before the repo was moved to Gerrit
-            # In that case, change the upstream to point to Gerrit (unless keep_origin == True)
-            if all(g not in origin_url for g in ('gerrit.diamond.ac.uk', 'gerritbeta.diamond.ac.uk')):
-                if gerrit_repo_details.get('keep_origin'):
-                    if repo_name in ('dawnsci.git', 'gda-mt.git'):
-                        if (current_branch.startswith(('gda-9.8', 'gda-9.7', 'gda-9.6', 'gda-9.5', 'gda-9.4', 'gda-9.3', 'gda-9.2', 'gda-9.1', 'gda-9.0', 'dawn-'))
-                            or
-                            ((repo_name == 'gda-mt.git') and current_branch.startswith(('gda-9.9',)))):
-                            self.logger.info('%sSkipped: did not change remote origin to Gerrit, since old branch (%s) can use pre-Gerrit remote: %s' % (self.log_prefix, current_branch, git_dir))
-                        else:
-                            self.logger.error('%sSkipped: unable to change remote origin to Gerrit, requires a fresh clone: %s' % (self.log_prefix, git_dir))
-                            rc = 1
-                        continue
-                    else:
-                        raise PewmaException('ERROR: internal bug: keep_origin not handled for ' + repo_name)
-                if gerrit_repo_details.get('must_use_ssh'):
-                    gerrit_repo_url_pull = GERRIT_URI_SSH + gerrit_repo_url_path
-                else:
-                    gerrit_repo_url_pull = GERRIT_URI_HTTPS + gerrit_repo_url_path  # the default scheme for all repos unless they are private, and need SSH
-                config_changes = [
-                # section         , option          , name                   , required_value                   , action_if_already_exists
-                ('remote "origin"', 'url'           , 'remote.origin.url'    , gerrit_repo_url_pull             , 'replace'),]
 
-                # set push URL
-                gerrit_repo_url_push = GERRIT_URI_SSH + gerrit_repo_url_path  # push is always authenticated, i.e. SSH
+    def _gerrit_config_one_repo(self, repo_name, git_dir):
+        """ Switches one repository to Gerrit, and configures it for EGit/JGit and git (or with --verify, checks that has been done)
+            Returns 0 if OK, 1 if there was an error
+        """
 
-            else:
-                config_changes = []
-                # set push URL
-                if origin_url.startswith('ssh://'):
-                    gerrit_repo_url_push = origin_url
-                elif origin_url.startswith('https://'):
-                    origin_url_parts = origin_url[8:].split('/',1)
-                    gerrit_repo_url_push = 'ssh://' + origin_url_parts[0] + ':29418/' + origin_url_parts[1]  # works for both gerrit and gerritbeta
-                else:
-                    raise PewmaException('ERROR: internal bug: ' + repo_name + ' has unrecognised URI scheme in ' + origin_url)
-
-            config_changes.extend((
-                # section         , option          , name                   , required_value                   , action_if_already_exists
-                ('gerrit'         , 'createchangeid', 'gerrit.createchangeid', 'true'                           , 'replace'),
-                ('remote "origin"', 'fetch'         , 'remote.origin.fetch'  , 'refs/notes/*:refs/notes/*'      , 'append'),
-                ('remote "origin"', 'pushurl'       , 'remote.origin.pushurl', gerrit_repo_url_push             , 'append'),
-                ('remote "origin"', 'push'          , 'remote.origin.push'   , 'HEAD:refs/for/' + current_branch, 'keep'),
-                ('merge'          , 'log'           , 'merge.log'            , '50'                             , 'replace'),
-                # the following 2 options commented out, since command line git works correctly,
-                # however JGit does not support pull.ff (see https://bugs.eclipse.org/bugs/show_bug.cgi?id=474174)
-                ### ('merge'          , 'ff'            , 'merge.ff'             , 'false'                          , True),  # merges from branches should not fast-forward
-                ### # NB: if you have merge.ff=false, you also need pull.ff=true, so that you do not get a merge commit on every pull!
-                ### ('pull'           , 'ff'            , 'pull.ff'              , 'true'                           , True),  # pulls should fast-forward if possible
-                ),)
-
-            git_config_commands = []
-            for (section, option, name, required_value, action_if_already_exists) in config_changes:
-                self.logger.debug('%sProcessing: %s in: %s' % (self.log_prefix, (section, option, name, required_value, action_if_already_exists), git_dir))
-                try:
-                    option_value = config.get(section, option)
-                    self.logger.debug('%sGot: %s=%s' % (self.log_prefix, option, option_value))
+        NOT_REQUIRED, DONE, FAILED = list(range(3))  # possible status for various configure actions
+        assert NOT_REQUIRED < DONE                   # )
+        assert DONE < FAILED                         # ) we record the highest status, which must therefore be FAILED
+
+        rc = 0
+        config_file_loc = os.path.join(git_dir, '.git', 'config')
+        if not os.path.isfile(config_file_loc):
+            self.logger.error('%sSkipped: %s should exist, but does not' % (self.log_prefix, config_file_loc))
+            return 1  # when we're finished, exit with return code 1 to indicate an error
+
+        #####################################################
+        # parse and potentially update the .git/config file #
+        #####################################################
+        config = GitConfigFile(config_file_loc)
+        origin_url = config.get('remote.origin.url')
+        if origin_url is None:
+            self.logger.warn('%sSkipped: no [remote "origin"]: %s' % (self.log_prefix, config_file_loc))
+            return rc
 
-                except (ConfigParser.NoSectionError, ConfigParser.NoOptionError):
-                    git_config_commands.append('git config -f %s %s %s' % (config_file_loc, name, required_value))
+        # origin_url can be ssh or https. ssh might or might not include a username. server might be gerrit or gerritbeta
+        # examples:
+        # ssh://mwebber@gerritbeta.diamond.ac.uk:29418/gda/gda-core.git
+        # ssh://gerrit.diamond.ac.uk:29418/gda/gda-core.git
+        # https://gerrit.diamond.ac.uk:29418/gda/gda-core.git
+
+        # get the current branch (so we can set up the push branch correctly)
+        # the HEAD file contains one line which looks like "ref: refs/heads/gda-9.8" (probably)
+        HEAD_file_loc = os.path.join(git_dir, '.git', 'HEAD')
+        if not os.path.isfile(HEAD_file_loc):
+            self.logger.error('%sSkipped: %s should exist, but does not' % (self.log_prefix, HEAD_file_loc))
+            return 1  # when we're finished, exit with return code 1 to indicate an error
+        current_branch = 'master'  # in case of problems parsing HEAD file
+        with open(HEAD_file_loc, 'r') as HEAD_file:
+            for line in HEAD_file:
+                current_branch = (line.rsplit('/')[-1] or 'master').strip()  # strip() to get rid of newline
+                break
 
-                else:
-                    if option_value != required_value:
-                        if action_if_already_exists == 'append':
-                            git_config_commands.append('git config -f %s --add %s %s' % (config_file_loc, name, required_value))
-                        elif action_if_already_exists == 'replace':
-                            git_config_commands.append('git config -f %s %s %s' % (config_file_loc, name, required_value))
-                        else:
-                            self.logger.log(5, '%sSkipped: already have %s=%s in: %s' % (self.log_prefix, name, option_value, git_dir))
+        gerrit_repo_details = GERRIT_REPOSITORIES[repo_name]
+        gerrit_repo_url_path = gerrit_repo_details['url_part']
+
+        # this repo might have been cloned before the repo was moved to Gerrit
+        # In that case, change the upstream to point to Gerrit (unless keep_origin == True)
+        if all(g not in origin_url for g in ('gerrit.diamond.ac.uk', 'gerritbeta.diamond.ac.uk')):
+            if gerrit_repo_details.get('keep_origin'):
+                if repo_name in ('dawnsci.git', 'gda-mt.git'):
+                    if (current_branch.startswith(('gda-9.8', 'gda-9.7', 'gda-9.6', 'gda-9.5', 'gda-9.4', 'gda-9.3', 'gda-9.2', 'gda-9.1', 'gda-9.0', 'dawn-'))
+                        or
+                        ((repo_name == 'gda-mt.git') and current_branch.startswith(('gda-9.9',)))):
+                        self.logger.info('%sSkipped: did not change remote origin to Gerrit, since old branch (%s) can use pre-Gerrit remote: %s' % (self.log_prefix, current_branch, git_dir))
                     else:
-                        self.logger.log(5, '%sSkipped: already have %s=%s in: %s' % (self.log_prefix, name, required_value, git_dir))
+                        self.logger.error('%sSkipped: unable to change remote origin to Gerrit, requires a fresh clone: %s' % (self.log_prefix, git_dir))
+                        rc = 1
+                    return rc
+                else:
+                    raise PewmaException('ERROR: internal bug: keep_origin not handled for ' + repo_name)
+            if gerrit_repo_details.get('must_use_ssh'):
+                gerrit_repo_url_pull = GERRIT_URI_SSH + gerrit_repo_url_path
+            else:
+                gerrit_repo_url_pull = GERRIT_URI_HTTPS + gerrit_repo_url_path  # the default scheme for all repos unless they are private, and need SSH
+            config_changes = [
+            # name                   , required_value                   , action_if_already_exists
+            ('remote.origin.url'    , gerrit_repo_url_pull             , 'replace'),]
 
-            repo_status = {'switched_remote_to_gerrit': NOT_REQUIRED, 'configured_for_eclipse': NOT_REQUIRED, 'hook_added': NOT_REQUIRED}
+            # set push URL
+            gerrit_repo_url_push = GERRIT_URI_SSH + gerrit_repo_url_path  # push is always authenticated, i.e. SSH
 
-            for command in git_config_commands:
-                self.logger.debug('%sRunning: %s' % (self.log_prefix, command))
-                action_type = 'switched_remote_to_gerrit' if 'remote.origin.url' in command else 'configured_for_eclipse'
-                status = DONE  # for dry run, pretend the operation succeeded
-                if not self.options.dry_run:
-                    try:
-                        if not self.isWindows:
-                            retcode = subprocess.call(shlex.split(str(command)), shell=False)
-                        else:
-                            retcode = subprocess.call(command, shell=True)
-                    except (OSError,) as e:
-                        if e.errno == errno.ENOENT:
-                            possible_cause = ' (does the "git" command exist?)'
-                        else:
-                            possible_cause = ''
-                        self.logger.error('%sError "%s" %s' % (self.log_prefix, e, possible_cause))
-                        status = FAILED
-                    else:
-                        if retcode:
-                            self.logger.error('%sError rc=%s attempting "%s"' % (self.log_prefix, retcode, command))
-                            status = FAILED
-                repo_status[action_type] = max(repo_status[action_type], status)  # FAILED is the highest status, since we want to know if _any_ failed
-
-            #############################################################################
-            # get the commit hook, for people who use command line Git rather than EGit #
-            #############################################################################
-
-            hooks_loc = os.path.join(git_dir, '.git', 'hooks')
-            hooks_commit_msg_loc = os.path.join(hooks_loc, 'commit-msg')
-            if os.path.exists(hooks_commit_msg_loc):
-                self.logger.debug('%scommit-msg hook already set up: %s' % (self.log_prefix, hooks_commit_msg_loc))
+        else:
+            config_changes = []
+            # set push URL
+            if origin_url.startswith('ssh://'):
+                gerrit_repo_url_push = origin_url
+            elif origin_url.startswith('https://'):
+                origin_url_parts = origin_url[8:].split('/',1)
+                gerrit_repo_url_push = 'ssh://' + origin_url_parts[0] + ':29418/' + origin_url_parts[1]  # works for both gerrit and gerritbeta
             else:
-                if not os.path.isdir(hooks_loc):
-                    self.logger.info('%screating repository hooks directory: %s' % (self.log_prefix, hooks_loc))
-                    os.mkdir(hooks_loc, 0775)
-                commit_hook = self.gerrit_commit_hook()
-                if not self.options.dry_run:
-                    with open(hooks_commit_msg_loc, 'w') as commit_msg_file:
-                        commit_msg_file.write(commit_hook)
-                    os.chmod(hooks_commit_msg_loc, 0o775)  # rwxrwxr-x
-                self.logger.debug('%scommit-msg hook copied to: %s' % (self.log_prefix, hooks_commit_msg_loc))
-                repo_status['hook_added'] = DONE
+                raise PewmaException('ERROR: internal bug: ' + repo_name + ' has unrecognised URI scheme in ' + origin_url)
+
+        config_changes.extend((
+            # name                   , required_value                   , action_if_already_exists
+            ('gerrit.createchangeid', 'true'                           , 'replace'),
+            ('remote.origin.fetch'  , 'refs/notes/*:refs/notes/*'      , 'append'),
+            ('remote.origin.pushurl', gerrit_repo_url_push             , 'append'),
+            ('remote.origin.push'   , 'HEAD:refs/for/' + current_branch, 'keep'),
+            ('merge.log'            , '50'                             , 'replace'),
+            # the following 2 options commented out, since command line git works correctly,
+            # however JGit does not support pull.ff (see https://bugs.eclipse.org/bugs/show_bug.cgi?id=474174)
+            ### ('merge.ff'             , 'false'                          , True),  # merges from branches should not fast-forward
+            ### # NB: if you have merge.ff=false, you also need pull.ff=true, so that you do not get a merge commit on every pull!
+            ### ('pull.ff'              , 'true'                           , True),  # pulls should fast-forward if possible
+            ),)
+
+        repo_status = {'switched_remote_to_gerrit': NOT_REQUIRED, 'configured_for_eclipse': NOT_REQUIRED, 'hook_added': NOT_REQUIRED}
+
+        # all the changes are made to the in-memory copy of the file, which is then written back once
+        for (name, required_value, action_if_already_exists) in config_changes:
+            self.logger.debug('%sProcessing: %s in: %s' % (self.log_prefix, (name, required_value, action_if_already_exists), git_dir))
+            action_type = 'switched_remote_to_gerrit' if name == 'remote.origin.url' else 'configured_for_eclipse'
+            option_values = config.get_all(name)
+            self.logger.debug('%sGot: %s=%s' % (self.log_prefix, name, option_values))
+            if required_value in option_values:
+                self.logger.log(5, '%sSkipped: already have %s=%s in: %s' % (self.log_prefix, name, required_value, git_dir))
+                continue
+            if option_values and (action_if_already_exists == 'keep'):
+                self.logger.log(5, '%sSkipped: already have %s=%s in: %s' % (self.log_prefix, name, option_values[-1], git_dir))
+                continue
+            if self.options.verify:
+                self.logger.error('%sNot configured: %s should be %s (is %s) in: %s' %
+                                  (self.log_prefix, name, required_value, ', '.join(option_values) or '<not set>', git_dir))
+                rc = 1
+                continue
+            self.logger.debug('%sSetting: %s %s%s in: %s' % (self.log_prefix, name, ('', '--add ')[bool(option_values) and action_if_already_exists == 'append'], required_value, git_dir))
+            if option_values and (action_if_already_exists == 'append'):
+                config.add(name, required_value)
+                status = DONE
+            elif config.set(name, required_value):
+                status = DONE
+            else:
+                self.logger.error('%sError: %s has multiple values, so cannot be replaced, in: %s' % (self.log_prefix, name, git_dir))
+                status = FAILED
+            repo_status[action_type] = max(repo_status[action_type], status)  # FAILED is the highest status, since we want to know if _any_ failed
 
-            if all(status == NOT_REQUIRED for status in list(repo_status.values())):
+        if config.changed and not self.options.dry_run:
+            try:
+                config.write()
+            except (IOError, OSError) as e:
+                self.logger.error('%sError "%s" writing %s' % (self.log_prefix, e, config_file_loc))
+                for action_type in ('switched_remote_to_gerrit', 'configured_for_eclipse'):
+                    if repo_status[action_type] == DONE:
+                        repo_status[action_type] = FAILED
+
+        #############################################################################
+        # get the commit hook, for people who use command line Git rather than EGit #
+        #############################################################################
+
+        hooks_loc = os.path.join(git_dir, '.git', 'hooks')
+        hooks_commit_msg_loc = os.path.join(hooks_loc, 'commit-msg')
+        if os.path.exists(hooks_commit_msg_loc):
+            self.logger.debug('%scommit-msg hook already set up: %s' % (self.log_prefix, hooks_commit_msg_loc))
+        elif self.options.verify:
+            self.logger.error('%sNot configured: no commit-msg hook in: %s' % (self.log_prefix, git_dir))
+            rc = 1
+        else:
+            if not os.path.isdir(hooks_loc):
+                self.logger.info('%screating repository hooks directory: %s' % (self.log_prefix, hooks_loc))
+                os.mkdir(hooks_loc, 0775)
+            commit_hook = self.gerrit_commit_hook()
+            if not self.options.dry_run:
+                with open(hooks_commit_msg_loc, 'w') as commit_msg_file:
+                    commit_msg_file.write(commit_hook)
+                os.chmod(hooks_commit_msg_loc, 0o775)  # rwxrwxr-x
+            self.logger.debug('%scommit-msg hook copied to: %s' % (self.log_prefix, hooks_commit_msg_loc))
+            repo_status['hook_added'] = DONE
+
+        if all(status == NOT_REQUIRED for status in list(repo_status.values())):
+            if self.options.verify and not rc:
+                self.logger.debug('%sVerified: switched to Gerrit; configured for EGit/JGit and git: %s' % (self.log_prefix, git_dir))
+            elif not rc:
                 self.logger.debug('%sSkipped: already switched to Gerrit; configured for EGit/JGit and git: %s' % (self.log_prefix, git_dir))
-            else:
-                for (action, message) in (('switched_remote_to_gerrit', 'switch remote.origin.url to Gerrit'),
-                                          ('configured_for_eclipse'   , 'configure repository for EGit/JGit'),
-                                          ('hook_added'               , 'add Gerrit commit-msg hook for git'),
-                                         ):
-                    if repo_status[action] == NOT_REQUIRED:
-                        self.logger.debug('%sDone previously: %s: %s' % (self.log_prefix, message, git_dir))
-                    elif repo_status[action] == DONE:
-                        self.logger.info('%sDone: %s: %s' % (self.log_prefix, message, git_dir))
-                    elif repo_status[action] == FAILED:
-                        self.logger.error('%sFailed: %s: %s' % (self.log_prefix, message, git_dir))
-                        rc = 1
+        else:
+            for (action, message) in (('switched_remote_to_gerrit', 'switch remote.origin.url to Gerrit'),
+                                      ('configured_for_eclipse'   , 'configure repository for EGit/JGit'),
+                                      ('hook_added'               , 'add Gerrit commit-msg hook for git'),
+                                     ):
+                if repo_status[action] == NOT_REQUIRED:
+                    self.logger.debug('%sDone previously: %s: %s' % (self.log_prefix, message, git_dir))
+                elif repo_status[action] == DONE:
+                    self.logger.info('%sDone: %s: %s' % (self.log_prefix, message, git_dir))
+                elif repo_status[action] == FAILED:
+                    self.logger.error('%sFailed: %s: %s' % (self.log_prefix, message, git_dir))
+                    rc = 1
 
         return rc
 
@@ -1795,17 +4894,10 @@ class PewmaManager(object):
         repo_names = [repo_name for (repo_name, _) in git_directories]
         prefix= "%%%is: " % max([len(r) for r in repo_names]) if self.options.repo_prefix else ""
 
-        if self.options.repo_includes:
-            repos_included = self.get_items_matching_glob_patterns(repo_names, self.options.repo_includes)
-        else:
-            repos_included = repo_names
-        if self.options.repo_excludes:
-            repos_excluded = self.get_items_matching_glob_patterns(repo_names, self.options.repo_excludes)
-        else:
-            repos_excluded = []
-        selected_repos = sorted(set(repos_included) - set(repos_excluded))
+        selected_repos = self.get_selected_repo_names(repo_names)
 
-        return_code_count = {}  # dictionary with key=return_code, value=repositories it occurred in
+        git_command = 'git ' + ' '.join(self.arguments)
+        repos_to_process = []  # list of (repo_name, git_dir), in sorted order
         for (repo_name, git_dir) in sorted(git_directories):
             if self.options.non_gerrit_only:
                 if repo_name in GERRIT_REPOSITORIES:
@@ -1819,7 +4911,6 @@ class PewmaManager(object):
                 self.logger.debug('%sSkipped: does not satisfy --repo-include/--repo-exclude: %s' % (self.log_prefix, git_dir))
                 continue
 
-            git_command = 'git ' + ' '.join(self.arguments)
             if (git_command.strip() in ('git pull', 'git fetch')) or git_command.startswith(('git pull ', 'git fetch ')):
                 # don't attempt a "git pull" or "git fetch" if no upstream defined
                 has_remote = False
@@ -1833,8 +4924,10 @@ class PewmaManager(object):
                 if not has_remote:
                     self.logger.warn('%sSkipped: %s in %s (NO REMOTE DEFINED)' % (self.log_prefix, git_command, git_dir))
                     continue
+            repos_to_process.append((repo_name, git_dir))
 
-            retcode = self._one_git_repo(git_command, git_dir, prefix)
+        return_code_count = {}  # dictionary with key=return_code, value=repositories it occurred in
+        for (repo_name, retcode) in self._run_git_in_repos(git_command, repos_to_process, prefix):
             if not self.options.quiet:
                 print()  # empty line after each repo to make the output more human-readable
             if retcode in return_code_count:
@@ -1857,6 +4950,28 @@ class PewmaManager(object):
         return max_rc
 
 
+    def _run_git_in_repos(self, command, repos, prefix):
+        """ Runs the git command in each of the repositories, a list of (repo_name, git_dir)
+            With --jobs > 1, the commands are run concurrently, but the output is still printed in the order of the list
+            Yields (repo_name, return code) for each repository, in list order
+        """
+        jobs = min(self.options.git_jobs or 1, len(repos))
+        if (jobs <= 1) or self.options.dry_run:
+            for (repo_name, git_dir) in repos:
+                yield (repo_name, self._one_git_repo(command, git_dir, prefix))
+            return
+
+        self.logger.debug('%sRunning "%s" in %s repositories, %s at a time' % (self.log_prefix, command, len(repos), jobs))
+        sys.stdout.flush()
+        sys.stderr.flush()
+        # the results come in the same order as the input, whatever order they complete in
+        results = imap_concurrently(lambda repo: self._run_git_command(command, repo[1]), repos, jobs)
+        for ((repo_name, git_dir), (out, err, retcode)) in zip(repos, results):
+            if not self.options.quiet:
+                self.logger.info('%sRunning: %s in %s' % (self.log_prefix, command, git_dir))
+            yield (repo_name, self._print_git_output(command, git_dir, prefix, out, err, retcode))
+
+
     def _one_git_repo(self, command, directory, prefix):
         if not self.options.quiet:
             self.logger.info('%sRunning: %s in %s' % (self.log_prefix, command, directory))
@@ -1864,54 +4979,73 @@ class PewmaManager(object):
         if not self.options.dry_run:
             sys.stdout.flush()
             sys.stderr.flush()
-            try:
-                # set environment variables to pass to git command extensions
-                os.environ['PEWMA_PY_WORKSPACE_GIT_LOC'] = self.workspace_git_loc
-                if sys.stdin.encoding is not None:
-                    os.environ['PEWMA_PY_COMMAND'] = command.encode(sys.stdin.encoding)
-                    os.environ['PEWMA_PY_DIRECTORY'] = directory.encode(sys.stdin.encoding)
-                else:
-                    os.environ['PEWMA_PY_COMMAND'] = str(command)
-                    os.environ['PEWMA_PY_DIRECTORY'] = str(directory)
-                process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True, cwd=directory)
-                out, err = process.communicate()
-                out, err = out.rstrip(), err.rstrip()
-                retcode = process.returncode
-            except OSError:
-                raise PewmaException('ERROR: "%s" failed in %s: %s' % (command, directory, sys.exc_info()[1],))
+            (out, err, retcode) = self._run_git_command(command, directory)
+            return self._print_git_output(command, directory, prefix, out, err, retcode)
 
-            if self.options.repo_prefix:
-                if len(out)!=0 or len(err)!=0:
-                    print(prefix % os.path.basename(directory).strip(), end='')
-                    try:
-                        if ((len(out) and len(err)) or              # if both out and err
-                            (('\n' in out) or ('\r' in out)) or     # if out is multiline
-                            (('\n' in err) or ('\r' in err))):      # if err is multiline
-                            print("...")                            # start it on a new line
-                    except UnicodeDecodeError:
-                        if (len(out)>100) or (len(err)>100):
-                            print("...")                            # start it on a new line
-            if err:
-                print(err, file=sys.stderr)
-            if out:
-                if self.options.max_git_output > 0:
-                    print(out[0:self.options.max_git_output])
-                    if len(out) > self.options.max_git_output:
-                        print('... truncated "', command, '" in ',os.path.basename(directory).strip(), ' ...', sep='')
-                else:
-                    print(out)
-            sys.stderr.flush()
-            sys.stdout.flush()
-            if retcode:
-                self.logger.error('Return Code: %s running: %s in %s'% (retcode, command, directory))
+
+    def _run_git_command(self, command, directory):
+        """ Runs a git command in one repository, capturing the output
+            Returns (stdout, stderr, return code)
+            (safe to call from multiple threads at once, so does not write any output or change os.environ)
+        """
+
+        try:
+            # set environment variables to pass to git command extensions
+            env = dict(os.environ)
+            env['PEWMA_PY_WORKSPACE_GIT_LOC'] = self.workspace_git_loc
+            if sys.stdin.encoding is not None:
+                env['PEWMA_PY_COMMAND'] = command.encode(sys.stdin.encoding)
+                env['PEWMA_PY_DIRECTORY'] = directory.encode(sys.stdin.encoding)
             else:
-                self.logger.debug('Return Code: %s' % (retcode,))
-            return retcode
+                env['PEWMA_PY_COMMAND'] = str(command)
+                env['PEWMA_PY_DIRECTORY'] = str(directory)
+            process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True, cwd=directory, env=env)
+            out, err = process.communicate()
+            out, err = out.rstrip(), err.rstrip()
+            retcode = process.returncode
+        except OSError:
+            raise PewmaException('ERROR: "%s" failed in %s: %s' % (command, directory, sys.exc_info()[1],))
+        return (out, err, retcode)
+
+
+    def _print_git_output(self, command, directory, prefix, out, err, retcode):
+        """ Prints the captured output of a git command in one repository
+            Returns the return code
+        """
+
+        if self.options.repo_prefix:
+            if len(out)!=0 or len(err)!=0:
+                print(prefix % os.path.basename(directory).strip(), end='')
+                try:
+                    if ((len(out) and len(err)) or              # if both out and err
+                        (('\n' in out) or ('\r' in out)) or     # if out is multiline
+                        (('\n' in err) or ('\r' in err))):      # if err is multiline
+                        print("...")                            # start it on a new line
+                except UnicodeDecodeError:
+                    if (len(out)>100) or (len(err)>100):
+                        print("...")                            # start it on a new line
+        if err:
+            print(err, file=sys.stderr)
+        if out:
+            if self.options.max_git_output > 0:
+                print(out[0:self.options.max_git_output])
+                if len(out) > self.options.max_git_output:
+                    print('... truncated "', command, '" in ',os.path.basename(directory).strip(), ' ...', sep='')
+            else:
+                print(out)
+        sys.stderr.flush()
+        sys.stdout.flush()
+        if retcode:
+            self.logger.error('Return Code: %s running: %s in %s'% (retcode, command, directory))
+        else:
+            self.logger.debug('Return Code: %s' % (retcode,))
+        return retcode
 
 
     def action_clean(self):
         """ Processes command: clean
         """
+        self.forget_build_fingerprint()
         return self.run_buckminster_in_subprocess(('clean',), scan_for_materialize_errors=False, scan_compile_messages=False)
 
 
@@ -1956,33 +5090,130 @@ class PewmaManager(object):
 
     def _action_build(self, thorough):
         """ Processes command: build
+            An incremental build is skipped if nothing has changed since the last successful build (unless --force);
+            a thorough build never is, since it is often run to recover from build state that the fingerprint does not cover
         """
 
-        self.logger.info('Writing buckminster commands to "%s"' % (self.script_file_path,))
-        with open(self.script_file_path, 'w') as script_file:
-            script_file.write('### File generated ' + time.strftime("%a, %Y/%m/%d %H:%M:%S %z") +
-                              ' (' + os.environ.get('BUILD_URL','$BUILD_URL:missing') + ')\n')
-            script_file.write('importproxysettings\n')  # will import proxy settings from Java system properties
-            if thorough:
-                script_file.write('build --thorough\n')
-            else:
-                script_file.write('build\n')
+        fingerprint = self.get_build_fingerprint()
+        if fingerprint and (not thorough) and (not self.options.force) and (fingerprint == self.read_build_fingerprint()):
+            self.logger.info('%sSkipping the build, since nothing in "%s" has changed since the last successful build (use --force to build anyway)' %
+                             (self.log_prefix, self.workspace_git_loc))
+            return
+        self.forget_build_fingerprint()  # in case the build fails, or is interrupted
+
+        script_file_path_to_pass = self._write_script_file(('build\n', 'build --thorough\n')[thorough])
 
         # if the workspace has a settings file specifically for Eclipse Mars (which is what Buckminster is), use that.
         mars_settings_file_status = self._switch_mars_settings_file_in()
         if mars_settings_file_status > 1:
             return mars_settings_file_status
 
-        if self.isWindows:
-            script_file_path_to_pass = '"%s"' % (self.script_file_path,)
-        else:
-            script_file_path_to_pass = self.script_file_path
         bm_exit_code =  self.run_buckminster_in_subprocess(('--scriptfile', script_file_path_to_pass), scan_for_materialize_errors=False, scan_compile_messages=True)
 
         if mars_settings_file_status:
-            return self._switch_mars_settings_file_out() or bm_exit_code
-        else:
-            return bm_exit_code
+            bm_exit_code = self._switch_mars_settings_file_out() or bm_exit_code
+        if fingerprint and not bm_exit_code:
+            self.record_build_fingerprint(fingerprint)  # as it was before the build, so that any changes made during the build are built next time
+        return bm_exit_code
+
+
+    def get_build_fingerprint(self):
+        """ Returns a fingerprint of what the workspace is built from: the HEAD commit of each repository in workspace_git, plus
+            the path, mtime and size of each file that "git status" reports as changed or untracked (got for several repositories
+            at a time), the projects imported into the workspace, and the -D properties
+            Returns None if it could not be determined for any repository
+        """
+        if self.options.dry_run or not os.path.isdir(self.workspace_git_loc):
+            return None
+
+        def repository_fingerprint(repository):
+            (repo_name, repo_relpath) = repository
+            repo_loc = os.path.join(self.workspace_git_loc, repo_relpath)
+            git_command = ('git', '--git-dir', os.path.join(repo_loc, '.git'), '--work-tree', repo_loc)
+            (head, retcode) = self._run_native_git(git_command + ('rev-parse', '--verify', 'HEAD'))
+            if retcode:
+                self.logger.debug('%sCould not determine the HEAD of %s: %s' % (self.log_prefix, repo_name, head))
+                return None
+            (status, error, retcode) = self._run_native_git_raw(git_command + ('status', '--porcelain', '-z', '--untracked-files=all'))
+            if retcode:
+                self.logger.debug('%sCould not get the status of %s: %s' % (self.log_prefix, repo_name, error))
+                return None
+            digest = hashlib.sha256(('%s\n%s\n' % (repo_relpath, head)).encode('utf-8'))
+            entries = status.split(b'\0')
+            while entries:
+                entry = entries.pop(0)
+                if not entry:
+                    continue
+                if entry[:1] in (b'R', b'C'):
+                    entries.pop(0)  # a rename or copy is followed by the original path
+                path = entry[3:]
+                try:
+                    file_stat = os.lstat(os.path.join(repo_loc, path))
+                    file_state = b'%r %d' % (file_stat.st_mtime, file_stat.st_size)
+                except OSError:
+                    file_state = b'missing'
+                digest.update(entry[:3] + path + b'\0' + file_state + b'\n')
+            return digest.hexdigest()
+
+        repositories = self.get_workspace_git_index()['repositories']
+        repository_fingerprints = map_concurrently(repository_fingerprint, repositories, self.options.git_jobs or REPOSITORY_JOBS)
+        if None in repository_fingerprints:
+            return None
+
+        projects_imported_dir = os.path.join(self.workspace_loc, '.metadata', '.plugins', 'org.eclipse.core.resources', '.projects')
+        projects_imported = sorted(os.listdir(projects_imported_dir)) if os.path.isdir(projects_imported_dir) else []
+        lines = ['format=%s' % (BUILD_FINGERPRINT_FORMAT,),
+                 'properties=%s' % (','.join(sorted(self.options.system_property)),),
+                 'projects=%s' % (','.join(projects_imported),),
+                 ] + repository_fingerprints
+        return hashlib.sha256('\n'.join(lines).encode('utf-8')).hexdigest()
+
+
+    def _get_build_fingerprint_loc(self):
+        metadata_loc = self.get_pewma_metadata_loc()
+        return metadata_loc and os.path.join(metadata_loc, BUILD_FINGERPRINT_FILE)
+
+
+    def read_build_fingerprint(self):
+        """ Returns the fingerprint recorded after the last successful build, or None
+        """
+
+        fingerprint_loc = self._get_build_fingerprint_loc()
+        if not (fingerprint_loc and os.path.isfile(fingerprint_loc)):
+            return None
+        try:
+            with open(fingerprint_loc) as fingerprint_file:
+                recorded = json.load(fingerprint_file)
+        except (IOError, ValueError) as e:
+            self.logger.debug('%sIgnoring unreadable build fingerprint "%s": %s' % (self.log_prefix, fingerprint_loc, e))
+            return None
+        return recorded.get('fingerprint') if recorded.get('format') == BUILD_FINGERPRINT_FORMAT else None
+
+
+    def record_build_fingerprint(self, fingerprint):
+        """ Records the fingerprint of a successful build
+        """
+
+        fingerprint_loc = self._get_build_fingerprint_loc()
+        if (not fingerprint_loc) or self.options.dry_run:
+            return
+        try:
+            self.write_json_file(fingerprint_loc, {'format': BUILD_FINGERPRINT_FORMAT, 'fingerprint': fingerprint, 'built': time.strftime('%Y-%m-%d %H:%M:%S')})
+        except (IOError, OSError) as e:
+            self.logger.warn('%sCould not save build fingerprint "%s": %s' % (self.log_prefix, fingerprint_loc, e))
+
+
+    def forget_build_fingerprint(self):
+        """ Removes the fingerprint of the last successful build, so that the next build is not skipped
+            (done before anything that changes the workspace in a way the fingerprint does not cover, e.g. materialize or clean)
+        """
+
+        fingerprint_loc = self._get_build_fingerprint_loc()
+        if fingerprint_loc and (not self.options.dry_run) and os.path.isfile(fingerprint_loc):
+            try:
+                os.remove(fingerprint_loc)
+            except OSError as e:
+                self.logger.warn('%sCould not remove build fingerprint "%s": %s' % (self.log_prefix, fingerprint_loc, e))
 
 
     def _switch_mars_settings_file_in(self):
@@ -2077,6 +5308,7 @@ class PewmaManager(object):
         if not os.path.isfile(path):
             raise PewmaException('ERROR: target file "%s" ("%s") does not exist' % (target, path))
 
+        self.forget_build_fingerprint()  # the target platform is changing
         return self.run_buckminster_in_subprocess(('importtargetdefinition', '--active',
                                                    path[len(self.workspace_loc)+1:]), scan_for_materialize_errors=False, scan_compile_messages=False)  # +1 for os.sep
 
@@ -2122,18 +5354,44 @@ class PewmaManager(object):
         if self.isWindows:
             script_file_path_to_pass = '"%s"' % (self.script_file_path,)
         else:
-            script_file_path_to_pass = self.script_file_path
-        return self.run_buckminster_in_subprocess(('--scriptfile', script_file_path_to_pass), scan_for_materialize_errors=False)
+            script_file_path_to_pass = self.script_file_path
+        return self.run_buckminster_in_subprocess(('--scriptfile', script_file_path_to_pass), scan_for_materialize_errors=False)
+
+
+    def action_product(self):
+        return self._product_or_product_zip(action_zip=False)
+    def action_product_zip(self):
+        return self._product_or_product_zip(action_zip=True)
+
+    def _product_or_product_zip(self, action_zip):
+        """ Processes command: product [ <site> ] [ <platform> ... ]
+                           or: product.zip [ <site> ] [ <platform> ... ]
+        """
+
+        platforms = self._prepare_product()
+        parallel_platforms = self.options.parallel_platforms and (len(platforms) > 1)
+        if not parallel_platforms:
+            script_file_path_to_pass = self._write_script_file(self._product_script_commands(platforms, action_zip, build=not self.options.assume_build))
+
+        # if the workspace has a settings file specifically for Eclipse Mars (which is what Buckminster is), use that.
+        mars_settings_file_status = self._switch_mars_settings_file_in()
+        if mars_settings_file_status > 1:
+            return mars_settings_file_status
+
+        if parallel_platforms:
+            bm_exit_code = self._product_parallel_platforms(platforms, action_zip)
+        else:
+            bm_exit_code =  self.run_buckminster_in_subprocess(('--scriptfile', script_file_path_to_pass), scan_for_materialize_errors=False)
 
+        if mars_settings_file_status:
+            return self._switch_mars_settings_file_out() or bm_exit_code
+        else:
+            return bm_exit_code
 
-    def action_product(self):
-        return self._product_or_product_zip(action_zip=False)
-    def action_product_zip(self):
-        return self._product_or_product_zip(action_zip=True)
 
-    def _product_or_product_zip(self, action_zip):
-        """ Processes command: product [ <site> ] [ <platform> ... ]
-                           or: product.zip [ <site> ] [ <platform> ... ]
+    def _prepare_product(self):
+        """ Interprets the arguments of a product or product.zip command: [ <site> ] [ <platform> ... ]
+            Sets self.site_name and self.buckminster_properties_path, and returns the sorted list of platforms to build
         """
 
         self.set_available_sites()
@@ -2176,52 +5434,593 @@ class PewmaManager(object):
                 self.options.buckminster_root_prefix = '/tmp/uk.ac.diamond.daq.server.site_' + self.start_time.strftime('%Y%m%d_%H%M%S.%f')
 
         self.set_buckminster_properties_path(self.site_name)
-        self.logger.info('Writing buckminster commands to "%s"' % (self.script_file_path,))
+        return platforms
+
+
+    def _product_script_commands(self, platforms, action_zip, build, root_prefix=None):
+        """ Returns the Buckminster script commands (a string of lines) to build the product for the platforms
+            (preceded by a thorough build of the workspace if build is True)
+            root_prefix, if specified, overrides --buckminster.root.prefix
+        """
+
         properties_text = '-P%s ' % (self.buckminster_properties_path,)
         for keyval in self.options.system_property:
             properties_text += '-D%s ' % (keyval,)
-        if self.options.buckminster_root_prefix:
-            properties_text += '-Dbuckminster.root.prefix=%s ' % (os.path.abspath(self.options.buckminster_root_prefix),)
-        with open(self.script_file_path, 'w') as script_file:
-            script_file.write('### File generated ' + time.strftime("%a, %Y/%m/%d %H:%M:%S %z") +
-                              ' (' + os.environ.get('BUILD_URL','$BUILD_URL:missing') + ')\n')
-            script_file.write('importproxysettings\n')  # will import proxy settings from Java system properties
-            if not self.options.assume_build:
-                script_file.write('build --thorough\n')
-            script_file.write('perform ' + properties_text)
-            script_file.write('-Dtarget.os=* -Dtarget.ws=* -Dtarget.arch=* ')
-            for p in platforms:
-                perform_options = {'action': 'create.product.zip' if action_zip else 'create.product', 'withsymlink': '', 'site_name': self.site_name,
-                                   'os': p.split(',')[0], 'ws': p.split(',')[1], 'arch': p.split(',')[2]}
-                if self.options.recreate_symlink and (p == 'linux,gtk,x86_64') and not action_zip:
-                    perform_options['withsymlink'] = '-with.symlink'
-                script_file.write(' %(site_name)s#%(action)s-%(os)s.%(ws)s.%(arch)s%(withsymlink)s' % perform_options)
-            script_file.write('\n')
+        root_prefix = root_prefix or self.options.buckminster_root_prefix
+        if root_prefix:
+            properties_text += '-Dbuckminster.root.prefix=%s ' % (os.path.abspath(root_prefix),)
+        script_commands = ''
+        if build:
+            script_commands += 'build --thorough\n'
+        script_commands += 'perform ' + properties_text
+        script_commands += '-Dtarget.os=* -Dtarget.ws=* -Dtarget.arch=* '
+        for p in platforms:
+            perform_options = {'action': 'create.product.zip' if action_zip else 'create.product', 'withsymlink': '', 'site_name': self.site_name,
+                               'os': p.split(',')[0], 'ws': p.split(',')[1], 'arch': p.split(',')[2]}
+            if self.options.recreate_symlink and (p == 'linux,gtk,x86_64') and not action_zip:
+                perform_options['withsymlink'] = '-with.symlink'
+            script_commands += ' %(site_name)s#%(action)s-%(os)s.%(ws)s.%(arch)s%(withsymlink)s' % perform_options
+        script_commands += '\n'
+        return script_commands
+
+
+    def _product_parallel_platforms(self, platforms, action_zip):
+        """ Builds the workspace, then exports the product for each platform in a separate, concurrent, Buckminster process
+            Each export uses its own copy of the workspace (since Eclipse does not support several processes using one workspace),
+            and writes to its own buckminster.root.prefix, and the outputs are then merged into the real one
+            Returns the return code
+        """
+        root_prefix = self.options.buckminster_root_prefix
+        if not root_prefix:
+            # use the value from the properties file, provided that it's a plain path
+            with open(self.buckminster_properties_path) as properties_file:
+                for line in properties_file:
+                    m = re.match(r'\s*buckminster\.root\.prefix\s*[=:]\s*(\S.*?)\s*$', line)
+                    if m:
+                        root_prefix = m.group(1)
+            if (not root_prefix) or ('${' in root_prefix) or (not os.path.isabs(root_prefix)):
+                raise PewmaException('ERROR: --parallel-platforms requires --buckminster.root.prefix, since "%s" does not define it as an absolute path' %
+                                     (self.buckminster_properties_path,))
+        root_prefix = os.path.abspath(root_prefix)
+
+        if not self.options.assume_build:
+            rc = self.run_buckminster_in_subprocess(('--scriptfile', self._write_script_file('build --thorough\n')), scan_for_materialize_errors=False)
+            if rc:
+                return rc
+
+        exports = []  # (platform, root prefix, script file path to pass, workspace copy)
+        for p in platforms:
+            platform_suffix = '.'.join(p.split(','))
+            platform_root_prefix = '%s_%s' % (root_prefix, platform_suffix)
+            if os.path.isdir(platform_root_prefix):
+                remove_tree(platform_root_prefix)
+            script_file_path_to_pass = self._write_script_file(
+                self._product_script_commands((p,), action_zip, build=False, root_prefix=platform_root_prefix),
+                script_file_path='%s.%s' % (self.script_file_path, platform_suffix))
+            exports.append((p, platform_root_prefix, script_file_path_to_pass, '%s.export-%s' % (self.workspace_loc, platform_suffix)))
+
+        def export_one_platform(export):
+            (p, platform_root_prefix, script_file_path_to_pass, export_workspace_loc) = export
+            start_time = time.time()
+            if not self.options.dry_run:
+                self._create_export_workspace(export_workspace_loc)
+            try:
+                rc = self.run_buckminster_in_subprocess(('--scriptfile', script_file_path_to_pass), scan_for_materialize_errors=False,
+                                                        output_line_prefix=('[%s] ' % (p,)).encode('ascii'), workspace_loc=export_workspace_loc)
+            finally:
+                if os.path.isdir(export_workspace_loc):
+                    remove_tree(export_workspace_loc)
+            self.logger.info('%sExport for %s %s in %s' % (self.log_prefix, p, 'failed (rc=%s)' % (rc,) if rc else 'completed',
+                             datetime.timedelta(seconds=int(time.time() - start_time))))
+            return rc
 
-        # if the workspace has a settings file specifically for Eclipse Mars (which is what Buckminster is), use that.
-        mars_settings_file_status = self._switch_mars_settings_file_in()
-        if mars_settings_file_status > 1:
-            return mars_settings_file_status
+        self.report_executable_location('buckminster')  # once, before the concurrent exports
+        self.report_and_check_java_version()
+        self.logger.info('%sExporting %s platforms concurrently' % (self.log_prefix, len(exports)))
+        rcs = map_concurrently(export_one_platform, exports, len(exports))
 
-        if self.isWindows:
-            script_file_path_to_pass = '"%s"' % (self.script_file_path,)
-        else:
-            script_file_path_to_pass = self.script_file_path
+        if self.options.dry_run:
+            return max(rcs)
+        for (p, platform_root_prefix, _, _) in exports:
+            if os.path.isdir(platform_root_prefix):
+                self.logger.info('%sMerging "%s" into "%s"' % (self.log_prefix, platform_root_prefix, root_prefix))
+                for relpath in merge_tree(platform_root_prefix, root_prefix):
+                    self.logger.debug('%sKept existing "%s" (from an earlier platform)' % (self.log_prefix, relpath))
+        return max(rcs)
+
+
+    def _create_export_workspace(self, export_workspace_loc):
+        """ Creates a copy of the workspace for one of the concurrent product exports: its own .metadata (cloned or copied, so the build
+            state is shared but never written to by two processes), with everything else in the workspace (such as tp/) symlinked
+            (projects in workspace_git are referenced by absolute location, so they are the same projects as in the workspace)
+        """
+
+        if os.path.isdir(export_workspace_loc):
+            remove_tree(export_workspace_loc)  # left behind by an interrupted run
+        self.logger.debug('%sCopying the workspace to "%s"' % (self.log_prefix, export_workspace_loc))
+        os.makedirs(export_workspace_loc)
+        for name in os.listdir(self.workspace_loc):
+            if name == '.metadata':
+                clone_tree(self.workspace_loc, export_workspace_loc, member_prefix='.metadata/')
+            elif hasattr(os, 'symlink'):
+                os.symlink(os.path.join(self.workspace_loc, name), os.path.join(export_workspace_loc, name))
+            elif os.path.isdir(os.path.join(self.workspace_loc, name)):
+                clone_tree(self.workspace_loc, export_workspace_loc, member_prefix=name + '/')
+
+
+    def action_pipeline(self):
+        """ Processes command: pipeline <stage>,<stage>... [<stage arguments>] [+ <stage arguments>]
+            Writes the Buckminster commands for all the stages into one script file, and runs them in a single Buckminster process,
+            so that JVM startup, OSGi resolution and workspace loading are only paid for once
+        """
 
-        bm_exit_code =  self.run_buckminster_in_subprocess(('--scriptfile', script_file_path_to_pass), scan_for_materialize_errors=False)
+        if not self.arguments:
+            raise PewmaException('ERROR: pipeline command requires a comma-separated list of stages')
+        stages = self.arguments[0].split(',')
+        stage_kinds = []
+        for stage in stages:
+            for (kind, stage_names) in enumerate(PIPELINE_STAGES):
+                if stage in stage_names:
+                    stage_kinds.append(kind)
+                    break
+            else:
+                raise PewmaException('ERROR: pipeline stage "%s" unrecognised (valid stages are: %s)' % (stage, ', '.join(sum(PIPELINE_STAGES, ()))))
+        if stage_kinds != sorted(set(stage_kinds)):
+            raise PewmaException('ERROR: pipeline stages "%s" must be in the order materialize, build, product, with at most one of each' % (self.arguments[0],))
+        materialize = 'materialize' in stages
+        build_stage = ([stage for stage in stages if stage in PIPELINE_STAGES[1]] or [None])[0]
+        product_stage = ([stage for stage in stages if stage in PIPELINE_STAGES[2]] or [None])[0]
+        if (not materialize) and any((self.options.delete, self.options.recreate, self.options.tp_recreate, self.options.preclone)):
+            raise PewmaException('ERROR: the --delete, --recreate, --tp-recreate and --preclone options need a materialize stage in the pipeline')
+
+        # the remaining arguments are split at each "+", and given in turn to the stages that take arguments
+        stage_arguments = [[]]
+        for arg in self.arguments[1:]:
+            if arg == '+':
+                stage_arguments.append([])
+            else:
+                stage_arguments[-1].append(arg)
+        stages_with_arguments = [stage for stage in (('materialize' if materialize else None), product_stage) if stage]
+        if len(stage_arguments) > max(len(stages_with_arguments), 1) or (stage_arguments[0] and not stages_with_arguments):
+            raise PewmaException('ERROR: pipeline command has too many arguments (only the materialize and product stages take arguments)')
+        stage_arguments = dict(zip(stages_with_arguments, stage_arguments))
+
+        fingerprint = None
+        if build_stage:
+            self.forget_build_fingerprint()
+            if not materialize:
+                # taken before Buckminster starts, so that edits made during the build are built next time (after a materialize
+                # stage, workspace_git is not known until Buckminster has finished, so no fingerprint is recorded)
+                fingerprint = self.get_build_fingerprint()
+        script_commands = []  # (stage, commands)
+        if materialize:
+            self.arguments = stage_arguments.get('materialize', [])
+            if product_stage and not self.options.preclone:
+                # the product's site project must be on disk before Buckminster runs, so that its properties file can be passed
+                self.logger.info('%sPre-cloning repositories, so that the product site is available before the materialize' % (self.log_prefix,))
+                self.options.preclone = True
+            (exit_code, components_to_use, cquery_to_use) = self._prepare_materialize()
+            if exit_code:
+                return exit_code
+            script_commands.append(('materialize', self._materialize_script_commands(components_to_use, cquery_to_use)))
+        if build_stage:
+            script_commands.append((build_stage, ('build --thorough\n', 'build\n')[build_stage == 'buildinc']))
+        if product_stage:
+            self.arguments = stage_arguments.get(product_stage, [])
+            if materialize:
+                self.set_available_sites(imported_only=False)  # the site is cloned, but not yet imported into the workspace
+            platforms = self._prepare_product()
+            script_commands.append((product_stage, self._product_script_commands(platforms, product_stage == 'product.zip',
+                                                                                 build=not (build_stage or self.options.assume_build))))
+
+        # Buckminster echoes each script command as it starts it, so the first command of each stage marks where the stage begins
+        stage_markers = []
+        for (stage, commands) in script_commands:
+            first_command = [line for line in commands.splitlines() if not line.startswith('setpref ')][0]
+            stage_markers.append((('INFO:  ' + first_command.split()[0]).encode('ascii'), stage))
+        script_file_path_to_pass = self._write_script_file(''.join(commands for (_, commands) in script_commands))
+
+        mars_settings_file_status = False
+        if build_stage or product_stage:
+            # if the workspace has a settings file specifically for Eclipse Mars (which is what Buckminster is), use that.
+            mars_settings_file_status = self._switch_mars_settings_file_in()
+            if mars_settings_file_status > 1:
+                return mars_settings_file_status
+
+        rc = self.run_buckminster_in_subprocess(('--scriptfile', script_file_path_to_pass),
+                                                scan_for_materialize_errors=materialize, scan_compile_messages=bool(build_stage or product_stage),
+                                                prepare_jenkins_build_description=False, stage_markers=stage_markers)
+        scanner = self.buckminster_output_scanner
+
+        # report the outcome of each stage; a failure with no recognised error is attributed to the last stage that started
+        failed_stage = None
+        for (stage, _) in script_commands:
+            if scanner.stage_error_counts.get(stage):
+                failed_stage = failed_stage or stage
+                self.logger.error('%sPipeline stage %s failed (%s errors)' % (self.log_prefix, stage, scanner.stage_error_counts[stage]))
+            elif stage not in scanner.stages_reached:
+                self.logger.log(logging.WARNING if rc else logging.INFO, '%sPipeline stage %s was not reached' % (self.log_prefix, stage))
+            elif rc and (stage == scanner.stages_reached[-1]) and not failed_stage:
+                failed_stage = stage
+                self.logger.error('%sPipeline stage %s failed' % (self.log_prefix, stage))
+            else:
+                self.logger.info('%sPipeline stage %s completed' % (self.log_prefix, stage))
+        if rc and self.options.prepare_jenkins_build_description_on_error:
+            text = self._buckminster_errors_build_description(scanner) or ('Failure - compile errors' if scanner.compile_errors_seen else 'Failure')
+            print('append-build-description: %s stage: %s' % (failed_stage or 'pipeline', text))
 
+        if materialize:
+            rc = self._finish_materialize(components_to_use, cquery_to_use, rc)
         if mars_settings_file_status:
-            return self._switch_mars_settings_file_out() or bm_exit_code
-        else:
-            return bm_exit_code
+            rc = self._switch_mars_settings_file_out() or rc
+        if fingerprint and not rc:
+            self.record_build_fingerprint(fingerprint)
+        return rc
+
+
+    def action_stats(self):
+        """ Processes command: stats [<action> ...]
+            Summarises the metrics file: for each action and phase, the number of times it ran, how many failed,
+            and the median, 90th percentile and maximum durations
+        """
+
+        metrics_path = os.path.abspath(os.path.expanduser(self.options.metrics_file))
+        if not os.path.isfile(metrics_path):
+            raise PewmaException('ERROR: metrics file "%s" does not exist' % (metrics_path,))
+
+        durations = {}  # {(action, phase): [(duration, rc, start), ...]}
+        runs = set()
+        for path in (metrics_path + '.1', metrics_path):  # the older records first
+            if not os.path.isfile(path):
+                continue
+            with open(path) as metrics_file:
+                for line in metrics_file:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue  # a partly written record (should never happen)
+                    if (record.get('format') != METRICS_FORMAT) or (self.arguments and (record['action'] not in self.arguments)):
+                        continue
+                    durations.setdefault((record['action'], record['phase']), []).append((record['duration'], record['rc'], record['start']))
+                    runs.add(record['run'])
+        if not durations:
+            self.logger.info('No runs%s recorded in "%s"' % ((' of ' + ', '.join(self.arguments)) if self.arguments else '', metrics_path))
+            return
+
+        def percentile(sorted_values, fraction):
+            return sorted_values[int(round(fraction * (len(sorted_values) - 1)))]
+
+        def format_duration(seconds):
+            return '%.1fs' % (seconds,) if seconds < 60 else str(datetime.timedelta(seconds=int(seconds)))
+
+        self.logger.info('%s runs recorded in "%s"' % (len(runs), metrics_path))
+        print('%-24s %-16s %6s %6s %10s %10s %10s  %s' % ('action', 'phase', 'count', 'failed', 'median', 'p90', 'max', 'last run'))
+        for (action, phase) in sorted(durations, key=lambda key: (key[0], key[1] != 'action', key[1])):
+            values = durations[(action, phase)]
+            sorted_durations = sorted(duration for (duration, _, _) in values)
+            print('%-24s %-16s %6s %6s %10s %10s %10s  %s' %
+                  (action, phase, len(values), len([rc for (_, rc, _) in values if rc != 0]),
+                   format_duration(percentile(sorted_durations, 0.5)), format_duration(percentile(sorted_durations, 0.9)),
+                   format_duration(sorted_durations[-1]), max(start for (_, _, start) in values)))
+
+
+    def action_scan_log(self):
+        """ Processes command: scan-log <file> ...
+            Replays previously captured Buckminster output through the output scanner (without echoing it),
+            reports any errors found, and how long the scan took
+        """
+
+        if not self.arguments:
+            raise PewmaException('ERROR: scan-log command requires the path of at least one saved Buckminster log')
+
+        rc = 0
+        for log_path in self.arguments:
+            log_path = os.path.abspath(os.path.expanduser(log_path))
+            try:
+                with open(log_path, 'rb') as log_file:
+                    lines = log_file.readlines()  # read everything first, so that only the scan is timed
+            except (IOError) as e:
+                raise PewmaException('ERROR: could not read "%s": %s' % (log_path, e))
+
+            scanner = BuckminsterOutputScanner(scan_for_materialize_errors=True, scan_compile_messages=True,
+                                               suppress_compile_warnings=self.options.suppress_compile_warnings)
+            start_time = time.time()
+            lines_echoed = 0
+            for line in lines:
+                if scanner.scan_line(line):
+                    lines_echoed += 1
+            elapsed = time.time() - start_time
+
+            self.logger.info('Scanned %s lines (%s echoed) from "%s" in %.3f seconds (%s lines/second)' %
+                             ('{0:,d}'.format(scanner.lines_scanned), '{0:,d}'.format(lines_echoed), log_path, elapsed,
+                              '{0:,d}'.format(int(scanner.lines_scanned / elapsed)) if elapsed else '<unknown>'))
+            if scanner.compile_errors_seen:
+                self.logger.info('Compile errors seen in "%s"' % (log_path,))
+            rc = max(rc, self._report_buckminster_errors(scanner, 0))
+        return rc
+
+
+    def action_template_benchmark(self):
+        """ Processes command: template-benchmark [<template version> [<iterations>]]
+            Creates workspace files from the template repeatedly, both as in earlier versions of pewma (write the zip, unzip it,
+            delete it) and by copying the extracted template in the download cache, and reports the timings
+        """
+        import tempfile
+        import zipfile
+
+        if len(self.arguments) > 2:
+            raise PewmaException('ERROR: template-benchmark command has too many arguments')
+        template_name = 'template_workspace_%s.zip' % (self.arguments[0] if self.arguments else DEFAULT_TEMPLATE,)
+        try:
+            iterations = int(self.arguments[1]) if len(self.arguments) > 1 else 10
+            if iterations < 1:
+                raise ValueError
+        except ValueError:
+            raise PewmaException('ERROR: template-benchmark iterations must be a positive integer')
+        download_cache = self.get_download_cache()
+        if not download_cache:
+            raise PewmaException('ERROR: template-benchmark command requires the download cache')
+        if self.options.dry_run:
+            self.logger.info('%sBenchmarking "%s"' % (self.log_prefix, template_name))
+            return
+
+        templatedata = self.download_url(self._get_full_uri('templates/' + template_name), 'template workspace', 'Workspace template')
+        with download_cache.extracted_zip(templatedata) as template_dir:
+            benchmark_dir = tempfile.mkdtemp(prefix='template-benchmark.', dir=download_cache.cache_dir)  # same filesystem as the cache
+            try:
+                timings = {'unzip': [], 'copy': []}
+                for iteration in range(iterations):
+                    workspace_dir = os.path.join(benchmark_dir, 'unzip%s' % (iteration,))
+                    start_time = time.time()
+                    os.mkdir(workspace_dir)
+                    template_zip = os.path.join(workspace_dir, template_name)
+                    with open(template_zip, 'wb') as template:
+                        template.write(templatedata)
+                    with contextlib.closing(zipfile.ZipFile(template_zip, 'r')) as template:
+                        template.extractall(workspace_dir)
+                    os.remove(template_zip)
+                    timings['unzip'].append(time.time() - start_time)
+
+                    workspace_dir = os.path.join(benchmark_dir, 'copy%s' % (iteration,))
+                    start_time = time.time()
+                    counts = clone_tree(template_dir, workspace_dir)
+                    timings['copy'].append(time.time() - start_time)
+            finally:
+                remove_tree(benchmark_dir)
+
+        self.logger.info('Template "%s" (%s bytes), %s iterations; files hardlinked: %s, cloned: %s, copied: %s' %
+                         (template_name, '{0:,d}'.format(len(templatedata)), iterations, counts['hardlinked'], counts['cloned'], counts['copied']))
+        for method in ('unzip', 'copy'):
+            self.logger.info('%-5s: mean %.1f ms, min %.1f ms, max %.1f ms' %
+                             (method, 1000 * sum(timings[method]) / iterations, 1000 * min(timings[method]), 1000 * max(timings[method])))
+        self.logger.info('Copying the extracted template is %.1fx the speed of unzipping' % (sum(timings['unzip']) / max(sum(timings['copy']), 1e-6),))
+
+
+    def report_startup_times(self):
+        """ Logs the time taken to reach each startup milestone (--profile-startup)
+        """
+
+        previous_time = STARTUP_TIMES[0][1]
+        for (milestone, milestone_time) in STARTUP_TIMES[1:]:
+            self.logger.info('Startup: %-7s %6.1f ms (total %6.1f ms)' %
+                             (milestone, 1000 * (milestone_time - previous_time), 1000 * (milestone_time - STARTUP_TIMES[0][1])))
+            previous_time = milestone_time
+        self.logger.info('Startup: modules imported %s' % (len(sys.modules),))
+
+
+    def action_startup_benchmark(self):
+        """ Processes command: startup-benchmark [<runs> [<threshold ms>]]
+            Runs "pewma print-workspace-path" repeatedly in a new Python process, and compares the timings with starting
+            Python alone. Returns 1 if the median difference exceeds the threshold, so can be used to detect startup regressions.
+        """
+        import tempfile
+
+        if len(self.arguments) > 2:
+            raise PewmaException('ERROR: startup-benchmark command has too many arguments')
+        try:
+            runs = int(self.arguments[0]) if self.arguments else 10
+            if runs < 1:
+                raise ValueError
+        except ValueError:
+            raise PewmaException('ERROR: startup-benchmark runs must be a positive integer')
+        try:
+            threshold_ms = float(self.arguments[1]) if len(self.arguments) > 1 else STARTUP_BENCHMARK_THRESHOLD_MS
+        except ValueError:
+            raise PewmaException('ERROR: startup-benchmark threshold must be a number of milliseconds')
+
+        (module_name, extension) = os.path.splitext(os.path.basename(PEWMA_SCRIPT))
+        if extension != '.py':
+            raise PewmaException('ERROR: startup-benchmark requires "%s" to be named *.py, so that it can be imported' % (PEWMA_SCRIPT,))
+        # run pewma as the code at the top of this file does, importing it
+        commands = (('python', (sys.executable, '-c', 'pass')),
+                    ('pewma', (sys.executable, '-c', 'import sys; sys.path[0] = %r; import %s; %s.run()' % (os.path.dirname(PEWMA_SCRIPT), module_name, module_name),
+                               '--no-metrics', '--no-graylog', '-w', os.path.join(tempfile.gettempdir(), 'pewma-startup-benchmark'), 'print-workspace-path')),
+                   )
+        if self.options.dry_run:
+            for (name, command) in commands:
+                self.logger.info('%sTiming %s runs of: %s' % (self.log_prefix, runs, ' '.join(command)))
+            return
+
+        medians = {}
+        with open(os.devnull, 'w') as devnull:
+            for (name, command) in commands:
+                timings = []
+                for _ in range(runs):
+                    start_time = time.time()
+                    retcode = subprocess.call(command, stdout=devnull)
+                    timings.append(time.time() - start_time)
+                    if retcode:
+                        raise PewmaException('ERROR: startup-benchmark command failed (return code %s): %s' % (retcode, ' '.join(command)))
+                timings.sort()
+                medians[name] = timings[len(timings) // 2] if len(timings) % 2 else (timings[len(timings) // 2 - 1] + timings[len(timings) // 2]) / 2
+                self.logger.info('%-6s: median %.1f ms, min %.1f ms, max %.1f ms (%s runs)' %
+                                 (name, 1000 * medians[name], 1000 * timings[0], 1000 * timings[-1], runs))
+
+        bytecode_path = os.path.splitext(PEWMA_SCRIPT)[0] + '.pyc'
+        if not os.path.isfile(bytecode_path):
+            self.logger.warn('"%s" does not exist, so pewma is compiled on every run (is the directory writable, or PYTHONDONTWRITEBYTECODE set?)' %
+                             (bytecode_path,))
+        overhead_ms = 1000 * (medians['pewma'] - medians['python'])
+        if overhead_ms > threshold_ms:
+            self.logger.error('pewma startup adds %.1f ms to Python startup, more than the threshold of %s ms' % (overhead_ms, threshold_ms))
+            return 1
+        self.logger.info('pewma startup adds %.1f ms to Python startup (threshold %s ms)' % (overhead_ms, threshold_ms))
 
 
     def _iterate_ant(self, target):
         """ Processes using an ant target
         """
 
-        selected_projects = self.get_selected_imported_projects_with_releng_ant()
-        return self.run_ant_in_subprocess((selected_projects, target))
+        if target not in TEST_TARGETS:
+            selected_projects = self.get_selected_imported_projects_with_releng_ant()
+            return self.run_ant_in_subprocess((selected_projects, target))
+
+        project_names = self.get_selected_imported_project_names()
+        if self.options.affected_since or self.options.affected_repositories:
+            project_names = self.select_affected_projects(project_names)
+            if not project_names:
+                self.logger.info('%sNo projects to test are affected by the changes, so not running %s' % (self.log_prefix, target))
+                return
+        if self.options.test_jobs > 1:
+            return self._iterate_ant_sharded(target, project_names)
+        return self.run_ant_in_subprocess((self.get_plugin_list_argument(project_names), target))
+
+
+    def _iterate_ant_sharded(self, target, project_names):
+        """ Runs the tests in --test-jobs ant processes at once, with the selected projects split into shards of roughly equal
+            total test duration (from the last time that each project's tests were run)
+            Each shard has its own java.io.tmpdir and Xvfb display, and its output is written to a file in the workspace
+            Returns the first non-zero return code of a shard, or 0 if they all succeeded
+        """
+        durations = self.get_test_durations(project_names)
+        shards = balance_shards(durations, self.options.test_jobs)
+        self.logger.info('%sRunning %s for %s projects in %s shards' % (self.log_prefix, target, len(project_names), len(shards)))
+        for (shard_number, (estimate, names)) in enumerate(shards, 1):
+            self.logger.info('%sShard %s: %s projects, estimated %s' %
+                             (self.log_prefix, shard_number, len(names), datetime.timedelta(seconds=int(estimate))))
+
+        self.report_executable_location('ant')  # once, rather than from every shard
+        self.report_and_check_java_version()
+        start_time = time.time()
+        def run_shard(numbered_shard):
+            (shard_number, (_, names)) = numbered_shard
+            output_path = os.path.join(self.workspace_loc, 'pewma-%s-shard%s.log' % (target, shard_number))
+            shard_start_time = time.time()
+            retcode = self.run_ant_in_subprocess((self.get_plugin_list_argument(names), target), shard_number, output_path)
+            return (retcode, time.time() - shard_start_time, output_path)
+
+        results = map_concurrently(run_shard, list(enumerate(shards, 1)), len(shards))
+        if self.options.dry_run:
+            return
+
+        # combine the results of the shards
+        reports = self.read_test_reports(project_names, start_time)
+        self.save_test_durations(reports)
+        retcode = 0
+        shards_failed = 0
+        total = {'projects': 0, 'tests': 0, 'failures': 0, 'errors': 0}
+        for (shard_number, ((_, names), (shard_retcode, duration, output_path))) in enumerate(zip(shards, results), 1):
+            shard_total = {'tests': 0, 'failures': 0, 'errors': 0}
+            for name in names:
+                if name in reports:
+                    total['projects'] += 1
+                    for key in shard_total:
+                        shard_total[key] += reports[name][key]
+            for key in shard_total:
+                total[key] += shard_total[key]
+            (self.logger.error if shard_retcode else self.logger.info)(
+                '%sShard %s: %s projects, %s tests, %s failures, %s errors, return code %s, ran for %s (output in "%s")' %
+                (self.log_prefix, shard_number, len(names), shard_total['tests'], shard_total['failures'], shard_total['errors'],
+                 shard_retcode, datetime.timedelta(seconds=int(duration)), output_path))
+            retcode = retcode or shard_retcode
+            shards_failed += bool(shard_retcode)
+        failed_projects = sorted(name for name in reports if reports[name]['failures'] or reports[name]['errors'])
+        self.logger.info('%sAll shards: %s tests, %s failures, %s errors, in %s projects with test reports (of %s selected)' %
+                         (self.log_prefix, total['tests'], total['failures'], total['errors'], total['projects'], len(project_names)))
+        if failed_projects:
+            self.logger.error('%sProjects with test failures or errors: %s' % (self.log_prefix, ', '.join(failed_projects)))
+        if shards_failed:
+            self.logger.error('%s%s of %s shards failed' % (self.log_prefix, shards_failed, len(shards)))
+        return retcode
+
+
+    def read_test_reports(self, project_names, since=None):
+        """ Reads the JUnit reports in the test-reports directory of each project (ignoring reports last modified before since)
+            Returns a dictionary of {project name: {"tests", "failures", "errors", "time"}} for the projects that have reports
+            (a test run that crashed in-flight leaves IGNORETHIS.xml, which is counted as an error)
+        """
+
+        reports = {}
+        for name in project_names:
+            reports_dir = os.path.join(self.workspace_git_loc, self.all_imported_projects_with_releng_ant[name], 'test-reports')
+            try:
+                filenames = os.listdir(reports_dir)
+            except OSError:
+                continue
+            for filename in filenames:
+                report_path = os.path.join(reports_dir, filename)
+                if not (fnmatch.fnmatch(filename, 'TEST-*.xml') or (filename == 'IGNORETHIS.xml')):
+                    continue
+                try:
+                    if since and (os.path.getmtime(report_path) < since):
+                        continue
+                except OSError:
+                    continue
+                summary = read_junit_report_summary(report_path)
+                if filename == 'IGNORETHIS.xml':
+                    summary = {'tests': 0, 'failures': 0, 'errors': 1, 'time': (summary or {}).get('time', 0.0)}
+                if summary:
+                    project_summary = reports.setdefault(name, {'tests': 0, 'failures': 0, 'errors': 0, 'time': 0.0})
+                    for key in project_summary:
+                        project_summary[key] += summary[key]
+        return reports
+
+
+    def get_test_durations(self, project_names):
+        """ Returns a dictionary of {project name: seconds} with the duration of each project's tests when last run
+            Durations are taken from the test durations file, else from any test reports in the workspace,
+            else the median of the known durations is assumed
+        """
+
+        try:
+            with open(os.path.expanduser(TEST_DURATIONS_FILE)) as durations_file:
+                recorded = json.load(durations_file)
+            recorded = recorded['projects'] if recorded.get('format') == TEST_DURATIONS_FORMAT else {}
+        except (IOError, ValueError, KeyError):
+            recorded = {}
+
+        durations = dict((name, recorded[name]['time']) for name in project_names if name in recorded)
+        unknown = [name for name in project_names if name not in durations]
+        for (name, summary) in self.read_test_reports(unknown).items():
+            durations[name] = summary['time']
+        known = sorted(durations.values())
+        default = known[len(known) // 2] if known else TEST_DURATION_DEFAULT
+        self.logger.debug('%sTest durations known for %s of %s projects (%s seconds assumed for the others)' %
+                          (self.log_prefix, len(known), len(project_names), default))
+        return dict((name, durations.get(name, default)) for name in project_names)
+
+
+    def save_test_durations(self, reports):
+        """ Records the duration of the tests of each project just run in the test durations file
+        """
+
+        durations_path = os.path.expanduser(TEST_DURATIONS_FILE)
+        try:
+            if not os.path.isdir(os.path.dirname(durations_path)):
+                os.makedirs(os.path.dirname(durations_path))
+            with exclusive_file_lock(durations_path + '.lock'):
+                try:
+                    with open(durations_path) as durations_file:
+                        durations = json.load(durations_file)
+                    if durations.get('format') != TEST_DURATIONS_FORMAT:
+                        raise ValueError
+                except (IOError, ValueError):
+                    durations = {'format': TEST_DURATIONS_FORMAT, 'projects': {}}
+                for (name, summary) in reports.items():
+                    durations['projects'][name] = {'time': round(summary['time'], 1), 'recorded': int(time.time())}
+                self.write_json_file(durations_path, durations)
+        except (IOError, OSError) as e:
+            self.logger.debug('%sCould not save test durations "%s": %s' % (self.log_prefix, durations_path, e))
 
 
     def action_developer_test(self):
@@ -2244,14 +6043,8 @@ class PewmaManager(object):
             return self.executable_locations[executable_name]
         loc = None
         if self.isLinux:
-            # "which" command only available on Linux
-            try:
-                whichrun = subprocess.Popen(('which', '-a', executable_name), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-                (stdout, stderr) = whichrun.communicate(None)
-                if not whichrun.returncode:
-                    loc = stdout.strip()
-            except:
-                pass
+            # search the PATH in-process, as "which -a" would (on Windows, PATHEXT would also need to be considered)
+            loc = '\n'.join(find_executables_on_path(executable_name)) or None
         if loc:
             self.logger.info('%s%s install that will be used: %s' % (self.log_prefix, executable_name, loc))
         else:
@@ -2260,6 +6053,58 @@ class PewmaManager(object):
         return loc
 
 
+    def get_java_cache_key(self):
+        """ Returns the key for the "java" on the PATH in the Java cache: its resolved path, inode, size and mtime,
+            plus any environment variables that change the Java defaults (so that a changed JDK is never looked up)
+            Returns None if there is no java on the PATH
+        """
+
+        java_locs = find_executables_on_path('java.exe' if self.isWindows else 'java')
+        if not java_locs:
+            return None
+        java_loc = os.path.realpath(java_locs[0])
+        try:
+            java_stat = os.stat(java_loc)
+        except OSError:
+            return None
+        return '|'.join([java_loc, str(java_stat.st_ino), str(java_stat.st_size), repr(java_stat.st_mtime)] +
+                        ['%s=%s' % (name, os.environ[name]) for name in JAVA_OPTIONS_ENVIRONMENT_VARIABLES if name in os.environ])
+
+
+    def load_java_cache(self):
+        """ Returns the Java cache, a dictionary with "entries" of {key: {"java_version", "java_default_tmpdir", "checked"}}
+            (an empty one if there isn't one yet, or it is unreadable)
+        """
+
+        try:
+            with open(os.path.expanduser(JAVA_CACHE_FILE)) as cache_file:
+                java_cache = json.load(cache_file)
+            if java_cache.get('format') == JAVA_CACHE_FORMAT:
+                return java_cache
+        except (IOError, ValueError):
+            pass
+        return {'format': JAVA_CACHE_FORMAT, 'entries': {}}
+
+
+    def save_java_cache_entry(self, java_cache_key):
+        """ Saves the Java version and java.io.tmpdir just determined in the Java cache, keeping only the most recently checked entries
+        """
+
+        cache_path = os.path.expanduser(JAVA_CACHE_FILE)
+        try:
+            if not os.path.isdir(os.path.dirname(cache_path)):
+                os.makedirs(os.path.dirname(cache_path))
+            with exclusive_file_lock(cache_path + '.lock'):
+                java_cache = self.load_java_cache()
+                java_cache['entries'][java_cache_key] = {'java_version': self.java_version_current,
+                                                         'java_default_tmpdir': self.java_default_tmpdir,
+                                                         'checked': int(time.time())}
+                java_cache['entries'] = dict(sorted(java_cache['entries'].items(), key=lambda item: item[1]['checked'])[-JAVA_CACHE_ENTRIES_KEPT:])
+                self.write_json_file(cache_path, java_cache)
+        except (IOError, OSError) as e:
+            self.logger.debug('%sCould not save Java cache "%s": %s' % (self.log_prefix, cache_path, e))
+
+
     def report_and_check_java_version(self):
         """ Determines the Java version number, something like 1.7.0_17
             Writes the version number to the log (if it has not already been written)
@@ -2267,21 +6112,29 @@ class PewmaManager(object):
         """
 
         if not self.java_inspected:
-            try:
-                javarun = subprocess.Popen(('java', '-XshowSettings:properties', '-version'), stdout=subprocess.PIPE, stderr=subprocess.STDOUT)  #  java -version writes to stderr
-                (stdout, stderr) = javarun.communicate(None)
-                if not javarun.returncode:
-                    for line in stdout.splitlines():
-                        line = line.strip()
-                        if line.startswith('java.io.tmpdir = '):
-                            self.java_default_tmpdir = line[len('java.io.tmpdir = '):]
-                            continue
-                        if line.startswith('java version "'):
-                            self.java_version_current = line[len('java version "'):].partition('"')[0]
-                            if self.java_default_tmpdir:
-                                break  # we've found both items we were looking for
-            except:
-                pass
+            java_cache_key = self.get_java_cache_key()
+            cached = java_cache_key and self.load_java_cache()['entries'].get(java_cache_key)
+            if cached:
+                (self.java_version_current, self.java_default_tmpdir) = (cached['java_version'], cached['java_default_tmpdir'])
+                self.logger.debug('%sJava version and java.io.tmpdir taken from "%s"' % (self.log_prefix, os.path.expanduser(JAVA_CACHE_FILE),))
+            else:
+                try:
+                    javarun = subprocess.Popen(('java', '-XshowSettings:properties', '-version'), stdout=subprocess.PIPE, stderr=subprocess.STDOUT)  #  java -version writes to stderr
+                    (stdout, stderr) = javarun.communicate(None)
+                    if not javarun.returncode:
+                        for line in stdout.splitlines():
+                            line = line.strip()
+                            if line.startswith('java.io.tmpdir = '):
+                                self.java_default_tmpdir = line[len('java.io.tmpdir = '):]
+                                continue
+                            if line.startswith('java version "'):
+                                self.java_version_current = line[len('java version "'):].partition('"')[0]
+                                if self.java_default_tmpdir:
+                                    break  # we've found both items we were looking for
+                except:
+                    pass
+                if java_cache_key and self.java_version_current and self.java_default_tmpdir:
+                    self.save_java_cache_entry(java_cache_key)
             if self.java_version_current:
                 self.logger.info('%sJava version that will be used: %s' % (self.log_prefix, self.java_version_current))
             else:
@@ -2304,10 +6157,11 @@ class PewmaManager(object):
         return self.java_version_current
 
 
-    def determine_java_io_tmpdir(self):
+    def determine_java_io_tmpdir(self, suffix=''):
         """ If the environment variable "JENKINS_java_io_tmpdir_alternative" was specified,
             determine the amount of free space there, and use that for java.io.tmpdir if
             there's more free space than the default location.
+            suffix is appended to the name of the directory created there (to make it unique)
         """
 
         java_io_tmpdir_alternative = os.environ.get('JENKINS_java_io_tmpdir_alternative')  # specified in the Jenkins agent configuration
@@ -2334,7 +6188,7 @@ class PewmaManager(object):
         if alternative_free <= default_free:
             return
 
-        new_tmpdir = os.path.join(java_io_tmpdir_alternative, datetime.datetime.today().strftime("%Y%m%d_%H%M%S_") + os.environ.get('BUILD_TAG', ''))
+        new_tmpdir = os.path.join(java_io_tmpdir_alternative, datetime.datetime.today().strftime("%Y%m%d_%H%M%S_") + os.environ.get('BUILD_TAG', '') + suffix)
         try:
             os.mkdir(new_tmpdir)
         except:
@@ -2342,32 +6196,302 @@ class PewmaManager(object):
         return new_tmpdir
 
 
-    def Xvfb_display_number_calculate(self):
+    def Xvfb_display_number_calculate(self, shard_number=None):
         """ Tests are sometimes run without a GUI (X-Server), e.g. when running in a Jenkins slave started from the command line.
             However, certain tests require a GUI. The answer is to start a simulated X-server, using Xvfb (X virtual frame buffer) and attach it to a $DISPLAY.
             If more than one test job is run in parallel, each job should get its own Xvfb simulated display.
-            This routine simply determines what the display number should be.
+            This routine simply determines what the display number should preferably be (claim_Xvfb_display then claims a free one).
+            Shards of a job (--test-jobs) get the job's display number offset by 1000 for each shard after the first.
         """
 
         if "linux" in platform.system().lower():
+            shard_offset = 1000 * ((shard_number or 1) - 1)
             if os.environ.get("EXECUTOR_NUMBER"):
                 jenkins_executor = os.environ.get("EXECUTOR_NUMBER")
                 try:
-                    return 9123 + int(jenkins_executor) + 1
+                    return 9123 + int(jenkins_executor) + 1 + shard_offset
                 except (ValueError, TypeError):
-                    return 9123
+                    return 9123 + shard_offset
             else:
                 try:
-                    return 9200 + int(("00%s" % os.getpid())[-2:])  # base on last 2 digits of PID
+                    return 9200 + int(("00%s" % os.getpid())[-2:]) + shard_offset  # base on last 2 digits of PID
                 except (ValueError, TypeError):
-                    return 9223
+                    return 9223 + shard_offset
         else:
             return None
 
 
-    def run_buckminster_in_subprocess(self, buckminster_args, scan_for_materialize_errors=True, scan_compile_messages=True):
+    def get_Xvfb_displays(self):
+        """ Returns the XvfbDisplays allocator
+        """
+
+        if not hasattr(self, 'Xvfb_displays'):
+            self.Xvfb_displays = XvfbDisplays(self.logger)
+        return self.Xvfb_displays
+
+
+    def claim_Xvfb_display(self, shard_number=None):
+        """ Claims an Xvfb display for a test run: with --xvfb-pool, one of the pool's running servers if one is free,
+            otherwise a display number that no other run is using (starting from Xvfb_display_number_calculate)
+            Returns (display number, whether it is a running pool server), or (None, False) if not on Linux
+        """
+
+        preferred = self.Xvfb_display_number_calculate(shard_number)
+        if (not preferred) or self.options.dry_run:
+            return (preferred, False)
+        if self.options.xvfb_pool:
+            display = self.get_Xvfb_displays().lease()
+            if display:
+                return (display, True)
+            self.logger.warn('%sNo free Xvfb server in the pool, so the tests will start their own' % (self.log_prefix,))
+        return (self.get_Xvfb_displays().claim(preferred), False)
+
+
+    def action_xvfb_pool(self):
+        """ Processes command: xvfb-pool {start [<count>]|stop|status}
+        """
+
+        if not self.isLinux:
+            raise PewmaException('ERROR: xvfb-pool command is only supported on Linux')
+        if (not self.arguments) or (self.arguments[0] not in ('start', 'stop', 'status')):
+            raise PewmaException('ERROR: xvfb-pool command must be followed by start, stop or status')
+        (subcommand, arguments) = (self.arguments[0], self.arguments[1:])
+        if len(arguments) > (subcommand == 'start'):
+            raise PewmaException('ERROR: xvfb-pool %s command has too many arguments' % (subcommand,))
+
+        Xvfb_displays = self.get_Xvfb_displays()
+        if subcommand == 'start':
+            try:
+                count = int(arguments[0]) if arguments else 1
+            except ValueError:
+                count = 0
+            if count < 1:
+                raise PewmaException('ERROR: xvfb-pool start <count> must be a positive integer, not "%s"' % (arguments[0],))
+            if self.options.dry_run:
+                self.logger.info('%sStarting %s Xvfb servers' % (self.log_prefix, count))
+                return
+            self.report_executable_location('Xvfb')
+            servers = Xvfb_displays.start_pool(count, self.Xvfb_display_number_calculate())
+        elif subcommand == 'stop':
+            if self.options.dry_run:
+                self.logger.info('%sStopping the Xvfb servers in the pool' % (self.log_prefix,))
+                return
+            Xvfb_displays.stop_pool()
+            return
+        else:
+            servers = Xvfb_displays.read_pool()
+        for server in servers:
+            (_, pid) = read_lock_pid(os.path.join(Xvfb_displays.lock_dir, '.pewma-X%s-lock' % (server['display'],)))
+            print('display :%s  Xvfb process %s  %s' % (server['display'], server['pid'],
+                  ('in use by process %s' % (pid,)) if (pid and pid_alive(pid)) else 'free'))
+        if not servers:
+            self.logger.info('%sThere are no Xvfb servers in the pool' % (self.log_prefix,))
+
+
+    def record_metric(self, phase, start_time, duration, rc, detail=None, peak_rss_mb=None):
+        """ Records the timing of a phase of the action (safe to call from multiple threads at once)
+            peak_rss_mb is the peak RSS of the Buckminster or ant process the phase ran, if it was one; otherwise the peak recorded
+            is that of the largest such process that started during the phase (or None if there were none)
+            The records are written to the metrics file when the action ends
+        """
+
+        if self.action in METRICS_SKIPPED_ACTIONS:
+            return
+        with self.metrics_lock:
+            if peak_rss_mb is not None:
+                self.child_peak_rss.append((start_time, peak_rss_mb))
+                peak_child_rss_mb = peak_rss_mb
+            else:
+                peak_child_rss_mb = max([mb for (child_start_time, mb) in self.child_peak_rss if child_start_time >= start_time] or [None])
+            self.metrics.append({'format': METRICS_FORMAT,
+                                 'run': '%s-%s' % (self.start_time.strftime('%Y%m%d_%H%M%S'), os.getpid()),
+                                 'host': socket.gethostname(),
+                                 'action': self.action,
+                                 'phase': phase,
+                                 'detail': detail,
+                                 'start': datetime.datetime.fromtimestamp(start_time).strftime('%Y-%m-%dT%H:%M:%S'),
+                                 'duration': round(duration, 3),
+                                 'rc': rc,
+                                 'peak_child_rss_mb': peak_child_rss_mb,
+                                 })
+
+
+    @contextlib.contextmanager
+    def timed_phase(self, phase, detail=None):
+        """ Context manager that records the timing of a phase of the action
+            Yields a dictionary, in which the caller should set "rc" to the outcome (if it's left unset, the phase is recorded as failed)
+        """
+
+        outcome = {'rc': 1}
+        start_time = time.time()
+        try:
+            yield outcome
+        finally:
+            self.record_metric(phase, start_time, time.time() - start_time, outcome['rc'], detail)
+
+
+    def write_metrics(self):
+        """ Appends the metrics recorded for this run to the metrics file, and writes the Prometheus textfile if requested
+            Failures are logged, but are not fatal
+        """
+
+        if self.options.dry_run or not self.metrics:
+            return
+        if not self.options.no_metrics:
+            metrics_path = os.path.abspath(os.path.expanduser(self.options.metrics_file))
+            try:
+                if not os.path.isdir(os.path.dirname(metrics_path)):
+                    os.makedirs(os.path.dirname(metrics_path))
+                with exclusive_file_lock(metrics_path + '.lock'):  # concurrent pewma runs append whole records
+                    if os.path.isfile(metrics_path) and (os.path.getsize(metrics_path) >= METRICS_FILE_MAX_BYTES):
+                        if os.path.isfile(metrics_path + '.1') and self.isWindows:
+                            os.remove(metrics_path + '.1')  # rename does not replace an existing file on Windows
+                        os.rename(metrics_path, metrics_path + '.1')
+                    with open(metrics_path, 'a') as metrics_file:
+                        for record in self.metrics:
+                            metrics_file.write(json.dumps(record, sort_keys=True) + '\n')
+            except (IOError, OSError) as e:
+                self.logger.warn('%sCould not write metrics file "%s": %s' % (self.log_prefix, metrics_path, e))
+
+        if self.options.prometheus_textfile:
+            textfile_path = os.path.abspath(os.path.expanduser(self.options.prometheus_textfile))
+            durations = {}  # {phase: (total duration, count)}
+            for record in self.metrics:
+                (total, count) = durations.get(record['phase'], (0, 0))
+                durations[record['phase']] = (total + record['duration'], count + 1)
+            action_record = self.metrics[-1]
+            labels = 'action="%s",host="%s"' % (self.action, socket.gethostname())
+            lines = ['# HELP pewma_phase_duration_seconds Total time spent in each phase of the last pewma run',
+                     '# TYPE pewma_phase_duration_seconds gauge']
+            lines.extend('pewma_phase_duration_seconds{%s,phase="%s"} %s' % (labels, phase, durations[phase][0]) for phase in sorted(durations))
+            lines.extend(['# HELP pewma_phase_count Number of times each phase ran in the last pewma run',
+                          '# TYPE pewma_phase_count gauge'])
+            lines.extend('pewma_phase_count{%s,phase="%s"} %s' % (labels, phase, durations[phase][1]) for phase in sorted(durations))
+            lines.extend(['# HELP pewma_exit_code Exit code of the last pewma run (-1 if it raised an exception)',
+                          '# TYPE pewma_exit_code gauge',
+                          'pewma_exit_code{%s} %s' % (labels, action_record['rc'] if action_record['rc'] is not None else -1),
+                          '# HELP pewma_last_run_timestamp_seconds When the last pewma run ended',
+                          '# TYPE pewma_last_run_timestamp_seconds gauge',
+                          'pewma_last_run_timestamp_seconds{%s} %s' % (labels, int(time.time()))])
+            if action_record['peak_child_rss_mb'] is not None:
+                lines.extend(['# HELP pewma_peak_child_rss_bytes Peak resident set size of the largest child process of the last pewma run',
+                              '# TYPE pewma_peak_child_rss_bytes gauge',
+                              'pewma_peak_child_rss_bytes{%s} %s' % (labels, action_record['peak_child_rss_mb'] * 1024 * 1024)])
+            temp_path = '%s.%s.tmp' % (textfile_path, os.getpid())  # the textfile collector must never see a partial file
+            try:
+                with open(temp_path, 'w') as textfile:
+                    textfile.write('\n'.join(lines) + '\n')
+                os.rename(temp_path, textfile_path)
+            except (IOError, OSError) as e:
+                self.logger.warn('%sCould not write Prometheus textfile "%s": %s' % (self.log_prefix, textfile_path, e))
+
+
+    def get_auto_tune_profile_path(self):
+        """ Returns the path of the --auto-tune profile for this host
+        """
+
+        return os.path.join(os.path.abspath(os.path.expanduser(self.options.auto_tune_profile_dir)), '%s.json' % (socket.gethostname() or 'localhost',))
+
+
+    def load_auto_tune_profile(self):
+        """ Returns the --auto-tune profile for this host (an empty one if there isn't one yet, or it is unreadable)
+        """
+
+        profile_path = self.get_auto_tune_profile_path()
+        try:
+            with open(profile_path) as profile_file:
+                profile = json.load(profile_file)
+            if profile.get('format') == AUTO_TUNE_PROFILE_FORMAT:
+                return profile
+        except (IOError, ValueError) as e:
+            if os.path.exists(profile_path):
+                self.logger.debug('%sIgnoring unreadable profile "%s": %s' % (self.log_prefix, profile_path, e))
+        return {'format': AUTO_TUNE_PROFILE_FORMAT, 'runs': []}
+
+
+    def get_auto_tune_settings(self):
+        """ Returns the --auto-tune settings for Buckminster, a dictionary of {"heap_mb": <MB>, "parallel": <materializations at once>}
+            The starting point is a quarter of the memory available (up to half, at most) and one materialization per CPU.
+            If this host has run the action before, the heap is then grown if the last run came close to filling it, or shrunk if the
+            last run used much less, and the parallelism of the fastest successful run is used (or one more, if that was the last run).
+        """
+
+        if self.auto_tune_settings:
+            return self.auto_tune_settings
+
+        (memory, cpus) = get_host_resources()
+        memory_mb = memory // (1024 * 1024) if memory else None
+        heap_limit_mb = AUTO_TUNE_MAX_HEAP_MB
+        if memory_mb:
+            heap_limit_mb = min(heap_limit_mb, max(AUTO_TUNE_MIN_HEAP_MB, memory_mb // 2))
+        heap_mb = min(max(AUTO_TUNE_MIN_HEAP_MB, (memory_mb or 0) // 4), heap_limit_mb)
+        parallel = min(max(2, cpus), AUTO_TUNE_MAX_PARALLEL)
+        reason = 'host has %s MB and %s CPUs available' % (memory_mb or 'unknown', cpus)
+
+        runs = [run for run in self.load_auto_tune_profile()['runs'] if run['action'] == self.action]
+        if runs:
+            last_run = runs[-1]
+            if last_run['peak_rss_mb'] and (last_run['peak_rss_mb'] >= 0.9 * (last_run['heap_mb'] + AUTO_TUNE_JVM_OVERHEAD_MB)):
+                heap_mb = last_run['heap_mb'] * 3 // 2
+                reason += ', last run nearly filled its %s MB heap' % (last_run['heap_mb'],)
+            elif last_run['peak_rss_mb'] and (last_run['peak_rss_mb'] < 0.5 * last_run['heap_mb']):
+                heap_mb = last_run['peak_rss_mb'] * 3 // 2
+                reason += ', last run used %s MB of its %s MB heap' % (last_run['peak_rss_mb'], last_run['heap_mb'])
+            else:
+                heap_mb = last_run['heap_mb']
+            successful_runs = [run for run in runs if (not run['rc']) and run.get('parallel')]
+            if successful_runs:
+                fastest_run = min(successful_runs, key=lambda run: run['wall_seconds'])
+                parallel = fastest_run['parallel']
+                tried = set(run['parallel'] for run in successful_runs)
+                if (fastest_run is successful_runs[-1]) and ((parallel + 1) not in tried) and (parallel < min(2 * cpus, AUTO_TUNE_MAX_PARALLEL)):
+                    parallel += 1  # the last run was the fastest so far, so see whether a little more parallelism helps
+                reason += ', fastest of %s earlier runs used %s in parallel' % (len(successful_runs), fastest_run['parallel'])
+
+        heap_mb = -(-heap_mb // AUTO_TUNE_HEAP_STEP_MB) * AUTO_TUNE_HEAP_STEP_MB  # round up
+        heap_mb = min(max(AUTO_TUNE_MIN_HEAP_MB, heap_mb), heap_limit_mb)
+        parallel = max(1, min(parallel, heap_mb // AUTO_TUNE_HEAP_MB_PER_MATERIALIZATION))
+        self.auto_tune_settings = {'heap_mb': heap_mb, 'parallel': parallel}
+        self.logger.info('%sAuto-tune: Buckminster heap %s MB, %s materializations in parallel (%s)' % (self.log_prefix, heap_mb, parallel, reason))
+        return self.auto_tune_settings
+
+
+    def record_auto_tune_run(self, wall_seconds, retcode, materialized, peak_rss_mb):
+        """ Adds a Buckminster run (its wall time, the peak RSS of the Buckminster process, and the settings used) to this host's
+            --auto-tune profile, which is used to refine the settings next time
+        """
+
+        run = {'action': self.action,
+               'time': datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+               'heap_mb': self.auto_tune_settings['heap_mb'],
+               'parallel': self.auto_tune_settings['parallel'] if materialized else None,  # parallelism only matters when materializing
+               'wall_seconds': round(wall_seconds, 1),
+               'peak_rss_mb': peak_rss_mb,
+               'rc': retcode,
+               }
+        self.logger.info('%sAuto-tune: Buckminster took %s with peak RSS %s MB' %
+                         (self.log_prefix, datetime.timedelta(seconds=int(wall_seconds)), peak_rss_mb if peak_rss_mb is not None else 'unknown'))
+        profile_path = self.get_auto_tune_profile_path()
+        with self.auto_tune_profile_lock:  # concurrent Buckminster processes (--parallel-platforms) record their runs one at a time
+            try:
+                if not os.path.isdir(os.path.dirname(profile_path)):
+                    os.makedirs(os.path.dirname(profile_path))
+                with exclusive_file_lock(profile_path + '.lock'):
+                    profile = self.load_auto_tune_profile()
+                    profile['runs'] = (profile['runs'] + [run])[-AUTO_TUNE_PROFILE_RUNS_KEPT:]
+                    self.write_json_file(profile_path, profile)
+            except (IOError, OSError) as e:
+                self.logger.warn('%sCould not save auto-tune profile "%s": %s' % (self.log_prefix, profile_path, e))
+
+
+    def run_buckminster_in_subprocess(self, buckminster_args, scan_for_materialize_errors=True, scan_compile_messages=True, prepare_jenkins_build_description=True,
+                                      stage_markers=(), output_line_prefix=b'', workspace_loc=None):
         """ Generates and runs the buckminster command
             scan_for_materialize_errors/scan_compile_messages are just an optimisation; set to False if not materializing/building
+            stage_markers is passed to the BuckminsterOutputScanner, to attribute errors to the stages of a pipeline
+            output_line_prefix is put before each line of output echoed (to tell apart the output of concurrent processes)
+            workspace_loc, if specified, is the workspace Buckminster uses instead of the --workspace
+            The BuckminsterOutputScanner used is left in self.buckminster_output_scanner, so that the caller can examine the errors
         """
 
         self.report_executable_location('buckminster')
@@ -2378,7 +6502,7 @@ class PewmaManager(object):
             buckminster_command.extend(('-debug', self.options.debug_options_file))
         buckminster_command.extend(('-application', 'org.eclipse.buckminster.cmdline.headless'))
         buckminster_command.extend(('--loglevel', self.options.log_level.upper()))
-        buckminster_command.extend(('-data', self.workspace_loc))  # do not quote the workspace name (it should not contain blanks)
+        buckminster_command.extend(('-data', workspace_loc or self.workspace_loc))  # do not quote the workspace name (it should not contain blanks)
         buckminster_command.extend(buckminster_args)
 
         vmargs_to_add = []
@@ -2393,7 +6517,10 @@ class PewmaManager(object):
         if possibly_bucky_4point5_plus:
             vmargs_to_add.append('-noverify')
         # if debugging memory allocation, add this parameter: '-XX:+PrintFlagsFinal'
-        if not self.isWindows:  # these extra options need to be removed on my Windows XP 32-bit / Java 1.7.0_25 machine
+        if self.options.auto_tune:
+            heap_mb = self.get_auto_tune_settings()['heap_mb']
+            vmargs_to_add.extend(('-Xms%sm' % (min(heap_mb, AUTO_TUNE_MIN_HEAP_MB),), '-Xmx%sm' % (heap_mb,), '-XX:+UseG1GC', '-XX:MaxGCPauseMillis=1000'))
+        elif not self.isWindows:  # these extra options need to be removed on my Windows XP 32-bit / Java 1.7.0_25 machine
             vmargs_to_add.extend(('-Xms768m', '-Xmx1536m', '-XX:+UseG1GC', '-XX:MaxGCPauseMillis=1000'))
         if self.java_proxy_system_properties:
             vmargs_to_add.extend(self.java_proxy_system_properties)
@@ -2409,6 +6536,7 @@ class PewmaManager(object):
 
         buckminster_command = ' '.join(buckminster_command)
         self.logger.info('%sRunning: %s' % (self.log_prefix, buckminster_command))
+        script_commands = []  # the Buckminster commands in the script file, to describe the run in the metrics
         try:
             scriptfile_index = buckminster_args.index('--scriptfile')
         except ValueError:
@@ -2425,87 +6553,24 @@ class PewmaManager(object):
                 with open(script_file_path_to_pass) as script_file:
                     for line in script_file.readlines():
                         self.logger.debug('%s(script file): %s' % (self.log_prefix, line))
+                        command = line.split()[0] if line.strip() else '#'
+                        if (not command.startswith('#')) and (command not in ('importproxysettings', 'setpref')) and (command not in script_commands):
+                            script_commands.append(command)
 
-        system_problems = []
-        jgit_errors_repos = []
-        jgit_errors_general = []
-        project_error_projects = []
-        buckminster_bugs = []
-        compile_error_bugs = []  # compile errors caused by Buckminster bugs
-        compile_errors_seen = False  # regular compile errors
+        scanner = BuckminsterOutputScanner(scan_for_materialize_errors, scan_compile_messages, self.options.suppress_compile_warnings, stage_markers)
         if not self.options.dry_run:
             sys.stdout.flush()
             sys.stderr.flush()
             retcode = 2  # assume failure, we'll set to 0 if success
+            peak_rss_mb = None
+            start_time = time.time()
             try:
                 process = subprocess.Popen(buckminster_command, bufsize=1, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, shell=True)
-                last_text_to_suppress = OUTPUT_LINES_TO_SUPPRESS[-1]
-                seen_last_text_to_suppress = False  # optimisation to avoid looking for OUTPUT_LINES_TO_SUPPRESS once we've seen them all
                 for line in iter(process.stdout.readline, b''):
-                    # sometimes there are system problems
-                    # sometimes JGit gets intermittent failures (network?) when cloning a repository
-                    # sometimes Buckminster detects an error in the projects
-                    # sometimes Buckminster hits an intermittent bug
-                    for (error_pattern, error_summary) in SYSTEM_PROBLEM_ERROR_PATTERNS:
-                        system_problem = re.search(error_pattern, line)
-                        if system_problem:
-                            system_problems.append(error_summary)
-                    if scan_for_materialize_errors:
-                        for (error_pattern, error_summary) in JGIT_ERROR_PATTERNS:
-                            jgit_error = re.search(error_pattern, line)
-                            if jgit_error:
-                                if isinstance(error_summary, int):
-                                    jgit_errors_repos.append(os.path.basename(jgit_error.group(error_summary)))
-                                else:
-                                    jgit_errors_general.append(error_summary)
-                        for (error_pattern, error_summary) in PROJECT_ERROR_PATTERNS:
-                            project_error = re.search(error_pattern, line)
-                            if project_error:
-                                try:
-                                    project_error_projects.append(project_error.group(error_summary))
-                                except:
-                                    project_error_projects.append('<unknown>')
-                        for (error_pattern, error_summary) in BUCKMINSTER_BUG_ERROR_PATTERNS:
-                            buckminster_bug = re.search(error_pattern, line)
-                            if buckminster_bug:
-                                buckminster_bugs.append(error_summary)
-                    try:
-                        if self.options.suppress_compile_warnings and line[0:len('Warning: file ')] == 'Warning: file ':
-                            continue  # finished with this line of output
-                    except UnicodeDecodeError:
-                        pass
-                    if scan_compile_messages:
-                        for (error_pattern, error_summary) in COMPILE_ERROR_DUE_TO_BUCKMINSTER_BUG_PATTERNS:
-                            compile_error_bug = re.search(error_pattern, line)
-                            if compile_error_bug:
-                                compile_error_bugs.append(error_summary)
-                                break
-                        else:
-                            try:
-                                if line[0:len('Error: file ')] == 'Error: file ':
-                                    compile_errors_seen = True
-                            except UnicodeDecodeError:
-                                pass
-                    if seen_last_text_to_suppress:
-                        print(line, end='')  # don't add an extra newline
-                    else:
-                        # Hack: if line contains non-ASCII characters, then "if line == x:" will emit the following warning:
-                        # UnicodeWarning: Unicode equal comparison failed to convert both arguments to Unicode - interpreting them as being unequal
-                        # So, test explicitly whether a line contains non-ASCII characters, and hand that ourselves
-                        try:
-                            unicode(line)
-                        except UnicodeDecodeError:
-                            print(line, end='')  # don't add an extra newline
-                        else:
-                            for x in OUTPUT_LINES_TO_SUPPRESS:
-                                if line == x:
-                                    if line == last_text_to_suppress:
-                                        seen_last_text_to_suppress = True
-                                    break
-                            else:
-                                print(line, end='')  # don't add an extra newline
-                process.communicate() # close p.stdout, wait for the subprocess to exit                
-                retcode = process.returncode
+                    if scanner.scan_line(line):
+                        print(output_line_prefix + line, end='')  # don't add an extra newline
+                process.stdout.close()
+                (retcode, peak_rss_mb) = wait_for_subprocess(process)
             except OSError:
                 raise PewmaException('ERROR: Buckminster failed: %s' % (sys.exc_info()[1],))
             sys.stdout.flush()
@@ -2514,55 +6579,86 @@ class PewmaManager(object):
                 self.logger.error('Buckminster return Code: %s' % (retcode,))
             else:
                 self.logger.debug('Buckminster return Code: %s' % (retcode,))
+            if self.options.auto_tune:
+                self.record_auto_tune_run(time.time() - start_time, retcode, materialized=scan_for_materialize_errors, peak_rss_mb=peak_rss_mb)
+            self.record_metric('buckminster', start_time, time.time() - start_time, retcode,
+                               detail=','.join(script_commands) if script_commands else buckminster_args[0], peak_rss_mb=peak_rss_mb)
         else:
             retcode = 0
 
-        if any((system_problems, jgit_errors_repos, jgit_errors_general, project_error_projects, buckminster_bugs, compile_error_bugs)):
+        self.buckminster_output_scanner = scanner
+        return self._report_buckminster_errors(scanner, retcode, prepare_jenkins_build_description)
+
+
+    def _transient_materialize_failure(self, scanner):
+        """ Returns True if the only errors found by a BuckminsterOutputScanner are network errors cloning named repositories
+            (whose partial clones can be deleted) or intermittent Buckminster bugs, so that rerunning the materialize should work
+        """
+
+        return bool((scanner.jgit_errors_repos or scanner.buckminster_bugs) and not
+                    (scanner.system_problems or scanner.jgit_errors_general or scanner.project_error_projects or scanner.compile_error_bugs))
+
+
+    def _report_buckminster_errors(self, scanner, retcode, prepare_jenkins_build_description=True):
+        """ Logs the errors found by a BuckminsterOutputScanner (and prepares the Jenkins build description if requested)
+            Returns the return code, adjusted to indicate failure if errors were found
+        """
+
+        if scanner.errors_found():
             retcode = max(int(retcode), 2)
-            for error_summary in set(system_problems):  # Use set, since multiple errors could have the same text, and only need logging once
+            for error_summary in set(scanner.system_problems):  # Use set, since multiple errors could have the same text, and only need logging once
                 self.logger.error(error_summary)
-            for repo in jgit_errors_repos:
+            for repo in scanner.jgit_errors_repos:
                 self.logger.error('Failure cloning ' + repo + ' (probable network issue): you MUST delete the partial clone before retrying')
-            for error_summary in set(jgit_errors_general):  # Use set, since multiple errors could have the same text, and only need logging once
+            for error_summary in set(scanner.jgit_errors_general):  # Use set, since multiple errors could have the same text, and only need logging once
                 self.logger.error(error_summary + ' (probable network issue): you should probably delete the workspace before retrying')
-            for project in set(project_error_projects):  # Use set, since multiple errors could have the same text, and only need logging once
+            for project in set(scanner.project_error_projects):  # Use set, since multiple errors could have the same text, and only need logging once
                 self.logger.error('Failure importing ' +  project + ' (might be invalid project metadata): take a careful look at the error details before retrying')
-            for error_summary in set(buckminster_bugs):  # Use set, since multiple errors could have the same text, and only need logging once
+            for error_summary in set(scanner.buckminster_bugs):  # Use set, since multiple errors could have the same text, and only need logging once
                 self.logger.error(error_summary)
-            for error_summary in set(compile_error_bugs):  # Use set, since multiple errors could have the same text, and only need logging once
+            for error_summary in set(scanner.compile_error_bugs):  # Use set, since multiple errors could have the same text, and only need logging once
                 self.logger.error(error_summary)
-            if self.options.prepare_jenkins_build_description_on_error:
-                if system_problems:
-                    text = system_problems[0]
-                elif jgit_errors_repos:
-                    text = 'Failure cloning '
-                    if len(jgit_errors_repos) == 1:
-                        text += jgit_errors_repos[0]
-                    else:
-                        text += str(len(jgit_errors_repos)) + ' repositories'
-                    text += ' (probable network issue)'
-                elif jgit_errors_general:
-                    text = 'Failure (probable network issue)'
-                elif project_error_projects:
-                    text = 'Failure importing '
-                    if len(project_error_projects) == 1:
-                        text += project_error_projects[0]
-                    else:
-                        text += str(len(project_error_projects)) + ' projects'
-                    text += ' (bad project metadata, or intermittent Buckminster bug)'
-                elif buckminster_bugs:
-                    text = 'Failure (intermittent Buckminster bug)'
-                elif compile_error_bugs:
-                    text = 'Failure - compile errors, probably due to earlier intermittent Buckminster bug'
-                if self.options.prepare_jenkins_build_description_on_error:
-                    print('append-build-description: ' + text)
-        elif compile_errors_seen and self.options.prepare_jenkins_build_description_on_error:
+            if self.options.prepare_jenkins_build_description_on_error and prepare_jenkins_build_description:
+                print('append-build-description: ' + self._buckminster_errors_build_description(scanner))
+        elif scanner.compile_errors_seen and self.options.prepare_jenkins_build_description_on_error and prepare_jenkins_build_description:
             print('append-build-description: Failure - compile errors')
         return retcode
 
 
-    def run_ant_in_subprocess(self, ant_args):
+    def _buckminster_errors_build_description(self, scanner):
+        """ Returns the Jenkins build description text for the errors found by a BuckminsterOutputScanner (None if there were none)
+        """
+
+        text = None
+        if scanner.system_problems:
+            text = scanner.system_problems[0]
+        elif scanner.jgit_errors_repos:
+            text = 'Failure cloning '
+            if len(scanner.jgit_errors_repos) == 1:
+                text += scanner.jgit_errors_repos[0]
+            else:
+                text += str(len(scanner.jgit_errors_repos)) + ' repositories'
+            text += ' (probable network issue)'
+        elif scanner.jgit_errors_general:
+            text = 'Failure (probable network issue)'
+        elif scanner.project_error_projects:
+            text = 'Failure importing '
+            if len(scanner.project_error_projects) == 1:
+                text += scanner.project_error_projects[0]
+            else:
+                text += str(len(scanner.project_error_projects)) + ' projects'
+            text += ' (bad project metadata, or intermittent Buckminster bug)'
+        elif scanner.buckminster_bugs:
+            text = 'Failure (intermittent Buckminster bug)'
+        elif scanner.compile_error_bugs:
+            text = 'Failure - compile errors, probably due to earlier intermittent Buckminster bug'
+        return text
+
+
+    def run_ant_in_subprocess(self, ant_args, shard_number=None, output_path=None):
         """ Generates and runs the ant command
+            For a shard of a --test-jobs run, shard_number selects the Xvfb display and java.io.tmpdir, and the output is
+            written to output_path rather than stdout
         """
 
         self.report_executable_location('ant')
@@ -2593,11 +6689,22 @@ class PewmaManager(object):
             else:
                 raise PewmaException('ERROR: --GDALargeTestFilesLocation=%s does not exist. If any tests require this, they will fail.\n' % (loc,))
 
-        display_number = self.Xvfb_display_number_calculate()
-        if display_number:
+        (display_number, display_pooled) = self.claim_Xvfb_display(shard_number)
+        env = None
+        if display_pooled:
+            env = dict(os.environ)
+            env['DISPLAY'] = ':%s' % (display_number,)  # use the running server (test-common.ant only starts Xvfb if given a display number)
+        elif display_number:
             ant_command.extend(("-DXvfb-display-number=%s" % display_number,))  # used by diamond.releng.tools/ant-headless/test-common.ant
 
-        new_tmpdir = self.determine_java_io_tmpdir()
+        if shard_number:
+            new_tmpdir = self.determine_java_io_tmpdir('_shard%s' % (shard_number,))
+            if (not new_tmpdir) and (not self.options.dry_run):
+                import tempfile
+                tmpdir_parent = self.java_default_tmpdir if (self.java_default_tmpdir and os.path.isdir(self.java_default_tmpdir)) else None
+                new_tmpdir = tempfile.mkdtemp(prefix='pewma-shard%s-' % (shard_number,), dir=tmpdir_parent)
+        else:
+            new_tmpdir = self.determine_java_io_tmpdir()
         if new_tmpdir:
             ant_command.extend(("-Djava.io.tmpdir=" + new_tmpdir,))
 
@@ -2607,31 +6714,50 @@ class PewmaManager(object):
         ant_command.extend(ant_args)
 
         ant_command = ' '.join(ant_command)
-        self.logger.info('%sRunning: %s' % (self.log_prefix, ant_command))
+        if display_pooled:
+            self.logger.info('%sUsing Xvfb server :%s from the pool' % (self.log_prefix, display_number))
+        if output_path:
+            self.logger.info('%sRunning (shard %s, output to "%s"): %s' % (self.log_prefix, shard_number, output_path, ant_command))
+        else:
+            self.logger.info('%sRunning: %s' % (self.log_prefix, ant_command))
 
         if not self.options.dry_run:
             sys.stdout.flush()
             sys.stderr.flush()
+            start_time = time.time()
             try:
-                process = subprocess.Popen(ant_command, bufsize=1, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, shell=True)
-                for line in iter(process.stdout.readline, b''):
-                    print(line, end='')  # don't add an extra newline
-                process.communicate() # close p.stdout, wait for the subprocess to exit                
-                retcode = process.returncode
-            except OSError:
+                if output_path:
+                    with open(output_path, 'wb') as output_file:
+                        process = subprocess.Popen(ant_command, stdout=output_file, stderr=subprocess.STDOUT, shell=True, env=env)
+                        (retcode, peak_rss_mb) = wait_for_subprocess(process)
+                else:
+                    process = subprocess.Popen(ant_command, bufsize=1, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, shell=True, env=env)
+                    for line in iter(process.stdout.readline, b''):
+                        print(line, end='')  # don't add an extra newline
+                    process.stdout.close()
+                    (retcode, peak_rss_mb) = wait_for_subprocess(process)
+            except (IOError, OSError):
                 raise PewmaException('ERROR: Ant failed: %s' % (sys.exc_info()[1],))
+            finally:
+                if display_number:
+                    self.get_Xvfb_displays().release(display_number)
             sys.stdout.flush()
             sys.stderr.flush()
+            shard_description = (' (shard %s)' % (shard_number,)) if shard_number else ''
             if retcode:
-                self.logger.error('Return Code: %s' % (retcode,))
+                self.logger.error('Return Code%s: %s' % (shard_description, retcode,))
             else:
-                self.logger.debug('Return Code: %s' % (retcode,))
+                self.logger.debug('Return Code%s: %s' % (shard_description, retcode,))
+            self.record_metric('ant', start_time, time.time() - start_time, retcode, detail=ant_args[-1] + shard_description, peak_rss_mb=peak_rss_mb)
 
             if new_tmpdir:
-                try:
-                    os.rmdir(new_tmpdir)  # remove the directory if it's empty (i.e. if we never used it)
-                except OSError:
-                    pass
+                if shard_number:
+                    remove_tree(new_tmpdir)  # the shard's own directory, so nothing else is using it
+                else:
+                    try:
+                        os.rmdir(new_tmpdir)  # remove the directory if it's empty (i.e. if we never used it)
+                    except OSError:
+                        pass
 
             return retcode
 
@@ -2641,8 +6767,17 @@ class PewmaManager(object):
         """
 
         # we cache the commit_hook and never re-fetch it from the Gerrit server
-        if hasattr(self, '_gerrit_commit_hook'):
-            return self._gerrit_commit_hook
+        # (gerrit-config can call this from several threads at once, so only one of them does the fetch)
+        with self.gerrit_commit_hook_lock:
+            if not hasattr(self, '_gerrit_commit_hook'):
+                self._gerrit_commit_hook = self._fetch_gerrit_commit_hook()
+        return self._gerrit_commit_hook
+
+
+    def _fetch_gerrit_commit_hook(self):
+        """ Downloads and returns the Gerrit commit hook
+        """
+        import urllib2
 
         commit_hook_url = GERRIT_URI_HTTPS + 'tools/hooks/commit-msg'
         try:
@@ -2670,8 +6805,7 @@ class PewmaManager(object):
             except:
                 pass
 
-        self._gerrit_commit_hook = commit_hook
-        return self._gerrit_commit_hook
+        return commit_hook
 
 ###############################################################################
 #  Main driver                                                                #
@@ -2714,6 +6848,9 @@ class PewmaManager(object):
         self.log_prefix = ("", "(DRY_RUN) ")[self.options.dry_run]
         self.logging_console_handler.setLevel( logging._levelNames[self.options.log_level.upper()] )
         if self.action == 'print-workspace-path': self.options.quiet = True  #  the output of print-workspace-path is used in scripts, so be quiet
+        if self.options.profile_startup:
+            STARTUP_TIMES.append(('options', time.time()))
+            self.report_startup_times()
 
         # validation of options and action
         self.validate_glob_patterns(self.options.project_includes, self.options.project_excludes, '--include or --exclude')
@@ -2722,14 +6859,44 @@ class PewmaManager(object):
             raise PewmaException('ERROR: you can specify at most one of --delete, --recreate and --tp-recreate')
         if self.options.gerrit_only and self.options.non_gerrit_only:
             raise PewmaException('ERROR: you can specify at most one of --gerrit-only and --non-gerrit-only')
+        if (self.options.git_jobs is not None) and (self.options.git_jobs < 1):
+            raise PewmaException('ERROR: --jobs must be at least 1')
+        if self.options.snapshot_size < 0:
+            raise PewmaException('ERROR: --snapshot-size must not be negative')
+        if self.options.snapshots and self.action != 'materialize':
+            raise PewmaException('ERROR: the --snapshots option cannot be specified with action "%s", only with "materialize"' % (self.action))
+        if self.options.test_jobs < 1:
+            raise PewmaException('ERROR: --test-jobs must be at least 1')
+        if (self.options.test_jobs > 1) and (self.action not in TEST_TARGETS):
+            raise PewmaException('ERROR: the --test-jobs option cannot be specified with action "%s", only with %s' % (self.action, ', '.join(TEST_TARGETS)))
+        if (self.options.affected_since or self.options.affected_repositories) and (self.action not in TEST_TARGETS):
+            raise PewmaException('ERROR: the --affected-since and --affected-repositories options cannot be specified with action "%s", only with %s' % (self.action, ', '.join(TEST_TARGETS)))
+        if self.options.force and (self.action != 'buildinc'):
+            raise PewmaException('ERROR: the --force option cannot be specified with action "%s", only with buildinc' % (self.action,))
+        if self.options.xvfb_pool and (self.action not in TEST_TARGETS):
+            raise PewmaException('ERROR: the --xvfb-pool option cannot be specified with action "%s", only with %s' % (self.action, ', '.join(TEST_TARGETS)))
+        if self.options.download_cache_size < 0:
+            raise PewmaException('ERROR: --download-cache-size must not be negative')
+        if self.options.preclone_retries < 0:
+            raise PewmaException('ERROR: --preclone-retries must not be negative')
+        if self.options.parallel_platforms and self.action not in ('product', 'product.zip'):
+            raise PewmaException('ERROR: the --parallel-platforms option cannot be specified with action "%s", only with "product" or "product.zip"' % (self.action))
+        if not re.match(r'^[^:\s]+:\d+$', self.options.graylog_server):
+            raise PewmaException('ERROR: --graylog-server must be specified as <host>:<port>')
+        if self.options.retry_transient < 0:
+            raise PewmaException('ERROR: --retry-transient must not be negative')
+        if self.options.retry_transient and self.action != 'materialize':
+            raise PewmaException('ERROR: the --retry-transient option cannot be specified with action "%s", only with "materialize"' % (self.action))
+        if self.options.preclone and self.action not in ('materialize', 'pipeline'):
+            raise PewmaException('ERROR: the --preclone option cannot be specified with action "%s", only with "materialize" or "pipeline"' % (self.action))
         if (self.action not in list(self.valid_actions.keys())):
             raise PewmaException('ERROR: action "%s" unrecognised (try --help)' % (self.action,))
-        if self.options.delete and self.action not in ('setup', 'materialize'):
+        if self.options.delete and self.action not in ('setup', 'materialize', 'pipeline'):
             raise PewmaException('ERROR: the --delete option cannot be specified with action "%s"' % (self.action))
-        if self.options.recreate and self.action not in ('setup', 'materialize'):
+        if self.options.recreate and self.action not in ('setup', 'materialize', 'pipeline'):
             raise PewmaException('ERROR: the --recreate option cannot be specified with action "%s"' % (self.action))
-        if self.options.tp_recreate and self.action != 'materialize':
-            raise PewmaException('ERROR: the --tp-recreate option cannot be specified with action "%s", only with "materialize"' % (self.action))
+        if self.options.tp_recreate and self.action not in ('materialize', 'pipeline'):
+            raise PewmaException('ERROR: the --tp-recreate option cannot be specified with action "%s", only with "materialize" or "pipeline"' % (self.action))
         if self.options.system_property:
             if any((keyval.find('=') == -1) for keyval in self.options.system_property):
                 raise PewmaException('ERROR: the -D option must specify a property and value as "key=value"')
@@ -2742,13 +6909,13 @@ class PewmaManager(object):
         if self.options.workspace:
             self.workspace_loc = os.path.realpath(os.path.abspath(os.path.expanduser(self.options.workspace)))
             log_msg = '%s"--workspace" specified as "%s"' % (self.log_prefix, self.workspace_loc,)
-        elif self.action != 'get-branches-expected':
+        elif self.action not in ('get-branches-expected', 'resolve-components', 'scan-log', 'template-benchmark', 'startup-benchmark', 'mirror-gc', 'stats', 'xvfb-pool'):
             self._determine_workspace_location_when_not_specified()
             log_msg = '%s"--workspace" defaulted to "%s"' % (self.log_prefix, self.workspace_loc,)
         else:
             self.workspace_loc = None
 
-        if self.workspace_loc:  # will be set, unless (self.action == 'get-branches-expected')
+        if self.workspace_loc:  # will be set, unless (self.action in ('get-branches-expected', 'resolve-components', 'scan-log', 'template-benchmark', 'startup-benchmark', 'mirror-gc', 'stats', 'xvfb-pool'))
             self.logger.log(logging.INFO if not self.options.quiet else logging.DEBUG, log_msg)
             if ' ' in self.workspace_loc:
                 raise PewmaException('ERROR: the "--workspace" directory must not contain blanks')
@@ -2765,7 +6932,7 @@ class PewmaManager(object):
                     raise PewmaException('ERROR: specified workspace location is inside what looks like another workspace (something containing a .metadata/) at "' + parent_workspace + '"')
                 candidate = os.path.dirname(candidate)
             self.workspace_git_loc = self.workspace_loc + '_git'
-        elif (self.action != 'get-branches-expected') or any((self.options.workspace_must_exist, self.options.workspace_must_not_exist)):
+        elif (self.action not in ('get-branches-expected', 'resolve-components', 'scan-log', 'template-benchmark', 'startup-benchmark', 'mirror-gc', 'stats', 'xvfb-pool')) or any((self.options.workspace_must_exist, self.options.workspace_must_not_exist)):
             raise PewmaException('ERROR: the "--workspace" option must be specified. ' +
                                  os.path.basename(sys.argv[0]) +
                                 ' could not determine what workspace to use (based on the current directory).')
@@ -2836,10 +7003,18 @@ class PewmaManager(object):
         self.start_time = datetime.datetime.now()
         (action_handler, attempt_graylog) = self.valid_actions[self.action]
         use_graylog = attempt_graylog and self.setup_graylog_logging()  # returns True if graylog logging actually available 
-        if action_handler:
-            exit_code = action_handler(target=self.action)
-        else:
-            exit_code = getattr(self, 'action_'+self.action.replace('.', '_').replace('-', '_'))()
+        action_start_time = time.time()
+        exit_code = None  # recorded as such if the action raises an exception
+        try:
+            if action_handler:
+                exit_code = action_handler(target=self.action)
+            else:
+                exit_code = getattr(self, 'action_'+self.action.replace('.', '_').replace('-', '_'))()
+        finally:
+            if hasattr(self, 'Xvfb_displays'):
+                self.Xvfb_displays.release_all()  # e.g. if a test shard was interrupted
+            self.record_metric('action', action_start_time, time.time() - action_start_time, exit_code)
+            self.write_metrics()
 
         if (not self.options.quiet) or use_graylog:
             end_time = datetime.datetime.now()
@@ -2860,14 +7035,27 @@ class PewmaManager(object):
                     extra_fields['jenkins_build_tag'] = jenkins_build_tag
                     extra_fields['jenkins_build_url'] = jenkins_build_url
                 self.logger_graylog.log(logging.ERROR if exit_code else logging.INFO, final_message, extra = extra_fields)
+        if use_graylog:
+            self.logging_graylog_handler.close()  # waits (briefly) for the queued records to be sent
+            handler = self.logging_graylog_handler
+            self.logger.debug('Graylog records sent: %s, dropped: %s, failed: %s' % (handler.sent_count, handler.dropped_count, handler.failed_count))
         return exit_code
 
 ###############################################################################
 # Command line processing                                                     #
 ###############################################################################
 
-if __name__ == '__main__':
+STARTUP_TIMES.append(('module', time.time()))
+
+def run(start_time=None):
+    """ Runs pewma with the command line arguments, and exits
+        start_time is when the code at the top of this file started, before it imported this module
+    """
+
+    if start_time:
+        STARTUP_TIMES.insert(0, ('start', start_time))
     pewma = PewmaManager()
+    STARTUP_TIMES.append(('init', time.time()))
     try:
         sys.exit(pewma.main())
     except PewmaException as e:
@@ -2880,3 +7068,5 @@ if __name__ == '__main__':
             print("\nOperation interrupted and will be abandoned")
         sys.exit(3)
 
+if __name__ == '__main__':
+    run()
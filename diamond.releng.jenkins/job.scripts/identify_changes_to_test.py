@@ -799,6 +799,12 @@ post_materialize_function_gerrit () {
 
         with open(SET_JUNIT_OPTIONS_FILE_PATH, 'w') as junit_options_file:
             junit_options_file.write(self.generated_header)
+            if self.get_override_branch_for_repo(None):
+                junit_options_file.write('# repository branches overridden, so test all projects, not just those affected by the changes\n')
+            else:
+                affected_repositories = sorted(set(os.path.basename(ci[0]['project']) + '.git' for ci in self.changes_to_fetch))
+                junit_options_file.write('# only the projects affected by the changes (and the bundles that depend on them) need be tested\n')
+                junit_options_file.write('junit_tests_affected=\'--affected-repositories=%s\'\n' % (','.join(affected_repositories),))
             for ci in self.changes_to_fetch:
                 if ci[0]['project'] == 'eclipse/scanning':
                     junit_options_file.write('# eclipse/scanning included in changes to test, so do NOT skip any tests\n')